@@ -0,0 +1,11 @@
+# gevent workers, so an open event stream holds a greenlet rather than a
+# thread, up to worker_connections requests per worker. EVENT_STREAMS
+# stays below it to leave room for regular requests.
+worker_class = 'gevent'
+worker_connections = 1000
+
+
+def post_fork(server, worker):
+    # psycopg2 blocks in C, waiting on the database must yield instead
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -1,17 +1,24 @@
 import os
+import json
 import subprocess
 import random
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 import requests
 import click
 from sqlalchemy import exc, and_
+from sqlalchemy.sql import func
+from flask import current_app
 from flask.cli import FlaskGroup
 
 from src import create_app, db
-from src.lib.search import add_to_index, TagsIndex, UsersIndex
-from src.blueprints.users.models import User
-from src.blueprints.posts.models import Post
+from src.lib.feed import feed
+from src.lib.search import bulk_index, create_index_version, \
+    get_write_alias, prune_index, publish_index_version
+from src.blueprints.users.models import User, Timeline, Recommendation, \
+    FanOutProgress, fan_out
+from src.blueprints.posts.models import Post, PostRanking
 from src.blueprints.profiles.models import Profile
 from src.blueprints.tags.models import Tag
 from src.blueprints.messages.models import Message, Chat, LastReadMessage
@@ -61,12 +68,352 @@ def routes():
 
 
 @cli.command()
-def index_search_fields():
+@click.option(
+    "--workers",
+    default=4,
+    help="Number of bulk requests sent in parallel."
+)
+@click.option(
+    "--batch-size",
+    default=500,
+    help="Number of documents per bulk request."
+)
+@click.option(
+    "--checkpoint",
+    default=".reindex-checkpoint.json",
+    help="File recording the last indexed id of each index."
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted reindex from the checkpoint."
+)
+def index_search_fields(workers, batch_size, checkpoint, resume):
     """
     Index searchable fields.
+
+    Every index is rebuilt into a new versioned index while searches keep
+    using the current one. Rows are streamed in id order and sent with
+    parallel bulk requests, then the aliases are switched to the new
+    index, the rows changed in the meantime are indexed again and the
+    documents of the rows deleted in the meantime are removed. The
+    last acknowledged id is saved after every batch, so an interrupted
+    run can be continued with --resume.
+
+    :param workers: Number of bulk requests sent in parallel
+    :param batch_size: Number of documents per bulk request
+    :param checkpoint: File recording the last indexed id of each index
+    :param resume: Continue an interrupted reindex from the checkpoint
+    """
+    done = {}
+
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done = json.load(f)
+
+    def save():
+        with open(checkpoint, 'w') as f:
+            json.dump(done, f)
+
+    for model in (Tag, User):
+        index = model.__search_index__
+        alias = index._index._name
+        state = done.get(alias)
+
+        if state is None:
+            state = done[alias] = {
+                'index': create_index_version(index),
+                'started': datetime.utcnow().isoformat(),
+                'last_id': 0,
+            }
+            save()
+        elif state.get('caught_up'):
+            continue
+
+        indexed = 0
+        started = time.perf_counter()
+
+        # a run interrupted after publishing only has the catch-up left
+        if not state.get('published'):
+            for id in bulk_index(
+                    state['index'],
+                    model.iter_search_documents(state['last_id'], batch_size),
+                    workers=workers, chunk_size=batch_size):
+                state['last_id'] = id
+                indexed += 1
+
+                if indexed % batch_size == 0:
+                    save()
+
+            publish_index_version(index, state['index'])
+            state['published'] = True
+            save()
+
+        # rows changed while rebuilding were indexed into the old version
+        changed = model.iter_search_documents(
+            since=datetime.fromisoformat(state['started']))
+        caught_up = sum(1 for _ in bulk_index(
+            get_write_alias(index), changed, workers=workers,
+            chunk_size=batch_size))
+        # and rows deleted meanwhile were only deleted from the old one
+        pruned = prune_index(get_write_alias(index), model, batch_size)
+        state['caught_up'] = True
+        save()
+
+        elapsed = time.perf_counter() - started
+        click.echo(f'Indexed {indexed} {alias} into {state["index"]} in '
+                   f'{elapsed:.1f}s, '
+                   f'{indexed / elapsed if elapsed else 0:.0f} docs/sec, '
+                   f'then {caught_up} changed and {pruned} deleted since.')
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=10000,
+    help="Number of post ids to recompute per transaction."
+)
+def reconcile_counters(batch_size):
+    """
+    Recompute the denormalized like and comment counters on posts.
+
+    :param batch_size: Number of post ids to recompute per transaction
+    """
+    last_id = db.session.query(func.max(Post.id)).scalar() or 0
+    fixed = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        fixed += Post.reconcile_counters(start, start + batch_size)
+        db.session.commit()
+
+    click.echo(f'Fixed counters on {fixed} posts.')
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=1000,
+    help="Number of user ids to backfill per transaction."
+)
+def backfill_timelines(batch_size):
+    """
+    Fill the home timelines of all users from the follow graph.
+
+    :param batch_size: Number of user ids to backfill per transaction
+    """
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    added = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        added += Timeline.backfill(start, start + batch_size).rowcount
+        db.session.commit()
+
+    click.echo(f'Added {added} timeline entries.')
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=10000,
+    help="Number of chat ids to backfill per transaction."
+)
+def backfill_chats(batch_size):
+    """
+    Point every chat at its newest message.
+
+    :param batch_size: Number of chat ids to backfill per transaction
+    """
+    last_id = db.session.query(func.max(Chat.id)).scalar() or 0
+    updated = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        updated += Chat.backfill_last_messages(start, start + batch_size)
+        db.session.commit()
+
+    click.echo(f'Updated {updated} chats.')
+
+
+@cli.command()
+@click.option(
+    "--idle",
+    default=300,
+    help="Seconds without progress after which a fan-out is redone."
+)
+def fan_out_posts(idle):
+    """
+    Finish the fan-out of the posts left unfinished by a crash, a restart
+    or failures, each from where it stopped.
+
+    Meant to be run periodically, e.g. every few minutes from cron.
+
+    :param idle: Seconds without progress after which a fan-out is
+        redone, so fan-outs still running in the app are left alone
+    """
+    ids = [id for id, in db.session.query(FanOutProgress.post_id).filter(
+        FanOutProgress.updated_on < datetime.utcnow() - timedelta(
+            seconds=idle)).order_by(FanOutProgress.post_id)]
+    failed = 0
+
+    for id in ids:
+        try:
+            fan_out.run(id)
+        except Exception as e:
+            failed += 1
+            click.echo(f'Fan-out of post {id} failed: {e}')
+
+    click.echo(f'Fanned out {len(ids) - failed} posts, {failed} failed.')
+
+
+@cli.command()
+def canonicalize_chats():
+    """
+    Store every chat with its participants in id order, merging the
+    pairs stored both ways, then rebuild what depends on chat ids.
+    """
+    merged = Chat.canonicalize()
+    db.session.commit()
+    click.echo(f'Merged {merged} chats.')
+
+    backfill_chats.callback(batch_size=10000)
+    reconcile_unread.callback(batch_size=1000)
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=1000,
+    help="Number of user ids to recompute per transaction."
+)
+def reconcile_unread(batch_size):
+    """
+    Recompute the unread message counters of every chat and user.
+
+    :param batch_size: Number of user ids to recompute per transaction
+    """
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    fixed = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        fixed += User.reconcile_unread(start, start + batch_size)
+        db.session.commit()
+
+    click.echo(f'Fixed unread counters of {fixed} users.')
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=1000,
+    help="Number of user ids to trim per transaction."
+)
+def trim_timelines(batch_size):
+    """
+    Cap every home timeline to the newest TIMELINE_LENGTH posts.
+
+    Meant to be run periodically, e.g. hourly from cron.
+
+    :param batch_size: Number of user ids to trim per transaction
+    """
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    removed = 0
+
+    for start in range(1, last_id + 1, batch_size):
+        removed += Timeline.trim(start, start + batch_size)
+        db.session.commit()
+
+    click.echo(f'Removed {removed} timeline entries.')
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=1000,
+    help="Number of user ids to recommend for per transaction."
+)
+@click.option(
+    "--user-id",
+    type=int,
+    default=None,
+    help="Only recompute the recommendations of this user."
+)
+def recommend_users(batch_size, user_id):
+    """
+    Compute the users to follow of every user.
+
+    Meant to be run periodically, e.g. nightly from cron.
+
+    :param batch_size: Number of user ids to recommend for per transaction
+    :param user_id: Only recompute the recommendations of this user
+    """
+    if user_id is not None:
+        first_id = last_id = user_id
+    else:
+        first_id = 1
+        last_id = db.session.query(func.max(User.id)).scalar() or 0
+    written = 0
+
+    for start in range(first_id, last_id + 1, batch_size):
+        written += Recommendation.rebuild(
+            start, min(start + batch_size, last_id + 1))
+        db.session.commit()
+
+    click.echo(f'Wrote {written} recommendations.')
+
+
+@cli.command()
+@click.option("--rounds", default=100, help="Pages to read per path.")
+@click.argument("user_id", type=int)
+def bench_feed(user_id, rounds):
+    """
+    Compare the latest home feed paths for a user.
+
+    :param user_id: The user whose feed is read
+    :param rounds: Pages to read per path
+    """
+    user = User.find_by_id(user_id)
+    limit = current_app.config['ITEMS_PER_PAGE']
+
+    def union():
+        followed_posts = user.get_followed_posts().subquery()
+        return db.session.query(Post).join(
+            followed_posts, Post.id == followed_posts.c.posts_id).order_by(
+                Post.created_on.desc()).limit(limit + 1).all()
+
+    def engine_cold():
+        feed.clear()
+        return Post.get_merged_feed(user, limit=limit)
+
+    paths = [
+        ('sql union', union),
+        ('sql timeline',
+            lambda: Timeline.get_posts(user.id).limit(limit + 1).all()),
+        ('engine, cold', engine_cold),
+        ('engine, warm', lambda: Post.get_merged_feed(user, limit=limit)),
+    ]
+
+    for name, path in paths:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            path()
+            db.session.expunge_all()
+        elapsed = (time.perf_counter() - start) * 1000 / rounds
+        click.echo(f'{name: >14}: {elapsed:.2f} ms/page')
+
+    click.echo(f'engine cache: {feed.stats()}')
+
+
+@cli.command()
+def rank_posts():
+    """
+    Rebuild the post ranking snapshot behind the "top" feeds.
+
+    Meant to be run periodically, e.g. every minute from cron.
     """
-    add_to_index(TagsIndex, Tag)
-    add_to_index(UsersIndex, User)
+    epoch = PostRanking.rebuild()
+    click.echo(f'Post rankings rebuilt, epoch {epoch}.')
 
 
 @cli.command()
@@ -118,6 +465,12 @@ def seed_db(num_of_users, num_of_posts, num_of_comments):
     seed_comments(num_of_comments)
     seed_conversations()
     seed_messages()
+    backfill_chats.callback(batch_size=10000)
+    reconcile_unread.callback(batch_size=1000)
+    reconcile_counters.callback(batch_size=10000)
+    PostRanking.rebuild()
+    backfill_timelines.callback(batch_size=1000)
+    recommend_users.callback(batch_size=1000, user_id=None)
 
 
 # @cli.command()
@@ -325,7 +678,7 @@ def seed_comments(num_of_comments):
 # @cli.command()
 def seed_conversations():
     users = User.query.all()
-    chats = []
+    chats = {}
     print('Setting up chats...')
 
     for user in users:
@@ -333,17 +686,15 @@ def seed_conversations():
             user.followed.all(), k=(random.randrange(10, 15)))
 
         for u in sample:
-            chat = Chat.query.filter(
-                and_(Chat.user1_id == user.id, Chat.user2_id == u.id) |
-                and_(Chat.user1_id == u.id, Chat.user2_id == user.id)).first()
+            user1_id, user2_id = Chat.participants(user.id, u.id)
 
-            if chat:
+            if (user1_id, user2_id) in chats:
                 continue
 
-            chat = Chat(user1_id=user.id, user2_id=u.id)
-            chats.append(chat)
+            chats[user1_id, user2_id] = Chat(
+                user1_id=user1_id, user2_id=user2_id)
     print('Saving to database...')
-    db.session.add_all(chats)
+    db.session.add_all(chats.values())
     db.session.commit()
 
 
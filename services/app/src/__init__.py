@@ -1,6 +1,5 @@
 import os
 
-# from elasticsearch import Elasticsearch
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 # from flask_migrate import Migrate
@@ -36,10 +35,21 @@ def create_app(config=app_settings):
     # migrate.init_app(app, db)
     cors.init_app(app)
 
-    # app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL']) \
-    #     if app.config['ELASTICSEARCH_URL'] else None
-    # app.search_host = app.config['ES_HOST'] if app.config['ES_HOST'] else None
-    # app.search_port = app.config['ES_PORT'] if app.config['ES_PORT'] else None
+    from src.lib.feed import feed
+    from src.lib.search import indexer, memory_backend, query_cache, \
+        search_client
+    feed.init_app(app)
+    indexer.init_app(app)
+    memory_backend.init_app(app)
+    query_cache.init_app(app)
+    search_client.init_app(app)
+
+    from src.lib.events import events
+    from src.blueprints.messages.models import read_receipts
+    from src.blueprints.users.models import fan_out
+    events.init_app(app)
+    read_receipts.init_app(app, app.config['READ_RECEIPT_DELAY'])
+    fan_out.init_app(app)
 
     @app.route('/ping')
     def ping():
@@ -1,23 +1,166 @@
 from datetime import datetime
 from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
 from src import db
+from src.lib import urlsafe_base64
+from src.lib.buffer import WriteBuffer
+from src.lib.events import events
 
 
 class Chat(db.Model):
     __tablename__ = 'chats'
     __table_args__ = (
         db.Index('_chat_users_idx', 'user2_id', 'user1_id', unique=True),
+        # one row per pair, see participants
+        db.CheckConstraint('user1_id < user2_id', name='ck_chats_user_order'),
+        # the inbox of a user is a range scan on each of these
+        db.Index(
+            'ix_chats_user1_last_message', 'user1_id', 'last_message_at',
+            'id'),
+        db.Index(
+            'ix_chats_user2_last_message', 'user2_id', 'last_message_at',
+            'id'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
     user1_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     user2_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    # denormalized newest message, kept current by the message routes
+    last_message_id = db.Column(db.Integer, db.ForeignKey(
+        "messages.id", ondelete='SET NULL', use_alter=True,
+        name='fk_chats_last_message_id'))
+    last_message_at = db.Column(db.DateTime)
     messages = db.relationship(
-        'Message', backref='chat', cascade='all, delete-orphan')
+        'Message', backref='chat', cascade='all, delete-orphan',
+        foreign_keys='Message.chat_id')
 
     def __repr__(self):
         return f"<Chat: user_{self.user1_id} <-> user_{self.user2_id}>"
 
+    @staticmethod
+    def participants(user_id, other_id):
+        '''The (user1_id, user2_id) of the chat between two users.'''
+        return min(user_id, other_id), max(user_id, other_id)
+
+    @classmethod
+    def find_by_users(cls, user_id, other_id):
+        user1_id, user2_id = cls.participants(user_id, other_id)
+        return cls.query.filter(
+            cls.user1_id == user1_id, cls.user2_id == user2_id).first()
+
+    @classmethod
+    def get_or_create(cls, user_id, other_id):
+        '''
+        Get the chat between two users, creating it in the current
+        transaction if needed. Concurrent first messages end up in the
+        same chat.
+        '''
+        chat = cls.find_by_users(user_id, other_id)
+
+        if chat is None:
+            user1_id, user2_id = cls.participants(user_id, other_id)
+            id = db.session.execute(insert(cls.__table__).values(
+                user1_id=user1_id, user2_id=user2_id).on_conflict_do_nothing(
+                    index_elements=['user2_id', 'user1_id']).returning(
+                        cls.__table__.c.id)).scalar()
+            # None when another transaction created it first
+            chat = cls.query.get(id) if id is not None else \
+                cls.find_by_users(user_id, other_id)
+
+        return chat
+
+    @classmethod
+    def canonicalize(cls):
+        '''
+        Store every chat with user1_id < user2_id, moving the messages of
+        a pair stored both ways into the chat already in that order.
+
+        :return: the number of chats merged away
+        '''
+        twin = aliased(cls)
+        duplicates = db.session.query(cls.id.label('id'), twin.id.label(
+            'twin_id')).join(twin, and_(
+                twin.user1_id == cls.user2_id,
+                twin.user2_id == cls.user1_id)).filter(
+                    cls.user1_id > cls.user2_id).subquery()
+
+        Message.query.filter(Message.chat_id == duplicates.c.id).update(
+            {Message.chat_id: duplicates.c.twin_id},
+            synchronize_session=False)
+        ids = db.session.query(duplicates.c.id)
+        LastReadMessage.query.filter(LastReadMessage.chat_id.in_(
+            ids)).delete(synchronize_session=False)
+        merged = cls.query.filter(cls.id.in_(ids)).delete(
+            synchronize_session=False)
+
+        # the right hand side still holds the values before the update
+        cls.query.filter(cls.user1_id > cls.user2_id).update({
+            cls.user1_id: cls.user2_id,
+            cls.user2_id: cls.user1_id,
+        }, synchronize_session=False)
+
+        return merged
+
+    def set_last_message(self, message):
+        '''
+        Point the chat at a new message, unless a newer one was sent in
+        the meantime.
+        '''
+        Chat.query.filter(Chat.id == self.id).filter(
+            Chat.last_message_at.is_(None) |
+            (Chat.last_message_at <= message.created_on)).update({
+                Chat.last_message_id: message.id,
+                Chat.last_message_at: message.created_on,
+            }, synchronize_session=False)
+
+    def refresh_last_message(self):
+        '''Point the chat at its newest message, after one was deleted.'''
+        last = Message.query.filter(Message.chat_id == self.id).order_by(
+            Message.created_on.desc(), Message.id.desc()).first()
+
+        self.last_message_id = last.id if last else None
+        self.last_message_at = last.created_on if last else None
+
+    @classmethod
+    def backfill_last_messages(cls, start, end):
+        '''
+        Point the chats with start <= id < end at their newest message.
+
+        :return: the number of chats updated
+        '''
+        last = db.session.query(
+            Message.chat_id, Message.id, Message.created_on).filter(
+                Message.chat_id >= start, Message.chat_id < end).distinct(
+                    Message.chat_id).order_by(
+                        Message.chat_id, Message.created_on.desc(),
+                        Message.id.desc()).subquery()
+
+        return cls.query.filter(cls.id == last.c.chat_id).update({
+            cls.last_message_id: last.c.id,
+            cls.last_message_at: last.c.created_on,
+        }, synchronize_session=False)
+
+    @staticmethod
+    def encode_cursor(last_message_at, id):
+        return urlsafe_base64(f'{last_message_at.isoformat()}_{id}')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''
+        :return: (last_message_at, id) tuple, None for the first page
+        :raises ValueError: when the cursor is malformed
+        '''
+        if cursor == '0':
+            return None
+
+        try:
+            last_message_at, id = urlsafe_base64(
+                cursor, from_base64=True).split('_')
+            return datetime.fromisoformat(last_message_at), int(id)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor.')
+
 
 class LastReadMessage(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -25,6 +168,11 @@ class LastReadMessage(db.Model):
         "users.id"), primary_key=True, nullable=False)
     chat_id = db.Column(db.Integer, db.ForeignKey(
         "chats.id"), primary_key=True, nullable=False)
+    # messages received since timestamp, kept current by the message routes
+    unread_count = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False)
+    # messages sent until then are hidden from the user
+    cleared_on = db.Column(db.DateTime)
 
     def save(self):
         """
@@ -41,9 +189,49 @@ class LastReadMessage(db.Model):
             and_(cls.user_id == user_id, cls.chat_id == chat_id)
         ).first()
 
+    @classmethod
+    def write_receipts(cls, receipts):
+        '''
+        Move read markers forward with a single upsert, older timestamps
+        leave a row untouched.
+
+        :param receipts: dict of (user_id, chat_id) to timestamp
+        '''
+        lrm = cls.__table__
+        # rows are locked in key order, so concurrent writers cannot
+        # deadlock
+        stmt = insert(lrm).values([
+            {'user_id': user_id, 'chat_id': chat_id, 'timestamp': timestamp}
+            for (user_id, chat_id), timestamp in sorted(receipts.items())])
+        moved = db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[lrm.c.user_id, lrm.c.chat_id],
+            set_={'timestamp': stmt.excluded.timestamp},
+            where=lrm.c.timestamp.is_(None) |
+            (lrm.c.timestamp < stmt.excluded.timestamp)).returning(
+                lrm.c.user_id, lrm.c.chat_id, lrm.c.timestamp)).fetchall()
+
+        # tell the other side of each chat how far it was read
+        chats = {id: users for id, *users in db.session.query(
+            Chat.id, Chat.user1_id, Chat.user2_id).filter(
+                Chat.id.in_({chat_id for _, chat_id, _ in moved}))}
+        for user_id, chat_id, timestamp in moved:
+            for other_id in chats.get(chat_id, ()):
+                if other_id != user_id:
+                    events.publish(other_id, 'read', {
+                        'chatId': chat_id, 'userId': user_id,
+                        'timestamp': timestamp})
+        db.session.commit()
+
+
+# read markers of the process, written about once per READ_RECEIPT_DELAY
+read_receipts = WriteBuffer('read-receipts', LastReadMessage.write_receipts)
+
 
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        db.Index('ix_messages_chat_created', 'chat_id', 'created_on'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text())
@@ -55,6 +243,14 @@ class Message(db.Model):
     def __repr__(self):
         return "<Message {}>".format(self.id)
 
+    def get_events(self):
+        '''A new message event for both sides of the chat.'''
+        # usually in the identity map, chat is not loaded on a pending row
+        chat = Chat.query.get(self.chat_id)
+        data = {'id': self.id, 'chatId': chat.id, 'authorId': self.author_id}
+        return [(user_id, 'message', data)
+                for user_id in (chat.user1_id, chat.user2_id)]
+
     @classmethod
     def find_by_id(cls, id):
         """
@@ -101,6 +297,31 @@ class Notification(db.Model):
     def __repr__(self):
         return "<Notification {}>".format(self.subject)
 
+    def get_events(self):
+        return [(self.user_id, 'notification', {
+            'id': self.id, 'subject': self.subject, 'itemId': self.item_id})]
+
+    @classmethod
+    def add_many(cls, subject, item_id, doer_id, user_ids, **kwargs):
+        '''
+        Insert the same notification for many users with one statement,
+        publishing their events.
+
+        :return: the number of notifications added
+        '''
+        table = cls.__table__
+        timestamp = datetime.utcnow()
+        rows = db.session.execute(insert(table).values([
+            dict(subject=subject, item_id=item_id, doer_id=doer_id,
+                 user_id=user_id, timestamp=timestamp, **kwargs)
+            for user_id in user_ids]).returning(
+                table.c.id, table.c.user_id)).fetchall()
+
+        events.publish_many([(user_id, 'notification', {
+            'id': id, 'subject': subject, 'itemId': item_id})
+            for id, user_id in rows])
+        return len(rows)
+
     @classmethod
     def find_by_id(cls, id):
         """
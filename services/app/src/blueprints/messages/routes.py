@@ -1,17 +1,19 @@
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError, ProgrammingError
-from flask import json, jsonify, request, url_for, Blueprint, current_app
+from flask import json, jsonify, request, url_for, Blueprint, current_app, \
+    Response
 from src.blueprints.messages.schema import NotificationSchema
 from src.blueprints.messages.models import Notification
 
 from src import db
 from src.lib import urlsafe_base64
-from src.lib.auth import authenticate
+from src.lib.auth import authenticate, authenticate_stream
+from src.lib.events import events, StreamLimitReached
 from src.blueprints.errors import error_response, bad_request, \
      server_error, not_found
 from src.blueprints.users.models import User
 from src.blueprints.profiles.models import Profile
-from src.blueprints.messages.models import Message, Chat, LastReadMessage
+from src.blueprints.messages.models import Message, Chat, read_receipts
 from src.blueprints.messages.schema import MessageSchema
 from src.blueprints.users.schema import UserSchema
 
@@ -33,29 +35,30 @@ def get_messages(user):
     messages = []
 
     try:
-        stmt, query = user.get_chat_last_messages()
-        if cursor == '0':
-            last_messages = query.limit(items_per_page + 1).all()
-        else:
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            last_messages = query.filter(
-                stmt.c.last_messages < cursor).limit(items_per_page + 1).all()
+        before = Chat.decode_cursor(cursor)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    try:
+        last_messages = user.get_chat_last_messages(
+            before, items_per_page + 1)
     except (IntegrityError, ValueError) as e:
         db.session.rollback()
         print(e)
         return server_error('Something went wrong, please try again.')
 
     if len(last_messages) > items_per_page:
-        nextCursor = urlsafe_base64(
-            last_messages[items_per_page - 1].last_messages.isoformat())
-
-    for msg, user1, user2, _ in last_messages[:items_per_page]:
-        author = user2 if user.id == user1.id else user1
-        last_read_msg = user.last_read_msg_ts(msg.chat_id)
-        message = MessageSchema(exclude=('author_id',)).dump(msg)
-        message['isRead'] = False if not last_read_msg else \
-            last_read_msg.timestamp >= msg.created_on
-        message['user'] = UserSchema(only=('id', 'profile',)).dump(author)
+        chat = last_messages[items_per_page - 1][2]
+        nextCursor = Chat.encode_cursor(chat.last_message_at, chat.id)
+
+    message_schema = MessageSchema(exclude=('author_id',))
+    user_schema = UserSchema(only=('id', 'profile',))
+
+    for msg, author, _, is_read, unread in last_messages[:items_per_page]:
+        message = message_schema.dump(msg)
+        message['isRead'] = is_read
+        message['unreadCount'] = unread
+        message['user'] = user_schema.dump(author)
         messages.append(message)
 
     return {
@@ -64,6 +67,13 @@ def get_messages(user):
     }
 
 
+@messages.route('/chats/unread/count', methods=['GET'])
+@authenticate
+def get_unread_count(user):
+    """Get the number of chats with unread messages"""
+    return {'count': user.unread_chats}
+
+
 @messages.route('/messages', methods=['GET'])
 @authenticate
 def get_chat_messages(user):
@@ -78,9 +88,13 @@ def get_chat_messages(user):
         return not_found('User not found.')
 
     try:
-        query = user.get_chat_messages(a_user)
         chat = user.get_chat(a_user)
 
+        if not chat:
+            return {'data': [], 'nextCursor': None}
+
+        query = user.get_chat_messages(chat)
+
         if cursor == '0':
             msgs = query.limit(items_per_page + 1).all()
         else:
@@ -92,29 +106,41 @@ def get_chat_messages(user):
             nextCursor = urlsafe_base64(
                 msgs[items_per_page - 1].created_on.isoformat())
 
-        # check if lrm exist
-        if chat:
-            lrm = LastReadMessage.find_by_pk(user.id, chat.id)
-
-            if lrm:
-                lrm.timestamp = datetime.utcnow()
-            else:
-                lrm = LastReadMessage()
-                lrm.user_id = user.id
-                lrm.chat_id = chat.id
-                lrm.timestamp = datetime.utcnow()
-            lrm.save()
+        # only the unread counters and the marker are written right away
+        if user.read_chat(chat.id):
+            db.session.commit()
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('Something went wrong, please try again.')
     else:
+        read_receipts.add((user.id, chat.id), datetime.utcnow())
         return {
             'data': MessageSchema(many=True).dump(msgs[:items_per_page]),
             'nextCursor': nextCursor
         }
 
 
+@messages.route('/chats/<int:chat_id>/messages', methods=['DELETE'])
+@authenticate
+def clear_chat(user, chat_id):
+    """Delete every message of a chat for the user only"""
+    chat = Chat.query.get(chat_id)
+
+    if not chat or user.id not in (chat.user1_id, chat.user2_id):
+        return not_found('Chat not found.')
+
+    try:
+        user.clear_chat(chat.id)
+        db.session.commit()
+    except (IntegrityError, ValueError) as e:
+        db.session.rollback()
+        print(e)
+        return server_error('Something went wrong, please try again.')
+    else:
+        return {'message': 'Successfully cleared for you.'}
+
+
 @messages.route('/messages', methods=['POST'])
 @authenticate
 def create_message(user):
@@ -130,12 +156,10 @@ def create_message(user):
         if not a_user:
             return not_found('User not found.')
 
-        chat = user.get_chat(a_user)
+        if a_user.id == user.id:
+            return bad_request('Cannot send a message to yourself.')
 
-        if not chat:
-            chat = Chat(user1_id=user.id, user2_id=a_user.id)
-            db.session.add(chat)
-            db.session.commit()
+        chat = Chat.get_or_create(user.id, a_user.id)
 
         message = Message()
         message.body = json.dumps(req_data.get('body'))
@@ -143,18 +167,11 @@ def create_message(user):
         message.created_on = datetime.utcnow()
         message.chat_id = chat.id
         db.session.add(message)
-
-        lrm = LastReadMessage.find_by_pk(user.id, chat.id)
-
-        if lrm:
-            lrm.timestamp = datetime.utcnow()
-        else:
-            lrm = LastReadMessage()
-            lrm.user_id = user.id
-            lrm.chat_id = chat.id
-            lrm.timestamp = message.created_on
-            db.session.add(lrm)
-
+        db.session.flush()
+        chat.set_last_message(message)
+        a_user.add_unread_message(chat.id)
+        # replying reads the chat
+        user.read_chat(chat.id)
         user.add_notification(
             subject='message', item_id=message.id, id=a_user.id)
         user.save()
@@ -163,6 +180,7 @@ def create_message(user):
         print(e)
         return server_error('Something went wrong, please try again.')
     else:
+        read_receipts.add((user.id, chat.id), message.created_on)
         response = jsonify(MessageSchema().dump(message))
         response.status_code = 201
         response.headers['Location'] = url_for(
@@ -187,15 +205,57 @@ def delete_message(user, msg_id):
         if user.id != message.author_id:
             return error_response(403, "Cannot delete another user's message.")
 
-        db.session.delete(
-            Notification.find_by_attr(subject='message', item_id=msg_id))
-        message.delete()
+        chat = message.chat
+        recipient = chat.user2 if chat.user1_id == user.id else chat.user1
+        recipient.remove_unread_message(message)
+        notif = Notification.find_by_attr(subject='message', item_id=msg_id)
+
+        if notif:
+            db.session.delete(notif)
+
+        db.session.delete(message)
+        db.session.flush()
+
+        if chat.last_message_id == msg_id:
+            chat.refresh_last_message()
+
+        db.session.commit()
         return {'message': 'Successfully deleted.'}
     except (IntegrityError, ValueError):
         db.session.rollback()
         return server_error('Something went wrong, please try again.')
 
 
+@messages.route('/events/token', methods=['POST'])
+@authenticate
+def get_events_token(user):
+    """
+    Get a token opening the event stream as its token query parameter,
+    valid for EVENT_TOKEN_SECONDS.
+    """
+    return {'token': user.encode_auth_token(
+        seconds=current_app.config['EVENT_TOKEN_SECONDS'], scope='events')}
+
+
+@messages.route('/events', methods=['GET'])
+@authenticate_stream
+def get_events(user):
+    """
+    Stream the message, notification and read events of the user as
+    server-sent events, instead of polling the routes above. Browsers
+    authenticate with a token from POST /events/token.
+    """
+    try:
+        stream = events.stream(user.id)
+    except StreamLimitReached as e:
+        return error_response(503, str(e))
+
+    # the request's session is released before the stream starts
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @messages.route('/notifications/count', methods=['GET'])
 @authenticate
 def get_notifications_count(user):
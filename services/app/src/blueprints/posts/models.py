@@ -1,8 +1,21 @@
-from sqlalchemy.sql import func
+import random
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import text, true, tuple_
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.sql import func, literal
 from src import db
+from src.lib import urlsafe_base64
+from src.lib.cache import TTLCache
+from src.lib.feed import feed
 from src.lib.mixins import ResourceMixin
 
 
+featured_pool = TTLCache(maxsize=1)
+# text search configuration of post bodies
+SEARCH_CONFIG = 'english'
+
 post_likes = db.Table(
     'post_likes',
     db.Column(
@@ -18,6 +31,8 @@ post_likes = db.Table(
         primary_key=True
     )
 )
+# the primary key only serves lookups by user, this one the likers of a post
+db.Index('ix_post_likes_post_id', post_likes.c.post_id, post_likes.c.user_id)
 
 
 post_tags = db.Table(
@@ -46,6 +61,15 @@ class Post(db.Model, ResourceMixin):
     user_id = db.Column(db.Integer, db.ForeignKey(
         'users.id', ondelete='CASCADE', onupdate='CASCADE'))
     comment_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    # denormalized counters, kept current by the routes that change them
+    like_count = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False)
+    comment_count = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False)
+    # generated by Postgres on write, only read by the search queries
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        f"to_tsvector('{SEARCH_CONFIG}', coalesce(body, ''))",
+        persisted=True)))
     # relationships
     comments = db.relationship(
         "Post", lazy='dynamic', backref=db.backref('parent', remote_side=[id]))
@@ -62,48 +86,430 @@ class Post(db.Model, ResourceMixin):
         return self.likes.filter(
             post_likes.c.user_id == user.id).count() > 0
 
+    def add_like(self, user):
+        db.session.execute(post_likes.insert().values(
+            user_id=user.id, post_id=self.id))
+        self.like_count = Post.like_count + 1
+
+    def remove_like(self, user):
+        db.session.execute(post_likes.delete().where(
+            (post_likes.c.user_id == user.id) &
+            (post_likes.c.post_id == self.id)))
+        self.like_count = Post.like_count - 1
+
+    def update_comment_count(self, value):
+        self.comment_count = Post.comment_count + value
+
+    @classmethod
+    def sample_ids(cls, count, tries=3):
+        '''
+        Pick about count random top-level post ids by probing random ids
+        between the smallest and largest one, which only touches the
+        primary key index whatever the size of the table.
+        '''
+        low, high = db.session.query(
+            func.min(cls.id), func.max(cls.id)).filter(
+                cls.comment_id.is_(None)).one()
+        ids = set()
+
+        if low is None:
+            return []
+
+        for _ in range(tries):
+            probes = {random.randint(low, high) for _ in range(count * 4)}
+            ids.update(id for id, in db.session.query(cls.id).filter(
+                cls.id.in_(probes), cls.comment_id.is_(None)))
+
+            if len(ids) >= count:
+                break
+
+        return random.sample(list(ids), min(count, len(ids)))
+
+    @classmethod
+    def get_featured(cls, count=5):
+        '''
+        Gets random top-level posts, with their authors, from a pool of
+        ids refreshed every FEATURED_POOL_TTL seconds. An empty pool is
+        not kept, so the first posts show up right away.
+        '''
+        pool = featured_pool.get('ids')
+
+        if pool is None:
+            pool = cls.sample_ids(current_app.config['FEATURED_POOL_SIZE'])
+
+            if pool:
+                featured_pool.set(
+                    'ids', pool, ttl=current_app.config['FEATURED_POOL_TTL'])
+
+        ids = random.sample(pool, min(count, len(pool)))
+
+        return cls.query.options(joinedload(cls.author)).filter(
+            cls.id.in_(ids)).all()
+
+    @classmethod
+    def get_merged_feed(cls, user, before=None, limit=20):
+        '''
+        Gets a page of a user's home feed from the in-memory feed engine.
+
+        Posts deleted since they were merged are left out, so a page can
+        be short without being the last one.
+
+        :return: (list of (post, created_on) tuples, created_on to read
+            the next page before or None on the last page), or None when
+            the engine cannot serve the page
+        '''
+        page = feed.merge(user.get_feed_sources(), before, limit)
+
+        if page is None:
+            return None
+
+        after = page[limit - 1][0] if len(page) > limit else None
+        page = page[:limit]
+        posts = {post.id: post for post in cls.query.filter(
+            cls.id.in_([post_id for _, post_id in page]))} if page else {}
+        return [(posts[post_id], created_on)
+                for created_on, post_id in page if post_id in posts], after
+
+    @classmethod
+    def reconcile_counters(cls, start, end):
+        '''
+        Recompute like_count and comment_count for posts with
+        start <= id < end, only rewriting the rows that drifted.
+
+        :return: number of posts that were fixed
+        '''
+        comments = aliased(cls)
+        nlikes = db.session.query(post_likes.c.post_id, func.count(
+            post_likes.c.user_id).label('num_likes')).filter(
+                post_likes.c.post_id >= start,
+                post_likes.c.post_id < end).group_by(
+                    post_likes.c.post_id).subquery()
+        ncomments = db.session.query(comments.comment_id, func.count(
+            comments.id).label('num_comments')).filter(
+                comments.comment_id >= start,
+                comments.comment_id < end).group_by(
+                    comments.comment_id).subquery()
+        counts = db.session.query(
+            cls.id.label('id'),
+            func.coalesce(nlikes.c.num_likes, 0).label('num_likes'),
+            func.coalesce(ncomments.c.num_comments, 0).label(
+                'num_comments')).outerjoin(
+                    nlikes, cls.id == nlikes.c.post_id).outerjoin(
+                        ncomments, cls.id == ncomments.c.comment_id).filter(
+                            cls.id >= start, cls.id < end).subquery()
+
+        return cls.query.filter(cls.id == counts.c.id).filter(
+            (cls.like_count != counts.c.num_likes) |
+            (cls.comment_count != counts.c.num_comments)).update({
+                cls.like_count: counts.c.num_likes,
+                cls.comment_count: counts.c.num_comments,
+                cls.updated_on: cls.updated_on,
+            }, synchronize_session=False)
+
     @classmethod
     def get_reactions(cls):
         '''Gets all posts and their reactions.'''
-        posts = cls.query.filter(cls.comment_id.is_(None)).subquery()
-        ncomments = db.session.query(posts.c.id, func.count(cls.id).label(
-            'num_comments')).outerjoin(
-                cls, posts.c.id == cls.comment_id).group_by(
-                    posts.c.id).subquery()
-        nlikes = db.session.query(cls.id, func.count(
-            post_likes.c.post_id).label('num_likes')).join(
-                post_likes, cls.id == post_likes.c.post_id).group_by(
-                    cls.id).subquery()
-        return db.session.query(ncomments.c.id, (
-            ncomments.c.num_comments + nlikes.c.num_likes).label(
-                'reactions')).outerjoin(nlikes, ncomments.c.id == nlikes.c.id)
+        return db.session.query(cls.id, (
+            cls.like_count + cls.comment_count).label('reactions')).filter(
+                cls.comment_id.is_(None))
 
     @classmethod
     def get_by_reactions(cls):
-        '''Gets all posts and ordered by their reactions.'''
-        posts = cls.get_reactions().subquery()
-        return db.session.query(Post.id, func.row_number().over(
-            order_by=posts.c.reactions).label('sequence')).join(
-                cls, posts.c.id == Post.id)
+        '''Gets all posts and their rank, ordered by their reactions.'''
+        return db.session.query(cls.id, func.row_number().over(
+            order_by=(cls.like_count + cls.comment_count, cls.id)).label(
+                'sequence')).filter(cls.comment_id.is_(None))
+
+    @classmethod
+    def search(cls, expression, top, after=None):
+        '''
+        Full-text search of post bodies, served by the GIN index.
+
+        Only the POST_SEARCH_CANDIDATES newest matches are ranked, which
+        bounds the ts_rank work and the vectors read. The bitmap scan of
+        the GIN index still visits every match before they are ordered
+        by id, so a common word costs more than a rare one, in proportion
+        to its matches. Posts newer than top are left out, which keeps
+        the candidates of a search the same while its pages are read.
+
+        :param expression: Search terms, in websearch_to_tsquery syntax
+        :param top: Id of the newest post to search
+        :param after: (rank, id) of the last post of the previous page
+        :return: query of (Post, rank), best ranked first
+        '''
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, expression)
+        candidates = db.session.query(
+            cls.id.label('id'), cls.search_vector.label('vector')).filter(
+                cls.search_vector.op('@@')(tsquery),
+                cls.id <= top).order_by(cls.id.desc()).limit(
+                    current_app.config['POST_SEARCH_CANDIDATES']).subquery()
+        # ts_rank is a real, compare it as a double so cursors round-trip
+        ranked = db.session.query(candidates.c.id, db.cast(func.ts_rank(
+            candidates.c.vector, tsquery), db.Float).label('rank')).subquery()
+        query = db.session.query(cls, ranked.c.rank).join(
+            ranked, ranked.c.id == cls.id)
+
+        if after is not None:
+            query = query.filter(
+                tuple_(ranked.c.rank, ranked.c.id) < tuple_(*after))
+
+        return query.order_by(ranked.c.rank.desc(), ranked.c.id.desc())
+
+    @staticmethod
+    def encode_search_cursor(top, rank, id):
+        return urlsafe_base64(f'{top}:{rank!r}:{id}')
+
+    @staticmethod
+    def decode_search_cursor(cursor):
+        '''
+        :return: (top, (rank, id)) tuple, (None, None) for the first page
+        '''
+        if cursor == '0':
+            return None, None
+
+        top, rank, id = urlsafe_base64(cursor, from_base64=True).split(':')
+        return int(top), (float(rank), int(id))
 
     def to_dict(self, auth):
-        return {
-            'id': self.id,
-            'body': self.body,
-            'likes': self.likes.count(),
-            'comments': self.comments.count(),
-            'isLiked': self.is_liked_by(auth),
-            'created_on': self.created_on,
-            'author': {
-                'id': self.author.id,
-                'username': self.author.profile.username,
-                'name': self.author.profile.name,
-                'avatar': self.author.profile.avatar,
-                'isFollowing': auth.is_following(self.author)
-                if auth.id != self.author.id else None,
-            },
-            'tags': [{
-                'id': tag.id,
-                'name': tag.name,
-            } for tag in self.tags],
-        }
+        return Post.bulk_to_dict([self], auth)[0]
+
+    @classmethod
+    def bulk_to_dict(cls, posts, auth, with_parent=False):
+        '''
+        Serialize a list of posts as seen by auth.
+
+        Every field is filled with a fixed number of set-based queries,
+        so the cost does not grow with the number of posts.
+
+        :param posts: list of Post instances
+        :param auth: the user viewing the posts
+        :param with_parent: also include the parent of comments
+        :return: list of dicts, in the same order as posts
+        '''
+        from src.blueprints.users.models import User, followers
+        from src.blueprints.tags.models import Tag
+        from src.blueprints.posts.schema import PostSchema
+
+        if not posts:
+            return []
+
+        ids = [post.id for post in posts]
+        author_ids = {post.user_id for post in posts}
+
+        liked = {row.post_id for row in db.session.query(
+            post_likes.c.post_id).filter(
+                post_likes.c.user_id == auth.id,
+                post_likes.c.post_id.in_(ids))}
+        following = {row.followed_id for row in db.session.query(
+            followers.c.followed_id).filter(
+                followers.c.follower_id == auth.id,
+                followers.c.followed_id.in_(author_ids))}
+        authors = {user.id: user for user in User.query.filter(
+            User.id.in_(author_ids))}
+
+        tags = {}
+        for post_id, tag_id, name in db.session.query(
+                post_tags.c.post_id, Tag.id, Tag.name).join(
+                    Tag, Tag.id == post_tags.c.tag_id).filter(
+                        post_tags.c.post_id.in_(ids)).order_by(Tag.id):
+            tags.setdefault(post_id, []).append({'id': tag_id, 'name': name})
+
+        parents = {}
+        if with_parent:
+            parent_ids = {post.comment_id for post in posts if post.comment_id}
+            if parent_ids:
+                parents = {parent.id: parent for parent in cls.query.filter(
+                    cls.id.in_(parent_ids))}
+                missing = {p.user_id for p in parents.values()} - set(authors)
+                authors.update({user.id: user for user in User.query.filter(
+                    User.id.in_(missing))})
+
+        result = []
+        for post in posts:
+            author = authors[post.user_id]
+            post_dict = {
+                'id': post.id,
+                'body': post.body,
+                'likes': post.like_count,
+                'comments': post.comment_count,
+                'isLiked': post.id in liked,
+                'created_on': post.created_on,
+                'author': {
+                    'id': author.id,
+                    'username': author.profile.username,
+                    'name': author.profile.name,
+                    'avatar': author.profile.avatar,
+                    'isFollowing': author.id in following
+                    if auth.id != author.id else None,
+                },
+                'tags': tags.get(post.id, []),
+            }
+
+            if post.comment_id in parents:
+                post_dict['parent'] = PostSchema(
+                    only=('id', 'body', 'author',)).dump(
+                        parents[post.comment_id])
+            result.append(post_dict)
+
+        return result
+
+
+@feed.loader('user')
+def get_recent_posts_by_authors(ids, limit):
+    '''Gets the newest top-level posts of many authors.'''
+    from src.blueprints.users.models import User
+
+    recent = db.session.query(Post.id, Post.created_on).filter(
+        Post.user_id == User.id, Post.comment_id.is_(None)).order_by(
+            Post.created_on.desc()).limit(limit).subquery().lateral()
+    query = db.session.query(User.id, recent.c.id, recent.c.created_on).join(
+        recent, true()).filter(User.id.in_(ids)).order_by(
+            User.id, recent.c.created_on.desc())
+
+    posts = {}
+    for user_id, post_id, created_on in query:
+        posts.setdefault(user_id, []).append((created_on, post_id))
+    return posts
+
+
+@feed.loader('tag')
+def get_recent_posts_by_tags(ids, limit):
+    '''Gets the newest top-level posts in many tags.'''
+    from src.blueprints.tags.models import Tag
+
+    recent = db.session.query(Post.id, Post.created_on).join(
+        post_tags, Post.id == post_tags.c.post_id).filter(
+            post_tags.c.tag_id == Tag.id, Post.comment_id.is_(None)).order_by(
+                Post.created_on.desc()).limit(limit).subquery().lateral()
+    query = db.session.query(Tag.id, recent.c.id, recent.c.created_on).join(
+        recent, true()).filter(Tag.id.in_(ids)).order_by(
+            Tag.id, recent.c.created_on.desc())
+
+    posts = {}
+    for tag_id, post_id, created_on in query:
+        posts.setdefault(tag_id, []).append((created_on, post_id))
+    return posts
+
+
+db.Index('ix_posts_user_created', Post.user_id, Post.created_on)
+db.Index('ix_posts_search_vector', Post.search_vector, postgresql_using='gin')
+db.Index(
+    'ix_posts_reactions', Post.like_count + Post.comment_count, Post.id,
+    postgresql_where=Post.comment_id.is_(None))
+
+
+class RankingEpoch(db.Model):
+    __tablename__ = 'ranking_epochs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_on = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<RankingEpoch {self.id}>'
+
+
+class PostRanking(db.Model):
+    '''
+    A snapshot of every top-level post ranked by its reactions.
+
+    Each rebuild writes a new epoch, so a "top" feed page is a range scan
+    on (epoch, rank) and a cursor keeps pointing into the snapshot it was
+    issued from while the user scrolls. The table is partitioned by
+    epoch, every snapshot is a partition of its own that is dropped
+    whole once it is stale, rather than deleted row by row.
+    '''
+    __tablename__ = 'post_rankings'
+    __table_args__ = (
+        db.Index('ix_post_rankings_epoch_post', 'epoch', 'post_id'),
+        {'postgresql_partition_by': 'LIST (epoch)'},
+    )
+
+    # no foreign keys: readers go through get_epoch and join back to
+    # posts, which leaves deleted posts out
+    epoch = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<PostRanking {self.epoch}:{self.rank}>'
+
+    @classmethod
+    def _partition(cls, epoch):
+        return f'{cls.__tablename__}_{int(epoch)}'
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Write a new snapshot into a partition of its own in a single
+        INSERT ... SELECT, then drop the partitions of all but the newest
+        RANKING_EPOCHS_KEPT epochs.
+
+        :return: the new epoch id
+        '''
+        epoch = RankingEpoch()
+        db.session.add(epoch)
+        db.session.flush()
+
+        # snapshots can always be rebuilt, so skip the WAL
+        db.session.execute(text(
+            f'CREATE UNLOGGED TABLE {cls._partition(epoch.id)} '
+            f'PARTITION OF {cls.__tablename__} FOR VALUES IN ({epoch.id})'))
+        ranks = Post.get_by_reactions().subquery()
+        db.session.execute(cls.__table__.insert().from_select(
+            ['epoch', 'rank', 'post_id'], db.session.query(
+                literal(epoch.id), ranks.c.sequence, ranks.c.id)))
+
+        stale = [id for id, in db.session.query(RankingEpoch.id).order_by(
+            RankingEpoch.id.desc()).offset(
+                current_app.config['RANKING_EPOCHS_KEPT'])]
+
+        for id in stale:
+            db.session.execute(text(
+                f'DROP TABLE IF EXISTS {cls._partition(id)}'))
+
+        RankingEpoch.query.filter(RankingEpoch.id.in_(stale)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+        return epoch.id
+
+    @classmethod
+    def get_epoch(cls, epoch=None):
+        '''
+        Get the snapshot a page should be read from: the requested epoch
+        if it still exists, otherwise the newest one. None until the
+        rank_posts command has built one, which reads as an empty feed.
+        '''
+        query = db.session.query(RankingEpoch.id)
+
+        if epoch is not None and query.filter(
+                RankingEpoch.id == epoch).scalar() is not None:
+            return epoch
+
+        return query.order_by(RankingEpoch.id.desc()).limit(1).scalar()
+
+    @classmethod
+    def get_posts(cls, epoch, rank=None):
+        '''Gets the posts in a snapshot, best ranked first.'''
+        query = db.session.query(Post, cls.rank).join(
+            cls, cls.post_id == Post.id).filter(cls.epoch == epoch)
+
+        if rank is not None:
+            query = query.filter(cls.rank < rank)
+
+        return query.order_by(cls.rank.desc())
+
+    @staticmethod
+    def encode_cursor(epoch, rank):
+        return urlsafe_base64(f'{epoch}.{rank}')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''
+        :return: (epoch, rank) tuple, (None, None) for the first page
+        '''
+        if cursor == '0':
+            return None, None
+
+        epoch, rank = urlsafe_base64(cursor, from_base64=True).split('.')
+        return int(epoch), int(rank)
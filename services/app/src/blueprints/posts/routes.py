@@ -1,15 +1,17 @@
-import random
+from datetime import datetime
 from sqlalchemy import exc
-from sqlalchemy.sql import func
 from flask import url_for, request, jsonify, Blueprint, current_app
 
 from src import db
 from src.lib import urlsafe_base64
 from src.lib.auth import authenticate
+from src.lib.feed import feed
 from src.blueprints.errors import server_error, bad_request, \
     not_found, error_response
 from src.blueprints.messages.models import Notification
-from src.blueprints.posts.models import Post
+from src.blueprints.users.models import Timeline, FanOutProgress, \
+    fan_out
+from src.blueprints.posts.models import Post, PostRanking
 from src.blueprints.posts.schema import PostSchema
 
 
@@ -21,11 +23,20 @@ def ping():
     return {'message': 'Post Route!'}
 
 
+@posts.route('/stats', methods=['GET'])
+@authenticate
+def get_stats(user):
+    """Get the progress and lag of the post fan-out of this process."""
+    if not user.is_admin:
+        return error_response(403, 'Not allowed!')
+
+    return {'fanOut': fan_out.stats()}
+
+
 @posts.route('/featured', methods=['GET'])
 def get_featured_posts():
     try:
-        res = Post.query.filter(Post.comment_id.is_(None)).all()
-        posts = random.sample(res, k=5)
+        posts = Post.get_featured(5)
     except Exception:
         return server_error('Something went wrong, please try again.')
 
@@ -33,6 +44,44 @@ def get_featured_posts():
         many=True, only=('id', 'body', 'author.profile')).dump(posts))
 
 
+@posts.route('/search', methods=['GET'])
+@authenticate
+def search_posts(user):
+    q = request.args.get('q', '', str).strip()
+    cursor = request.args.get('cursor', '0')
+    items_per_page = current_app.config['ITEMS_PER_PAGE']
+    nextCursor = None
+
+    if not q:
+        return {'data': [], 'nextCursor': None}
+
+    try:
+        top, after = Post.decode_search_cursor(cursor)
+    except ValueError:
+        return bad_request('Invalid cursor.')
+
+    try:
+        if top is None:
+            top = db.session.query(db.func.max(Post.id)).scalar() or 0
+
+        query = Post.search(q, top, after).limit(items_per_page + 1).all()
+    except Exception as e:
+        db.session.rollback()
+        print(e)
+        return server_error('An unexpected error occured, please try again.')
+
+    if len(query) > items_per_page:
+        post, rank = query[items_per_page - 1]
+        nextCursor = Post.encode_search_cursor(top, rank, post.id)
+
+    return {
+        'data': Post.bulk_to_dict(
+            [post for post, _ in query[:items_per_page]], user,
+            with_parent=True),
+        'nextCursor': nextCursor,
+    }
+
+
 @posts.route('/<int:post_id>', methods=['GET'])
 @authenticate
 def get_post(user, post_id):
@@ -44,13 +93,7 @@ def get_post(user, post_id):
     except Exception:
         return server_error('Something went wrong, please try again.')
     else:
-        post_dict = post.to_dict(user)
-        post_dict['isLiked'] = post.is_liked_by(user)
-
-        if user.id != post.author.id:
-            post_dict['author']['isFollowing'] = user.is_following(post.author)
-
-        return jsonify(post_dict)
+        return jsonify(post.to_dict(user))
 
 
 @posts.route('/explore', methods=['GET'])
@@ -63,43 +106,37 @@ def get_posts(user):
     query = ''
 
     try:
-        sorted_posts = Post.get_by_reactions().subquery()
-        top_posts = db.session.query(Post, sorted_posts.c.sequence).join(
-            sorted_posts, sorted_posts.c.id == Post.id).order_by(
-                sorted_posts.c.sequence.desc())
-        latest_posts = Post.query.filter(
-            Post.comment_id.is_(None)).order_by(Post.created_on.desc())
+        if feed == 'latest':
+            latest_posts = Post.query.filter(
+                Post.comment_id.is_(None)).order_by(Post.created_on.desc())
+        else:
+            epoch, rank = PostRanking.decode_cursor(cursor)
+            epoch = PostRanking.get_epoch(epoch)
+            top_posts = PostRanking.get_posts(epoch, rank)
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('An unexpected error occured, please try again.')
 
-    if cursor == '0' and feed == 'latest':
+    if feed == 'latest':
+        if cursor != '0':
+            cursor = urlsafe_base64(cursor, from_base64=True)
+            latest_posts = latest_posts.filter(Post.created_on < cursor)
         query = latest_posts.limit(items_per_page + 1).all()
-    elif cursor == '0' and feed == 'top':
-        query = top_posts.limit(items_per_page + 1).all()
     else:
-        if feed == 'latest':
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            query = latest_posts.filter(
-                Post.created_on < cursor).limit(items_per_page + 1).all()
-        else:
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            query = top_posts.filter(sorted_posts.c.sequence < cursor).limit(
-                items_per_page + 1).all()
+        query = top_posts.limit(items_per_page + 1).all()
 
     if len(query) > items_per_page:
         nextCursor = urlsafe_base64(
             query[items_per_page - 1].created_on.isoformat()) \
-                if feed == 'latest' else urlsafe_base64(
-            str(query[items_per_page - 1][1]))
+                if feed == 'latest' else PostRanking.encode_cursor(
+            epoch, query[items_per_page - 1][1])
 
-    posts = [post.to_dict(user) for post in query[:items_per_page]] \
-        if feed == 'latest' else \
-            [post[0].to_dict(user) for post in query[:items_per_page]]
+    posts = query[:items_per_page] if feed == 'latest' else \
+        [post[0] for post in query[:items_per_page]]
 
     return {
-        'data': posts,
+        'data': Post.bulk_to_dict(posts, user),
         'nextCursor': nextCursor
     }
 
@@ -108,57 +145,51 @@ def get_posts(user):
 @authenticate
 def posts_feed(user):
     latest = request.args.get('latest')
-    top = request.args.get('top')
     cursor = request.args.get('cursor')
     items_per_page = current_app.config['ITEMS_PER_PAGE']
     nextCursor = None
     query = ''
 
     try:
-        followed_posts = user.get_followed_posts().subquery()
-        posts_reactions = Post.get_reactions().subquery()
-        top_followed_posts = db.session.query(
-            followed_posts, func.row_number().over(
-                order_by=posts_reactions.c.reactions).label(
-                    'sequence')).outerjoin(posts_reactions,
-                        followed_posts.c.posts_id ==
-                            posts_reactions.c.id).subquery()
-
-        top_posts = db.session.query(Post, top_followed_posts.c.sequence).join(
-            Post, top_followed_posts.c.posts_id == Post.id).order_by(
-                top_followed_posts.c.sequence.desc())
-
-        latest_posts = db.session.query(Post, followed_posts.c.posts_id).join(
-            Post, Post.id == followed_posts.c.posts_id).order_by(
-                Post.created_on.desc())
+        if latest:
+            latest_posts = Timeline.get_posts(user.id)
+        else:
+            epoch, rank = PostRanking.decode_cursor(cursor)
+            epoch = PostRanking.get_epoch(epoch)
+            top_posts = Timeline.get_top_posts(user.id, epoch, rank)
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('An unexpected error occured, please try again.')
 
-    if cursor == '0' and latest:
-        query = latest_posts.limit(items_per_page + 1).all()
-    elif cursor == '0' and top:
-        query = top_posts.limit(items_per_page + 1).all()
-    else:
-        if latest:
+    if latest:
+        if cursor != '0':
             cursor = urlsafe_base64(cursor, from_base64=True)
-            query = latest_posts.filter(
-                Post.created_on < cursor).limit(items_per_page + 1).all()
+            latest_posts = latest_posts.filter(Timeline.created_on < cursor)
+
+        merged = Post.get_merged_feed(
+            user, None if cursor == '0' else datetime.fromisoformat(cursor),
+            items_per_page)
+
+        if merged is None:
+            query = latest_posts.limit(items_per_page + 1).all()
         else:
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            query = top_posts.filter(
-                top_followed_posts.c.sequence < cursor).limit(
-                    items_per_page + 1).all()
+            query, after = merged
+    else:
+        query = top_posts.limit(items_per_page + 1).all()
 
-    if len(query) > items_per_page:
+    if latest and merged is not None:
+        # pages lose deleted posts, only the merge knows where it stopped
+        nextCursor = urlsafe_base64(after.isoformat()) if after else None
+    elif len(query) > items_per_page:
         nextCursor = urlsafe_base64(
             query[items_per_page - 1][0].created_on.isoformat()) \
-                if latest else urlsafe_base64(
-            str(query[items_per_page - 1][1]))
+                if latest else PostRanking.encode_cursor(
+            epoch, query[items_per_page - 1][1])
 
     return {
-        'data': [post[0].to_dict(user) for post in query[:items_per_page]],
+        'data': Post.bulk_to_dict(
+            [post[0] for post in query[:items_per_page]], user),
         'nextCursor': nextCursor
     }
 
@@ -176,25 +207,37 @@ def create_post(user, post_id=None):
     post.body = req_data.get('post')
     post.user_id = user.id
     db.session.add(post)
+    # the activity of the author ranks them in search
+    user.reindex()
 
     if post_id:
         post.comment_id = post_id
         parent = Post.find_by_id(post_id)
-        db.session.add(user.add_notification(subject='comment',
-            item_id=post.id, id=parent.author.id, post_id=parent.id))
-    else:
-        post_notifs = []
-        for u in user.followers.all():
-            post_notifs.append(user.add_notification(
-                subject='post', item_id=post.id, id=u.id, post_id=post.id))
-        db.session.add_all(post_notifs)
+        parent.update_comment_count(1)
 
     try:
+        # the notification needs the id of the post
+        db.session.flush()
+
+        if post_id:
+            user.add_notification(subject='comment', item_id=post.id,
+                                  id=parent.author.id, post_id=parent.id)
+        else:
+            # followers get it from fan_out once it is committed, its
+            # progress is saved from the start so a lost one is redone
+            Timeline.push([user.id], post)
+            db.session.add(FanOutProgress(post_id=post.id))
         post.save()
     except (exc.IntegrityError, ValueError):
         db.session.rollback()
         return server_error('Something went wrong, please try again.')
     else:
+        if not post_id:
+            fan_out.submit(post.id)
+            feed.push(('user', user.id), post.created_on, post.id)
+            for tag in post.tags:
+                feed.push(('tag', tag.id), post.created_on, post.id)
+
         response = jsonify(post.to_dict(user))
         response.status_code = 201
         response.headers['Location'] = url_for(
@@ -220,6 +263,9 @@ def delete_post(user, post_id):
     [db.session.delete(notif) for notif in post_notif] if post_notif \
         else db.session.delete(comment_notif)
 
+    if post.parent:
+        post.parent.update_comment_count(-1)
+
     try:
         post.delete()
     except (exc.IntegrityError, ValueError):
@@ -239,11 +285,11 @@ def update_like(user, post_id):
 
     try:
         if post.is_liked_by(user):
-            post.likes.remove(user)
+            post.remove_like(user)
             db.session.delete(
                 Notification.find_by_attr(subject='like', item_id=post.id))
         else:
-            post.likes.append(user)
+            post.add_like(user)
             db.session.add(user.add_notification(
                 'like', item_id=post.id, id=post.author.id, post_id=post.id))
 
@@ -281,14 +327,8 @@ def get_post_comments(user, post_id):
         nextCursor = urlsafe_base64(
             query[items_per_page - 1].created_on.isoformat())
 
-    comments = []
-    for c in query[:items_per_page]:
-        comment = c.to_dict(user)
-        comment['parent'] = PostSchema(
-            only=('id', 'body', 'author',)).dump(c.parent)
-        comments.append(comment)
-
     return {
-        'data': comments,
+        'data': Post.bulk_to_dict(
+            query[:items_per_page], user, with_parent=True),
         'nextCursor': nextCursor
     }
@@ -3,6 +3,7 @@ from hashlib import md5
 
 from src import db
 from src.lib.mixins import ResourceMixin
+from src.lib.search import UsersIndex
 
 
 class Profile(db.Model, ResourceMixin):
@@ -25,6 +26,10 @@ class Profile(db.Model, ResourceMixin):
     def __repr__(self):
         return f'<Profile: {self.name}>'
 
+    def get_search_keys(self):
+        '''A profile is searched as part of its user's document.'''
+        return [(UsersIndex, self.user_id)]
+
     @staticmethod
     def set_avatar(email, size=128):
         digest = md5(email.lower().encode('utf-8')).hexdigest()
@@ -1,9 +1,13 @@
+import json
+
 from flask import Blueprint, request
 
 from src import db
+from src.lib import urlsafe_base64
 from src.lib.auth import authenticate
-from src.lib.search import TagsIndex, UsersIndex
-from src.blueprints.errors import server_error
+from src.lib.mixins import search_documents
+from src.lib.search import TagsIndex, UsersIndex, query_cache
+from src.blueprints.errors import bad_request, error_response, server_error
 from src.blueprints.users.models import User
 from src.blueprints.tags.models import Tag
 from src.blueprints.users.schema import UserSchema
@@ -17,50 +21,141 @@ def ping():
     return {'message': 'Search Route!'}
 
 
+def user_results(hits):
+    """Serialize users found by search_documents like UserSchema does."""
+    return [{
+        'id': id,
+        'profile': {
+            'username': doc['username'],
+            'name': doc['name'],
+            'avatar': doc.get('avatar'),
+        },
+    } for id, doc in hits]
+
+
+def encode_cursor(after):
+    '''
+    :param after: dict of result name to the search cursor of its next
+        page
+    :return: str cursor, None when there is no next page
+    '''
+    after = {name: list(cursor) for name, cursor in after.items()
+             if cursor is not None}
+    return urlsafe_base64(json.dumps(after)) if after else None
+
+
+def decode_cursor(cursor):
+    '''
+    :return: dict of result name to search cursor, None for the first
+        page
+    :raises ValueError: when the cursor is not one of ours
+    '''
+    if cursor in (None, '0'):
+        return None
+
+    after = json.loads(urlsafe_base64(cursor, from_base64=True))
+
+    if not isinstance(after, dict) or not all(
+            isinstance(value, list) for value in after.values()):
+        raise ValueError(cursor)
+    return after
+
+
+@search.route('/stats', methods=['GET'])
+@authenticate
+def get_stats(user):
+    """Get the hit rate of the search cache of this process."""
+    if not user.is_admin:
+        return error_response(403, 'Not allowed!')
+
+    return {'cache': query_cache.stats()}
+
+
 @search.route('', methods=['GET'])
 @authenticate
 def mainSearch(user):
-    q = request.args.get('q', str, None)
+    q = request.args.get('q', None, str)
+    hydrate = request.args.get('hydrate', 0, int)
+    nextCursor = None
+
+    if q is None:
+        return {'results': {'tags': [], 'users': []}, 'nextCursor': None}
 
     try:
-        if q is None:
-            return {[]}
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError:
+        return bad_request('Invalid cursor.')
 
-        tags = Tag.search(TagsIndex, q)
-        users = User.search(UsersIndex, q)
+    try:
+        if hydrate:
+            partial = False
+            tags = [tag.to_dict(user) for tag in Tag.search(TagsIndex, q)]
+            users = UserSchema(
+                many=True,
+                only=(
+                    'id', 'profile.username', 'profile.name', 'profile.avatar')
+            ).dump(User.search(UsersIndex, q))
+        else:
+            # later pages only search the results that have more
+            models = {'tags': Tag, 'users': User}
+            names = list(models if after is None else after.keys() & models)
+            pages = dict(zip(names, search_documents(
+                [models[name] for name in names], q,
+                None if after is None else [after[name] for name in names])))
+            # an index that did not answer in time is left out
+            partial = any(page is None for page in pages.values())
+            tags, tags_after = pages.get('tags') or ([], None)
+            users, users_after = pages.get('users') or ([], None)
+            tags = Tag.search_results_to_dict(tags, user)
+            users = user_results(users)
+            nextCursor = encode_cursor(
+                {'tags': tags_after, 'users': users_after})
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('An unexpected error occured, please try again.')
     return {
         'results': {
-            'tags': [tag.to_dict(user) for tag in tags],
-            'users': UserSchema(
-                many=True,
-                only=(
-                    'id', 'profile.username', 'profile.name', 'profile.avatar')
-            ).dump(users),
-        }
+            'tags': tags,
+            'users': users,
+        },
+        'partial': partial,
+        'nextCursor': nextCursor,
     }
 
 
 @search.route('/users', methods=['GET'])
 @authenticate
 def msg_Search(user):
-    q = request.args.get('q', str, None)
+    q = request.args.get('q', None, str)
+    hydrate = request.args.get('hydrate', 0, int)
+    nextCursor = None
+
+    if q is None:
+        return {'users': [], 'nextCursor': None}
 
     try:
-        if q is None:
-            return {[]}
+        after = decode_cursor(request.args.get('cursor')) or {}
+    except ValueError:
+        return bad_request('Invalid cursor.')
 
-        users = User.search(UsersIndex, q)
+    try:
+        if hydrate:
+            users = UserSchema(
+                many=True,
+                only=(
+                    'id', 'profile.username', 'profile.name', 'profile.avatar')
+            ).dump(User.search(UsersIndex, q))
+        else:
+            users, users_after = User.search_documents(
+                UsersIndex, q, after.get('users'))
+            users = user_results(users)
+            nextCursor = encode_cursor({'users': users_after})
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('An unexpected error occured, please try again.')
     return {
-        'users': UserSchema(
-            many=True,
-            only=('id', 'auth.username', 'profile.name', 'profile.avatar')
-        ).dump(users),
+        'users': users,
+        'nextCursor': nextCursor,
     }
@@ -1,13 +1,15 @@
-import random
 from sqlalchemy.sql import func
 from src import db
 from src.lib.mixins import ResourceMixin, SearchableMixin
+from src.lib.search import TagsIndex
 from src.blueprints.posts.models import post_tags
 from src.blueprints.users.schema import UserSchema
 
 
 class Tag(db.Model, ResourceMixin, SearchableMixin):
     __tablename__ = 'tags'
+    __search_index__ = TagsIndex
+    __searchable__ = ('name',)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), nullable=False, index=True, unique=True)
@@ -15,6 +17,14 @@ class Tag(db.Model, ResourceMixin, SearchableMixin):
     def __repr__(self):
         return f'<Tag {self.name}>'
 
+    @classmethod
+    def get_search_signals(cls, ids):
+        counts = dict(db.session.query(
+            post_tags.c.tag_id, func.count()).filter(
+                post_tags.c.tag_id.in_(ids)).group_by(post_tags.c.tag_id))
+
+        return {id: {'posts': counts.get(id, 0)} for id in ids}
+
     @classmethod
     def get_top_tags(cls, user):
         tags = cls.query.except_(user.tags).subquery()
@@ -23,22 +33,42 @@ class Tag(db.Model, ResourceMixin, SearchableMixin):
                 post_tags, tags.c.tags_id == post_tags.c.tag_id).group_by(
                     tags.c.tags_id)
 
-    def to_dict(self, user):
-        followers = []
-        count = 0
+    @staticmethod
+    def search_results_to_dict(hits, user):
+        '''
+        Serialize tags found by search_documents, with one query for the
+        ones user follows.
 
-        if len(self.users) == 1 or len(self.users) == 2:
-            followers = UserSchema(
-                many=True, only=('id', 'profile',)).dump(user)
+        :param hits: list of (id, document) pairs
+        '''
+        from src.blueprints.users.models import user_tags
+
+        followed = {id for id, in db.session.query(user_tags.c.tag_id).filter(
+            user_tags.c.user_id == user.id,
+            user_tags.c.tag_id.in_([id for id, _ in hits]))} if hits else ()
+
+        return [{
+            'id': id,
+            'name': doc['name'],
+            'isFollowing': id in followed,
+        } for id, doc in hits]
+
+    def to_dict(self, user):
+        from src.blueprints.users.models import User, user_tags
 
-        if len(self.users) > 2:
-            followers = UserSchema(many=True, only=('id', 'profile',)).dump(
-                random.sample(self.users, k=2))
-            count = len(self.users) - 2
+        followers = User.query.join(
+            user_tags, user_tags.c.user_id == User.id).filter(
+                user_tags.c.tag_id == self.id).limit(2).all()
+        count = db.session.query(func.count(user_tags.c.user_id)).filter(
+            user_tags.c.tag_id == self.id).scalar()
 
         return {
             'id': self.id,
             'name': self.name,
             'isFollowing': user.is_following_tag(self),
-            'followedBy': {'users': followers, 'count': count}
+            'followedBy': {
+                'users': UserSchema(
+                    many=True, only=('id', 'profile',)).dump(followers),
+                'count': count - len(followers),
+            }
         }
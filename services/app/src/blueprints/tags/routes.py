@@ -7,8 +7,9 @@ from src.lib import urlsafe_base64
 from src.lib.auth import authenticate
 from src.blueprints.errors import server_error, error_response, \
     bad_request, not_found
-from src.blueprints.posts.models import Post
+from src.blueprints.posts.models import Post, PostRanking, post_tags
 from src.blueprints.tags.models import Tag
+from src.blueprints.users.models import Timeline
 from src.blueprints.tags.schema import TagSchema
 
 
@@ -113,8 +114,13 @@ def follow_tag(user, tag_id):
         return bad_request(f'No tag with id "{tag_id}" exists')
 
     try:
-        user.unfollow_tag(tag) \
-            if user.is_following_tag(tag) else user.follow_tag(tag)
+        if user.is_following_tag(tag):
+            user.unfollow_tag(tag)
+            db.session.flush()
+            Timeline.remove_posts(user.id, Post.query.with_parent(tag))
+        else:
+            user.follow_tag(tag)
+            Timeline.add_posts(user.id, Post.query.with_parent(tag))
         user.save()
     except (exc.IntegrityError, ValueError):
         db.session.rollback()
@@ -142,7 +148,6 @@ def get_tag(user):
 @tags.route('/<tag_name>', methods=['GET'])
 @authenticate
 def get_tag_posts(user, tag_name):
-    top = request.args.get('top', default=False)
     latest = request.args.get('latest', default=False)
     cursor = request.args.get('cursor')
     items_per_page = current_app.config['ITEMS_PER_PAGE']
@@ -156,47 +161,42 @@ def get_tag_posts(user, tag_name):
         print(e)
         return server_error('An unexpected error occured.')
 
+    if not tag:
+        return not_found(f'Tag with name "{tag_name}" does not exist.')
+
     try:
-        sorted_posts = Post.get_by_reactions().subquery()
-        tag_posts = Post.query.with_parent(tag).subquery()
-        sort_top_posts = db.session.query(
-            tag_posts, sorted_posts.c.sequence).join(
-                sorted_posts, sorted_posts.c.id == tag_posts.c.id).subquery()
-        top_posts = db.session.query(Post, sort_top_posts.c.sequence).join(
-            sort_top_posts, Post.id == sort_top_posts.c.id).order_by(
-                sort_top_posts.c.sequence.desc())
-        latest_posts = Post.query.with_parent(tag).order_by(
-            Post.created_on.desc())
+        if latest:
+            latest_posts = Post.query.with_parent(tag).order_by(
+                Post.created_on.desc())
+        else:
+            epoch, rank = PostRanking.decode_cursor(cursor)
+            epoch = PostRanking.get_epoch(epoch)
+            top_posts = PostRanking.get_posts(epoch, rank).join(
+                post_tags, post_tags.c.post_id == Post.id).filter(
+                    post_tags.c.tag_id == tag.id)
     except Exception as e:
         db.session.rollback()
         print(e)
         return server_error('An unexpected error occured, please try again.')
 
-    if cursor == '0' and latest:
+    if latest:
+        if cursor != '0':
+            cursor = urlsafe_base64(cursor, from_base64=True)
+            latest_posts = latest_posts.filter(Post.created_on < cursor)
         query = latest_posts.limit(items_per_page + 1).all()
-    elif cursor == '0' and top:
-        query = top_posts.limit(items_per_page + 1).all()
     else:
-        if latest:
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            query = latest_posts.filter(
-                Post.created_on < cursor).limit(items_per_page + 1).all()
-        else:
-            cursor = urlsafe_base64(cursor, from_base64=True)
-            query = top_posts.filter(sort_top_posts.c.sequence < cursor).limit(
-                items_per_page + 1).all()
+        query = top_posts.limit(items_per_page + 1).all()
 
     if len(query) > items_per_page:
         nextCursor = urlsafe_base64(
             query[items_per_page - 1].created_on.isoformat()) \
-                if latest else urlsafe_base64(
-            str(query[items_per_page - 1][1]))
+                if latest else PostRanking.encode_cursor(
+            epoch, query[items_per_page - 1][1])
 
-    posts = [post.to_dict(user) for post in query[:items_per_page]] \
-        if latest else \
-            [post[0].to_dict(user) for post in query[:items_per_page]]
+    posts = query[:items_per_page] if latest else \
+        [post[0] for post in query[:items_per_page]]
 
     return {
-        'data': posts,
+        'data': Post.bulk_to_dict(posts, user),
         'nextCursor': nextCursor
     }
@@ -1,15 +1,19 @@
-import random
 import jwt
 from datetime import datetime, timedelta
 from flask import current_app
-from sqlalchemy import and_
-from sqlalchemy.sql import func
+from sqlalchemy import and_, or_, tuple_, union_all
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func, literal, true
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from src import db
-from src.lib.mixins import ResourceMixin, SearchableMixin
-from src.blueprints.posts.models import Post, post_tags
+from src.lib.fanout import FanOut, id_chunks
+from src.lib.mixins import ResourceMixin, SearchableMixin, prefix_pattern
+from src.lib.search import UsersIndex
+from src.blueprints.posts.models import Post, PostRanking, post_likes, \
+    post_tags
+from src.blueprints.profiles.models import Profile
 from src.blueprints.messages.models import Message, Chat, \
     LastReadMessage, Notification
 
@@ -28,6 +32,11 @@ followers = db.Table(
         db.ForeignKey('users.id', ondelete='CASCADE', onupdate='CASCADE'),
         primary_key=True)
 )
+# the primary key only serves lookups by follower, this one also walks
+# the followers of a user in id order
+db.Index(
+    'ix_followers_followed_id', followers.c.followed_id,
+    followers.c.follower_id)
 
 
 user_tags = db.Table(
@@ -46,6 +55,9 @@ user_tags = db.Table(
     )
 )
 
+# the followers of a tag in id order
+db.Index('ix_user_tags_tag_id', user_tags.c.tag_id, user_tags.c.user_id)
+
 deleted_msgs = db.Table(
     'deleted_messages',
     db.Column(
@@ -65,12 +77,16 @@ deleted_msgs = db.Table(
 
 class User(db.Model, ResourceMixin, SearchableMixin):
     __tablename__ = 'users'
+    __search_index__ = UsersIndex
 
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(128), index=True, unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
     is_active = db.Column(db.Boolean(), default=True, nullable=False)
     is_admin = db.Column(db.Boolean(), default=False, nullable=False)
+    # denormalized number of chats with unread messages
+    unread_chats = db.Column(
+        db.Integer, default=0, server_default='0', nullable=False)
 
     # Relationships
     profile = db.relationship(
@@ -109,6 +125,45 @@ class User(db.Model, ResourceMixin, SearchableMixin):
     def __str__(self):
         return f'<User {self.id} {self.email}>'
 
+    @classmethod
+    def search_fallback(cls, expression):
+        pattern = prefix_pattern(expression)
+        return cls.query.join(cls.profile).filter(
+            Profile.username.ilike(pattern, escape='\\') |
+            Profile.name.ilike(pattern, escape='\\')).order_by(
+                Profile.username)
+
+    @classmethod
+    def search_changed_since(cls, since):
+        return (cls.updated_on >= since) | cls.profile.has(
+            Profile.updated_on >= since)
+
+    @classmethod
+    def get_search_signals(cls, ids):
+        signals = {id: {'followers': 0, 'active_on': None} for id in ids}
+
+        for id, count in db.session.query(
+                followers.c.followed_id, func.count()).filter(
+                    followers.c.followed_id.in_(ids)).group_by(
+                        followers.c.followed_id):
+            signals[id]['followers'] = count
+
+        for id, created_on in db.session.query(
+                Post.user_id, func.max(Post.created_on)).filter(
+                    Post.user_id.in_(ids)).group_by(Post.user_id):
+            signals[id]['active_on'] = created_on
+
+        return signals
+
+    def to_search_document(self):
+        if self.profile is None:
+            return None
+        return {
+            'name': self.profile.name,
+            'username': self.profile.username,
+            'avatar': self.profile.avatar,
+        }
+
     @classmethod
     def find_by_email(cls, email):
         return cls.query.filter((cls.email == email)).first()
@@ -136,19 +191,33 @@ class User(db.Model, ResourceMixin, SearchableMixin):
         """
         return check_password_hash(self.password, password)
 
-    def encode_auth_token(self):
-        """Generates the auth token"""
+    def encode_auth_token(self, seconds=None, scope=None):
+        """
+        Generates the auth token
+
+        :param seconds: Lifetime of the token, defaults to the configured
+            TOKEN_EXPIRATION_DAYS and TOKEN_EXPIRATION_SECONDS
+        :param scope: Only accept the token for this purpose, e.g. 'events'
+        """
+        if seconds is None:
+            lifetime = timedelta(
+                days=current_app.config.get('TOKEN_EXPIRATION_DAYS'),
+                seconds=current_app.config.get('TOKEN_EXPIRATION_SECONDS'))
+        else:
+            lifetime = timedelta(seconds=seconds)
+
         try:
             payload = {
-                'exp': datetime.utcnow() + timedelta(
-                    days=current_app.config.get('TOKEN_EXPIRATION_DAYS'),
-                    seconds=current_app.config.get('TOKEN_EXPIRATION_SECONDS')
-                ),
+                'exp': datetime.utcnow() + lifetime,
                 'iat': datetime.utcnow(),
                 'sub': {
                     'id': self.id,
                 }
             }
+
+            if scope is not None:
+                payload['sub']['scope'] = scope
+
             return jwt.encode(
                 payload,
                 current_app.config.get('SECRET_KEY'),
@@ -180,26 +249,36 @@ class User(db.Model, ResourceMixin, SearchableMixin):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            user.reindex()
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            user.reindex()
 
     def is_following(self, user):
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
 
     def get_users_to_follow(self, count=3):
-        likes = self.likes.subquery()
-        liked_posts = db.session.query(User).join(
-            likes, User.id == likes.c.user_id).distinct().except_(
-                self.followed).order_by(User.updated_on).limit(count)
-
-        if liked_posts.count() > 0:
-            return liked_posts.all()
-
-        return [User.find_by_id(random.randrange(
-            User.query.count())) for _ in range(count)]
+        '''
+        Get the best precomputed recommendations not followed yet, or the
+        newest active users when none have been computed for self.
+        '''
+        followed = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id)
+        users = User.query.join(
+            Recommendation, Recommendation.recommended_id == User.id).filter(
+                Recommendation.user_id == self.id).filter(
+                    User.id.notin_(followed)).order_by(
+                        Recommendation.rank).limit(count).all()
+
+        if users:
+            return users
+
+        return User.query.filter(User.id != self.id).filter(
+            User.is_active.is_(True)).filter(User.id.notin_(
+                followed)).order_by(User.id.desc()).limit(count).all()
 
     def get_followed_posts(self):
         followed_users_posts = db.session.query(Post.id).join(
@@ -215,6 +294,16 @@ class User(db.Model, ResourceMixin, SearchableMixin):
                     user_tags.c.user_id == self.id).union(
                         followed_users_posts.union(own_posts))
 
+    def get_feed_sources(self):
+        '''Get the authors and tags whose posts make up the home feed.'''
+        users = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id)
+        tags = db.session.query(user_tags.c.tag_id).filter(
+            user_tags.c.user_id == self.id)
+
+        return [('user', self.id)] + [('user', id) for id, in users] + \
+            [('tag', id) for id, in tags]
+
     def follow_tag(self, tag):
         if not self.is_following_tag(tag):
             self.tags.append(tag)
@@ -239,41 +328,542 @@ class User(db.Model, ResourceMixin, SearchableMixin):
 
     def get_chat(self, user):
         '''Get chat between user?'''
-        return Chat.query.filter(
-            and_(Chat.user1_id == self.id, Chat.user2_id == user.id) |
-            and_(Chat.user1_id == user.id, Chat.user2_id == self.id)).first()
-
-    def get_chat_messages(self, user):
-        '''Get all the messages in a conversation between two users'''
-        return Message.query.join(Chat.messages).filter(
-            and_(Chat.user1_id == self.id, Chat.user2_id == user.id) |
-            and_(Chat.user1_id == user.id, Chat.user2_id == self.id)).except_(
-                self.deleted_messages).order_by(Message.created_on.desc())
-
-    def get_chat_last_messages(self):
-        '''Get the last messages in all chats with self.'''
-        user1 = aliased(User)
-        user2 = aliased(User)
-        # get the last message in all chats.
-        last_msgs = db.session.query(Message.chat_id, func.max(
-            Message.created_on).label('last_messages')).group_by(
-                Message.chat_id).subquery()
-        # return the users and messages involved in the conversation with self
-        return last_msgs, db.session.query(
-            Message, user1, user2, last_msgs.c.last_messages).join(
-            last_msgs, Message.created_on == last_msgs.c.last_messages).join(
-                Chat, Chat.id == Message.chat_id).join(
-                    user1, user1.id == Chat.user1_id).join(
-                        user2, user2.id == Chat.user2_id).filter((
-                            Chat.user1_id == self.id) | (
-                                Chat.user2_id == self.id)).order_by(
-                                    last_msgs.c.last_messages.desc())
-
-    def last_read_msg_ts(self, chat_id):
-        return LastReadMessage.query.filter(and_(
+        return Chat.find_by_users(self.id, user.id)
+
+    def get_chat_messages(self, chat):
+        '''
+        Get the messages of a chat self has not deleted or cleared, newest
+        first.
+
+        Each message is checked with a probe of the deleted_messages
+        primary key, so a page costs the same in any chat.
+        '''
+        deleted = db.session.query(deleted_msgs).filter(
+            deleted_msgs.c.user_id == self.id,
+            deleted_msgs.c.message_id == Message.id).exists()
+        query = Message.query.filter(Message.chat_id == chat.id).filter(
+            ~deleted)
+        cleared_on = db.session.query(LastReadMessage.cleared_on).filter(
+            LastReadMessage.user_id == self.id,
+            LastReadMessage.chat_id == chat.id).scalar()
+
+        if cleared_on is not None:
+            query = query.filter(Message.created_on > cleared_on)
+
+        return query.order_by(Message.created_on.desc())
+
+    def get_chat_last_messages(self, before=None, limit=20):
+        '''
+        Get the chats of self with their last message and the other user,
+        latest first, leaving out the chats self cleared since.
+
+        Each side of the chat is read with a keyset scan on its
+        (user, last_message_at) index, so the cost only depends on limit.
+
+        :param before: (last_message_at, chat id) of the last chat of the
+            previous page
+        :return: list of (Message, User, Chat, is_read, unread_count)
+        '''
+        pages = []
+        marker = aliased(LastReadMessage)
+
+        for own, other in ((Chat.user1_id, Chat.user2_id),
+                           (Chat.user2_id, Chat.user1_id)):
+            # chats cleared since their last message are hidden
+            page = db.session.query(
+                Chat.id.label('id'), other.label('user_id'),
+                Chat.last_message_id.label('message_id'),
+                Chat.last_message_at.label('last_message_at')).outerjoin(
+                    marker, and_(marker.chat_id == Chat.id,
+                                 marker.user_id == self.id)).filter(
+                    own == self.id, Chat.last_message_id.isnot(None),
+                    or_(marker.cleared_on.is_(None),
+                        Chat.last_message_at > marker.cleared_on))
+
+            if before is not None:
+                page = page.filter(
+                    tuple_(Chat.last_message_at, Chat.id) < tuple_(*before))
+
+            pages.append(page.order_by(
+                Chat.last_message_at.desc(), Chat.id.desc()).limit(
+                    limit).subquery().select())
+
+        inbox = union_all(*pages).alias()
+
+        is_read = db.case(
+            [(LastReadMessage.timestamp >= Message.created_on, True)],
+            else_=False)
+
+        return db.session.query(
+            Message, User, Chat, is_read,
+            func.coalesce(LastReadMessage.unread_count, 0)).join(
+                inbox, inbox.c.message_id == Message.id).join(
+                    User, User.id == inbox.c.user_id).join(
+                        Chat, Chat.id == inbox.c.id).outerjoin(
+                            LastReadMessage, and_(
+                                LastReadMessage.chat_id == inbox.c.id,
+                                LastReadMessage.user_id == self.id)).order_by(
+                                    inbox.c.last_message_at.desc(),
+                                    inbox.c.id.desc()).limit(limit).all()
+
+    def _add_unread_chats(self, count):
+        User.query.filter(User.id == self.id).update(
+            {User.unread_chats: User.unread_chats + count},
+            synchronize_session=False)
+
+    def add_unread_message(self, chat_id):
+        '''
+        Count a message received in a chat as unread, counting the chat
+        in unread_chats when it is its first unread message.
+        '''
+        lrm = LastReadMessage.__table__
+        unread = db.session.execute(insert(lrm).values(
+            user_id=self.id, chat_id=chat_id, timestamp=None,
+            unread_count=1).on_conflict_do_update(
+                index_elements=[lrm.c.user_id, lrm.c.chat_id],
+                set_={'unread_count': lrm.c.unread_count + 1}).returning(
+                    lrm.c.unread_count)).scalar()
+
+        if unread == 1:
+            self._add_unread_chats(1)
+
+    def remove_unread_message(self, message):
+        '''Stop counting a deleted message if it was unread.'''
+        lrm = LastReadMessage.__table__
+        unread = db.session.execute(lrm.update().where(and_(
+            lrm.c.user_id == self.id, lrm.c.chat_id == message.chat_id,
+            lrm.c.unread_count > 0, or_(
+                lrm.c.timestamp.is_(None),
+                lrm.c.timestamp < message.created_on))).values(
+                    unread_count=lrm.c.unread_count - 1).returning(
+                        lrm.c.unread_count)).scalar()
+
+        if unread == 0:
+            self._add_unread_chats(-1)
+
+    def read_chat(self, chat_id):
+        '''
+        Clear the unread count of a chat that self just read.
+
+        The read marker moves in the same statement, so the marker that
+        reconcile_unread and remove_unread_message count from never lags
+        the count, even if the buffered receipt is lost.
+
+        :return: whether there was anything to clear
+        '''
+        now = datetime.utcnow()
+        cleared = LastReadMessage.query.filter(
             LastReadMessage.user_id == self.id,
-            LastReadMessage.chat_id == chat_id)).first()
+            LastReadMessage.chat_id == chat_id,
+            LastReadMessage.unread_count > 0).update({
+                LastReadMessage.unread_count: 0,
+                LastReadMessage.timestamp: db.case(
+                    [(LastReadMessage.timestamp > now,
+                      LastReadMessage.timestamp)], else_=now)
+            }, synchronize_session=False)
+
+        if cleared:
+            self._add_unread_chats(-1)
+
+        return bool(cleared)
+
+    @classmethod
+    def reconcile_unread(cls, start, end):
+        '''
+        Recompute the unread counters of users with start <= id < end
+        from their messages.
+
+        :return: the number of users whose unread_chats was fixed
+        '''
+        lrm = LastReadMessage.__table__
+
+        # a chat never opened has no read marker yet
+        for own in (Chat.user1_id, Chat.user2_id):
+            db.session.execute(insert(lrm).from_select(
+                ['user_id', 'chat_id', 'timestamp', 'unread_count'],
+                db.session.query(own, Chat.id, db.null(), literal(0)).filter(
+                    own >= start, own < end)).on_conflict_do_nothing())
+
+        unread = db.session.query(func.count(Message.id)).filter(
+            Message.chat_id == lrm.c.chat_id,
+            Message.author_id != lrm.c.user_id,
+            lrm.c.timestamp.is_(None) |
+            (Message.created_on > lrm.c.timestamp)).correlate(
+                lrm).as_scalar()
+        db.session.execute(lrm.update().where(and_(
+            lrm.c.user_id >= start, lrm.c.user_id < end)).values(
+                unread_count=unread))
+
+        chats = db.session.query(func.count(lrm.c.chat_id)).filter(
+            lrm.c.user_id == cls.id, lrm.c.unread_count > 0).correlate(
+                cls).as_scalar()
+
+        return cls.query.filter(cls.id >= start, cls.id < end).filter(
+            cls.unread_chats != chats).update(
+                {cls.unread_chats: chats}, synchronize_session=False)
 
     def delete_message_for_me(self, message):
         self.deleted_messages.append(message)
         self.save()
+
+    def clear_chat(self, chat_id):
+        '''Hide every message of a chat sent so far from self.'''
+        now = datetime.utcnow()
+        lrm = LastReadMessage.__table__
+
+        self.read_chat(chat_id)
+        db.session.execute(insert(lrm).values(
+            user_id=self.id, chat_id=chat_id, timestamp=now,
+            cleared_on=now).on_conflict_do_update(
+                index_elements=[lrm.c.user_id, lrm.c.chat_id],
+                set_={'timestamp': now, 'cleared_on': now}))
+
+
+class Timeline(db.Model):
+    '''
+    The home feed of every user, filled on write.
+
+    A new top-level post is pushed to its author, the author's followers
+    and the followers of its tags, so reading a feed is a range scan on
+    (user_id, created_on) instead of a union over everything followed.
+    '''
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_created', 'user_id', 'created_on'),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'users.id', ondelete='CASCADE'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey(
+        'posts.id', ondelete='CASCADE'), primary_key=True)
+    created_on = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<Timeline {self.user_id}: {self.post_id}>'
+
+    @classmethod
+    def _insert(cls, entries):
+        '''
+        Insert (user_id, post_id, created_on) rows, skipping the ones
+        already in a timeline.
+        '''
+        return db.session.execute(insert(cls.__table__).from_select(
+            ['user_id', 'post_id', 'created_on'],
+            entries).on_conflict_do_nothing())
+
+    @classmethod
+    def push(cls, user_ids, post):
+        '''Push a post to the timelines of a list of users.'''
+        return db.session.execute(insert(cls.__table__).values([
+            {'user_id': user_id, 'post_id': post.id,
+             'created_on': post.created_on} for user_id in user_ids
+        ]).on_conflict_do_nothing())
+
+    @classmethod
+    def fan_out(cls, post, chunk_size=None, progress=None):
+        '''
+        Push a new top-level post to the timelines of the followers of
+        its author and of its tags, and notify the followers of its
+        author. Its author's own timeline is left to create_post.
+
+        Recipients are read and written a chunk at a time, a user
+        following both the author and a tag gets the post once.
+
+        :param progress: FanOutProgress of the post, started from and
+            moved along with every chunk
+        :return: generator of the number of users of each chunk written
+        '''
+        chunk_size = chunk_size or current_app.config['FAN_OUT_CHUNK_SIZE']
+        audience = [(db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == post.user_id),
+            followers.c.follower_id, True)]
+        # in a fixed order, progress is a position in it
+        audience.extend((db.session.query(user_tags.c.user_id).filter(
+            user_tags.c.tag_id == tag.id), user_tags.c.user_id, False)
+            for tag in sorted(post.tags, key=lambda tag: tag.id))
+        part, after = (progress.part, progress.after_id) \
+            if progress is not None else (0, None)
+
+        for index, (query, column, notify) in enumerate(audience):
+            if index < part:
+                continue
+
+            for user_ids in id_chunks(
+                    query, column, chunk_size,
+                    after if index == part else None):
+                cls.push(user_ids, post)
+
+                if notify:
+                    Notification.add_many(
+                        'post', post.id, post.user_id, user_ids,
+                        post_id=post.id)
+
+                if progress is not None:
+                    progress.part, progress.after_id = index, user_ids[-1]
+
+                yield len(user_ids)
+
+    @classmethod
+    def deliver(cls, post_id):
+        '''
+        Fan out a post from where its saved progress stopped, which is
+        removed once it is done. A post deleted in the meantime took its
+        progress with it.
+        '''
+        progress = FanOutProgress.query.get(post_id)
+
+        if progress is None:
+            return
+
+        post = Post.query.get(post_id)
+
+        if post is not None:
+            yield from cls.fan_out(post, progress=progress)
+
+        db.session.delete(progress)
+
+    @classmethod
+    def add_posts(cls, user_id, posts):
+        '''
+        Copy the newest posts of a Post query into a timeline, used when
+        a user or tag is followed.
+        '''
+        return cls._insert(posts.filter(Post.comment_id.is_(None)).order_by(
+            Post.created_on.desc()).limit(current_app.config[
+                'TIMELINE_LENGTH']).with_entities(
+                    literal(user_id), Post.id, Post.created_on))
+
+    @classmethod
+    def remove_posts(cls, user_id, posts):
+        '''
+        Remove the posts of a Post query from a timeline, used when a user
+        or tag is unfollowed. Own posts, posts by users still followed and
+        posts with a tag still followed are kept.
+        '''
+        followed = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user_id)
+        followed_tag = db.session.query(post_tags).join(
+            user_tags, user_tags.c.tag_id == post_tags.c.tag_id).filter(
+                post_tags.c.post_id == Post.id,
+                user_tags.c.user_id == user_id).exists()
+        ids = posts.filter(Post.user_id != user_id).filter(
+            Post.user_id.notin_(followed)).filter(~followed_tag).with_entities(
+                Post.id)
+
+        return cls.query.filter(cls.user_id == user_id).filter(
+            cls.post_id.in_(ids)).delete(synchronize_session=False)
+
+    @classmethod
+    def get_posts(cls, user_id):
+        '''Gets the posts in a timeline, newest first.'''
+        return db.session.query(Post, cls.created_on).join(
+            cls, cls.post_id == Post.id).filter(
+                cls.user_id == user_id).order_by(cls.created_on.desc())
+
+    @classmethod
+    def get_top_posts(cls, user_id, epoch, rank=None):
+        '''
+        Gets the posts in a timeline, best ranked first in a snapshot.
+
+        The query starts from the timeline, at most TIMELINE_LENGTH rows,
+        and probes the snapshot's (epoch, post_id) index for each of them
+        rather than scanning the whole snapshot.
+        '''
+        query = db.session.query(Post, PostRanking.rank).select_from(
+            cls).join(PostRanking, and_(
+                PostRanking.epoch == epoch,
+                PostRanking.post_id == cls.post_id)).join(
+                    Post, Post.id == cls.post_id).filter(
+                        cls.user_id == user_id)
+
+        if rank is not None:
+            query = query.filter(PostRanking.rank < rank)
+
+        return query.order_by(PostRanking.rank.desc())
+
+    @classmethod
+    def backfill(cls, start, end):
+        '''
+        Rebuild the timelines of users with start <= id < end from the
+        follow graph, keeping the newest TIMELINE_LENGTH posts each.
+        '''
+        posts = db.session.query(
+            Post.id.label('post_id'), Post.created_on.label('created_on')
+        ).filter(Post.comment_id.is_(None))
+        followed_users_posts = posts.join(
+            followers, followers.c.followed_id == Post.user_id).filter(
+                followers.c.follower_id >= start,
+                followers.c.follower_id < end).add_columns(
+                    followers.c.follower_id.label('user_id'))
+        own_posts = posts.filter(
+            Post.user_id >= start, Post.user_id < end).add_columns(
+                Post.user_id.label('user_id'))
+        tag_posts = posts.join(
+            post_tags, Post.id == post_tags.c.post_id).join(
+                user_tags, post_tags.c.tag_id == user_tags.c.tag_id).filter(
+                    user_tags.c.user_id >= start,
+                    user_tags.c.user_id < end).add_columns(
+                        user_tags.c.user_id.label('user_id'))
+        entries = followed_users_posts.union(
+            own_posts, tag_posts).subquery()
+        ranked = db.session.query(
+            entries.c.user_id, entries.c.post_id, entries.c.created_on,
+            func.row_number().over(
+                partition_by=entries.c.user_id,
+                order_by=entries.c.created_on.desc()).label(
+                    'position')).subquery()
+
+        return cls._insert(db.session.query(
+            ranked.c.user_id, ranked.c.post_id, ranked.c.created_on).filter(
+                ranked.c.position <= current_app.config['TIMELINE_LENGTH']))
+
+    @classmethod
+    def trim(cls, start, end):
+        '''
+        Drop everything but the newest TIMELINE_LENGTH entries from the
+        timelines of users with start <= id < end.
+        '''
+        ranked = db.session.query(
+            cls.user_id, cls.post_id, func.row_number().over(
+                partition_by=cls.user_id,
+                order_by=cls.created_on.desc()).label('position')).filter(
+                    cls.user_id >= start, cls.user_id < end).subquery()
+        stale = db.session.query(ranked.c.user_id, ranked.c.post_id).filter(
+            ranked.c.position > current_app.config['TIMELINE_LENGTH'])
+
+        return cls.query.filter(tuple_(cls.user_id, cls.post_id).in_(
+            stale)).delete(synchronize_session=False)
+
+
+class FanOutProgress(db.Model):
+    '''
+    The position reached by the fan-out of a new post, saved with every
+    chunk written and removed once it is done, so the posts whose fan-out
+    a crash or a failure left unfinished are the rows of this table.
+    '''
+    __tablename__ = 'fan_out_progress'
+
+    post_id = db.Column(db.Integer, db.ForeignKey(
+        'posts.id', ondelete='CASCADE'), primary_key=True)
+    # index of the audience in Timeline.fan_out, and the last user of it
+    # the post was delivered to
+    part = db.Column(db.Integer, nullable=False, default=0)
+    after_id = db.Column(db.Integer)
+    # last saved, a fan-out still running saves again within a chunk
+    updated_on = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<FanOutProgress {self.post_id}: {self.part} {self.after_id}>'
+
+
+class Recommendation(db.Model):
+    '''
+    The top users to follow for every user, computed offline.
+
+    Candidates are friends of friends and users who liked the same posts
+    or whose posts were liked, so recommending is a range scan on
+    (user_id, rank).
+    '''
+    __tablename__ = 'user_recommendations'
+
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'users.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    recommended_id = db.Column(db.Integer, db.ForeignKey(
+        'users.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<Recommendation {self.user_id}: {self.recommended_id}>'
+
+    @classmethod
+    def get_candidates(cls, start, end):
+        '''
+        Get the (user_id, candidate_id, weight) rows of users with
+        start <= id < end, one row per follow, like or shared like
+        linking them to the candidate.
+
+        Every hop reads at most RECOMMENDATION_LINKS rows, the follows of
+        a user or the likers of a post, so a celebrity account or a viral
+        post costs the same as any other.
+        '''
+        links = current_app.config['RECOMMENDATION_LINKS']
+        f1 = followers.alias()
+        f2 = followers.alias()
+        l1 = post_likes.alias()
+        l2 = post_likes.alias()
+        users = db.session.query(User.id.label('user_id')).filter(
+            User.id >= start, User.id < end).subquery()
+
+        followed = db.session.query(f1.c.followed_id).filter(
+            f1.c.follower_id == users.c.user_id).limit(
+                links).subquery().lateral()
+        followed_by_followed = db.session.query(f2.c.followed_id).filter(
+            f2.c.follower_id == followed.c.followed_id).limit(
+                links).subquery().lateral()
+        # the newest posts a user liked
+        liked = db.session.query(l1.c.post_id).filter(
+            l1.c.user_id == users.c.user_id).order_by(
+                l1.c.post_id.desc()).limit(links).subquery().lateral()
+        co_liked = db.session.query(l2.c.user_id).filter(
+            l2.c.post_id == liked.c.post_id).limit(links).subquery().lateral()
+
+        friends_of_friends = db.session.query(
+            users.c.user_id.label('user_id'),
+            followed_by_followed.c.followed_id.label('candidate_id'),
+            literal(1.0).label('weight')).select_from(
+                    users).join(followed, true()).join(
+                        followed_by_followed, true())
+        co_likers = db.session.query(
+            users.c.user_id, co_liked.c.user_id, literal(0.5)).select_from(
+                users).join(liked, true()).join(co_liked, true())
+        liked_authors = db.session.query(
+            users.c.user_id, Post.user_id, literal(1.0)).select_from(
+                users).join(liked, true()).join(
+                    Post, Post.id == liked.c.post_id)
+
+        return friends_of_friends.union_all(
+            co_likers, liked_authors).subquery()
+
+    @classmethod
+    def rebuild(cls, start, end):
+        '''
+        Replace the recommendations of users with start <= id < end with
+        their RECOMMENDATIONS_KEPT best scored candidates, skipping the
+        users they already follow and inactive accounts.
+
+        :return: the number of recommendations written
+        '''
+        candidates = cls.get_candidates(start, end)
+        followed = db.session.query(followers).filter(
+            followers.c.follower_id == candidates.c.user_id,
+            followers.c.followed_id == candidates.c.candidate_id).exists()
+        scores = db.session.query(
+            candidates.c.user_id, candidates.c.candidate_id,
+            func.sum(candidates.c.weight).label('score')).join(
+                User, User.id == candidates.c.candidate_id).filter(
+                    candidates.c.user_id != candidates.c.candidate_id,
+                    User.is_active.is_(True), ~followed).group_by(
+                        candidates.c.user_id,
+                        candidates.c.candidate_id).subquery()
+        ranked = db.session.query(
+            scores.c.user_id, scores.c.candidate_id, scores.c.score,
+            func.row_number().over(
+                partition_by=scores.c.user_id,
+                order_by=(scores.c.score.desc(), scores.c.candidate_id)
+            ).label('rank')).subquery()
+
+        cls.query.filter(cls.user_id >= start, cls.user_id < end).delete(
+            synchronize_session=False)
+
+        return db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'recommended_id', 'score', 'rank'],
+            db.session.query(
+                ranked.c.user_id, ranked.c.candidate_id, ranked.c.score,
+                ranked.c.rank).filter(ranked.c.rank <= current_app.config[
+                    'RECOMMENDATIONS_KEPT']))).rowcount
+
+
+# new top-level posts on their way to timelines and notifications
+fan_out = FanOut('fan-out', Timeline.deliver)
@@ -5,12 +5,11 @@ from src import db
 from src.lib import urlsafe_base64
 from src.lib.auth import authenticate
 from src.blueprints.errors import server_error, not_found
-from src.blueprints.users.models import User
+from src.blueprints.users.models import User, Timeline
 from src.blueprints.posts.models import Post
 from src.blueprints.profiles.models import Profile
 from src.blueprints.messages.models import Notification
 from src.blueprints.users.schema import UserSchema
-from src.blueprints.posts.schema import PostSchema
 from src.blueprints.tags.schema import TagSchema
 
 from src.blueprints.users.routes import users
@@ -25,6 +24,7 @@ def follow(user, id):
         return not_found('User not found')
 
     user.follow(to_follow)
+    Timeline.add_posts(user.id, Post.query.with_parent(to_follow))
 
     db.session.add(
         user.add_notification(
@@ -50,6 +50,8 @@ def unfollow(user, id):
         return not_found('User not found')
 
     user.unfollow(followed)
+    db.session.flush()
+    Timeline.remove_posts(user.id, Post.query.with_parent(followed))
 
     notif = Notification.find_by_attr(subject='follow', item_id=user.id)
 
@@ -202,7 +204,7 @@ def get_user_posts(user, username):
             posts[items_per_page - 1].created_on.isoformat())
 
     return {
-        'data': [post.to_dict(user) for post in posts[:items_per_page]],
+        'data': Post.bulk_to_dict(posts[:items_per_page], user),
         'nextCursor': nextCursor,
         'total': query.count(),
     }
@@ -241,15 +243,9 @@ def get_user_comments(user, username):
         nextCursor = urlsafe_base64(
             comments[items_per_page - 1].created_on.isoformat())
 
-    comment_list = []
-    for c in comments[:items_per_page]:
-        comment = c.to_dict(user)
-        comment['parent'] = PostSchema(
-            only=('id', 'body', 'author',)).dump(c.parent)
-        comment_list.append(comment)
-
     return {
-        'data': comment_list,
+        'data': Post.bulk_to_dict(
+            comments[:items_per_page], user, with_parent=True),
         'nextCursor': nextCursor,
         'total': query.count(),
     }
@@ -286,17 +282,9 @@ def get_liked_posts(user, username):
         nextCursor = urlsafe_base64(
             posts[items_per_page - 1].created_on.isoformat())
 
-    liked_posts = []
-    for p in posts[:items_per_page]:
-        post = p.to_dict(user)
-
-        if p.parent:
-            post['parent'] = PostSchema(
-                only=('id', 'body', 'author',)).dump(p.parent)
-        liked_posts.append(post)
-
     return {
-        'data': liked_posts,
+        'data': Post.bulk_to_dict(
+            posts[:items_per_page], user, with_parent=True),
         'nextCursor': nextCursor,
         'total': query.count(),
     }
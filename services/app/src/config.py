@@ -20,9 +20,65 @@ class BaseConfig:
     TESTING = False
     TOKEN_EXPIRATION_DAYS = 30
     TOKEN_EXPIRATION_SECONDS = 0
+    # seconds a verified token and its user's principal stay cached
+    AUTH_CACHE_TTL = 60
+    # post ranking snapshots still served to open "top" feed cursors
+    RANKING_EPOCHS_KEPT = 3
+    # posts kept in each user's home timeline
+    TIMELINE_LENGTH = 800
+    # followers read and written at a time when a new post is fanned out
+    FAN_OUT_CHUNK_SIZE = 1000
+    # users to follow stored per user by the recommend_users command
+    RECOMMENDATIONS_KEPT = 20
+    # follows of a user and likers of a post read per hop when finding them
+    RECOMMENDATION_LINKS = 200
+    # candidate post ids for /posts/featured, and seconds between refreshes
+    FEATURED_POOL_SIZE = 100
+    FEATURED_POOL_TTL = 300
+    # newest matches of a post search that are ranked, every match is still
+    # read from the index
+    POST_SEARCH_CANDIDATES = 1000
+    # seconds read markers are held, to write one per user and chat
+    READ_RECEIPT_DELAY = 1
+    # seconds between keepalive comments on an open event stream, events
+    # held for a client that is not reading them, and streams served at
+    # once by a process
+    EVENT_KEEPALIVE = 15
+    EVENT_BACKLOG = 100
+    EVENT_STREAMS = 900
+    # lifetime of the tokens opening an event stream from a browser
+    EVENT_TOKEN_SECONDS = 300
+    # in-memory feed engine: posts kept per author or tag, how many
+    # authors and tags are kept, and for how many seconds
+    FEED_SOURCE_SIZE = 100
+    FEED_SOURCES = 50000
+    FEED_SOURCE_TTL = 30
     ES_HOST = os.environ.get('ES_HOST')
     ES_PORT = os.environ.get('ES_PORT')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # Elasticsearch: results per search, seconds allowed per search and
+    # per indexing request, and pooled connections per process. After
+    # SEARCH_BREAKER_FAILURES failures in a row, searches use the database
+    # for SEARCH_BREAKER_RESET seconds.
+    SEARCH_RESULTS = 10
+    SEARCH_TIMEOUT = 0.5
+    SEARCH_INDEX_TIMEOUT = 10
+    SEARCH_POOL_SIZE = 10
+    SEARCH_BREAKER_FAILURES = 5
+    SEARCH_BREAKER_RESET = 30
+    # searches cached per process, and for how many seconds
+    SEARCH_CACHE_SIZE = 10000
+    SEARCH_CACHE_TTL = 30
+    # rebuilt search indices kept, the oldest are dropped after a rebuild
+    SEARCH_INDEX_VERSIONS_KEPT = 2
+    # 'elasticsearch', or 'memory' to search an in-process index that is
+    # rebuilt every SEARCH_MEMORY_TTL seconds, the longest the changes made
+    # by other processes take to show up in it
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
+    SEARCH_MEMORY_TTL = 600
+    # seconds between reindexes of a document for its ranking fields alone,
+    # e.g. the activity and followers of users
+    SEARCH_SIGNALS_INTERVAL = 300
 
 
 class DevelopmentConfig(BaseConfig):
@@ -35,6 +91,7 @@ class TestingConfig(BaseConfig):
     """Testing configuration"""
     ITEMS_PER_PAGE = 2
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    SEARCH_BACKEND = 'memory'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_TEST_URL')
     TESTING = True
     TOKEN_EXPIRATION_DAYS = 0
@@ -1,9 +1,165 @@
+import time
 from functools import wraps
 
-from flask import request
+import jwt
+from flask import current_app, request
 
+from src import db
+from src.lib.cache import TTLCache
 from src.blueprints.errors import error_response
 from src.blueprints.users.models import User
+from src.blueprints.profiles.models import Profile
+
+
+# verified token -> identity, and user id -> principal fields
+tokens = TTLCache(maxsize=10000)
+principals = TTLCache(maxsize=10000)
+
+
+class Principal(object):
+    """
+    The authenticated user of a request.
+
+    The fields needed on most requests are cached per process. Any other
+    attribute is read from and written to the User row, which is only
+    loaded the first time a route needs it.
+    """
+    _fields = ('id', 'is_active', 'username', 'name', 'avatar', '_user')
+
+    def __init__(self, id, is_active, username, name, avatar):
+        self.id = id
+        self.is_active = is_active
+        self.username = username
+        self.name = name
+        self.avatar = avatar
+        self._user = None
+
+    def __repr__(self):
+        return f'<Principal {self.id} {self.username}>'
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        if name in self._fields:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.user, name, value)
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.find_by_id(self.id)
+        return self._user
+
+
+def decode_token(token):
+    """
+    Decode an auth token, remembering the identity of verified tokens
+    until they expire.
+
+    :param token: JWT
+    :return: dict identity or str error message
+    """
+    payload = tokens.get(token)
+
+    if payload is not None:
+        return payload
+
+    payload = User.decode_auth_token(token)
+
+    if isinstance(payload, dict):
+        # the signature is verified above, only the expiry is needed here
+        exp = jwt.decode(token, options={'verify_signature': False})['exp']
+        tokens.set(token, payload, ttl=min(
+            current_app.config['AUTH_CACHE_TTL'], exp - time.time()))
+
+    return payload
+
+
+def load_principal(id):
+    """
+    Get the principal of a user id, from the cache when possible.
+
+    :param id: User id
+    :return: Principal or None
+    """
+    fields = principals.get(id)
+
+    if fields is None:
+        fields = db.session.query(
+            User.id, User.is_active, Profile.username, Profile.name,
+            Profile.avatar).outerjoin(
+                Profile, Profile.user_id == User.id).filter(
+                    User.id == id).first()
+
+        if fields is None:
+            return None
+
+        fields = tuple(fields)
+        principals.set(id, fields, ttl=current_app.config['AUTH_CACHE_TTL'])
+
+    return Principal(*fields)
+
+
+def collect_changes(session, flush_context):
+    """
+    Drop the cached principals a flush changed, and remember them so they
+    are dropped again once the transaction commits.
+    """
+    changed = session.info.setdefault('principals', set())
+
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+        elif isinstance(obj, Profile):
+            changed.add(obj.user_id)
+
+    for id in changed:
+        principals.pop(id)
+
+
+def invalidate(session):
+    """Drop the cached principals changed by a committed transaction."""
+    for id in session.info.pop('principals', ()):
+        principals.pop(id)
+
+
+def discard_changes(session):
+    session.info.pop('principals', None)
+
+
+db.event.listen(db.session, 'after_flush', collect_changes)
+db.event.listen(db.session, 'after_commit', invalidate)
+db.event.listen(db.session, 'after_rollback', discard_changes)
+
+
+def authorize(token, scope=None):
+    """
+    Get the principal of a token.
+
+    :param token: JWT
+    :param scope: Scope the token must have been issued for, None for
+        regular tokens
+    :return: Principal, or the error response
+    """
+    payload = decode_token(token)
+
+    if not isinstance(payload, dict):
+        return error_response(401, message=payload)
+
+    if payload.get('scope') != scope:
+        return error_response(401, message='Invalid token.')
+
+    user = load_principal(payload.get('id'))
+
+    if user is None:
+        return error_response(401, message='Invalid token.')
+
+    if not user.is_active:
+        return error_response(401, message='Account is disabled.')
+
+    return user
 
 
 def authenticate(func):
@@ -14,16 +170,33 @@ def authenticate(func):
         if not auth_header:
             return error_response(403, message='No authorization.')
 
-        token = auth_header.split(" ")[1]
-        payload = User.decode_auth_token(token)
+        user = authorize(auth_header.split(" ")[1])
+
+        if not isinstance(user, Principal):
+            return user
+
+        return func(user, *args, **kwargs)
+    return wrapper
+
+
+def authenticate_stream(func):
+    """
+    Like authenticate, but also accepting an 'events' token in the token
+    query parameter, as a browser's EventSource cannot send headers. Such
+    tokens are short-lived and only open event streams, so the regular
+    token never ends up in URLs and access logs.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = request.args.get('token')
 
-        if not isinstance(payload, dict):
-            return error_response(401, message=payload)
+        if token is None:
+            return authenticate(func)(*args, **kwargs)
 
-        user = User.find_by_id(payload.get('id'))
+        user = authorize(token, scope='events')
 
-        if user is None:
-            return error_response(401, message='Invalid token.')
+        if not isinstance(user, Principal):
+            return user
 
         return func(user, *args, **kwargs)
     return wrapper
@@ -0,0 +1,63 @@
+import time
+import threading
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a failing dependency for a while.
+
+    After `failures` consecutive errors the circuit opens and calls fail
+    immediately with CircuitOpenError. Once `reset_timeout` seconds have
+    passed a single trial call is let through: success closes the
+    circuit, another error opens it again.
+    """
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._errors = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            if self._opened_at is not None:
+                if self._trial or (
+                        time.monotonic() - self._opened_at <
+                        self.reset_timeout):
+                    raise CircuitOpenError()
+                self._trial = True
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._errors += 1
+                self._trial = False
+
+                if self._errors >= self.failures or \
+                        self._opened_at is not None:
+                    self._opened_at = time.monotonic()
+            raise
+
+        with self._lock:
+            self._errors = 0
+            self._opened_at = None
+            self._trial = False
+
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._errors = 0
+            self._opened_at = None
+            self._trial = False
@@ -0,0 +1,79 @@
+import time
+import threading
+
+from src.lib.worker import BackgroundWorker
+
+
+class WriteBuffer(object):
+    """
+    Coalesce frequent writes to the same rows and apply them in batches.
+
+    Values added for a key are merged with the pending one, e.g. keeping
+    the latest timestamp, and `delay` seconds after the first of a batch
+    they are all handed to `write` on a background thread. A burst of
+    writes to one row becomes a single one, at the cost of the row
+    lagging by up to `delay` seconds. A batch that fails is merged back
+    and written again `retry_delay` seconds later.
+
+    :param write: function applying a dict of key to value
+    :param merge: function of the pending and the new value of a key
+    """
+
+    def __init__(self, name, write, merge=max, delay=1.0, retry_delay=30.0,
+                 app=None):
+        self.delay = delay
+        self.retry_delay = retry_delay
+        self.worker = BackgroundWorker(name)
+        self._write = write
+        self._merge = merge
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, delay=None):
+        self.worker.init_app(app)
+
+        if delay is not None:
+            self.delay = delay
+
+    def add(self, key, value):
+        with self._lock:
+            scheduled = bool(self._pending)
+            pending = self._pending.get(key)
+            self._pending[key] = value if pending is None else self._merge(
+                pending, value)
+
+        if not scheduled:
+            self.worker.submit(self._flush_later)
+
+    def _flush_later(self, delay=None):
+        time.sleep(self.delay if delay is None else delay)
+        self.flush()
+
+    def flush(self):
+        """Write everything pending, called on the worker thread."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        try:
+            self._write(pending)
+        except Exception:
+            self._requeue(pending)
+            raise
+
+    def _requeue(self, pending):
+        with self._lock:
+            scheduled = bool(self._pending)
+
+            for key, value in pending.items():
+                newer = self._pending.get(key)
+                self._pending[key] = value if newer is None else self._merge(
+                    value, newer)
+
+        if not scheduled:
+            self.worker.submit(self._flush_later, self.retry_delay)
@@ -0,0 +1,101 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded, thread safe LRU cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        """
+        Get a cached value, moving it to the front of the LRU order.
+
+        :param key: Cache key
+        :param default: Value returned on a miss
+        :param count: Record the lookup in the hit/miss counters
+        :return: The cached value or default
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                if count:
+                    self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache a value, evicting the least recently used entry when full.
+
+        :param key: Cache key
+        :param value: Value to cache
+        :param ttl: Seconds to keep the value, defaults to the cache's ttl
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def replace(self, key, func):
+        """
+        Replace a live entry with func(value), keeping its expiry.
+
+        :return: True if the key was cached
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or item[0] < time.monotonic():
+                return False
+
+            self._data[key] = (item[0], func(item[1]))
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: dict with the size and hit rate of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+        }
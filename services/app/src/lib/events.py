@@ -0,0 +1,222 @@
+import json
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import text
+
+from src import db
+
+# Postgres channel shared by every process
+CHANNEL = 'user_events'
+
+
+class StreamLimitReached(Exception):
+    pass
+
+
+class EventBus(object):
+    """
+    Push events about users to the event streams they have open.
+
+    Events are sent with NOTIFY inside the transaction that causes them,
+    so Postgres hands them to every process once it commits and drops
+    them on rollback. Each process LISTENs on a single connection of its
+    own, opened with its first stream, and passes every event to the
+    queues of the user's streams. An idle stream waits on its queue and
+    costs the database nothing. A payload starts with its user's id, so
+    the events of users without a stream in this process are dropped
+    without decoding them.
+
+    Each stream holds its worker's connection while it is open, so at
+    most `max_streams` are served per process.
+
+    Rows with a get_events() method publish its events when they are
+    inserted.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.keepalive = 15
+        self.backlog = 100
+        self.max_streams = 1000
+        self._streams = {}
+        self._count = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.keepalive = app.config['EVENT_KEEPALIVE']
+        self.backlog = app.config['EVENT_BACKLOG']
+        self.max_streams = app.config['EVENT_STREAMS']
+
+    def publish(self, user_id, event, data, session=None):
+        """
+        Send an event to a user once the current transaction commits.
+
+        :param user_id: User id
+        :param event: str event type
+        :param data: dict, kept small as NOTIFY payloads are limited
+        """
+        self.publish_many([(user_id, event, data)], session)
+
+    def publish_many(self, items, session=None):
+        """
+        Send events with a single statement.
+
+        :param items: list of (user_id, event, data)
+        """
+        session = session or db.session
+        payloads = ['{}:{}'.format(user_id, json.dumps(
+            {'event': event, 'data': data}, default=str))
+            for user_id, event, data in items]
+
+        if not payloads:
+            return
+
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text(
+                'SELECT pg_notify(:channel, payload) '
+                'FROM unnest(:payloads) AS payload'),
+                {'channel': CHANNEL, 'payloads': payloads})
+        else:
+            # without NOTIFY only the streams of this process get them
+            session.info.setdefault('events', []).extend(payloads)
+
+    def stream(self, user_id):
+        """
+        Generate the server-sent events of a user until the client
+        disconnects, with a comment every `keepalive` seconds.
+
+        :raises StreamLimitReached: when the process serves max_streams
+        """
+        # subscribed right away, not on the first read of the stream
+        return self._stream(user_id, self.subscribe(user_id))
+
+    def _stream(self, user_id, events):
+        try:
+            while True:
+                try:
+                    payload = events.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                yield 'event: {}\ndata: {}\n\n'.format(
+                    payload['event'], json.dumps(payload['data']))
+        finally:
+            self.unsubscribe(user_id, events)
+
+    def subscribe(self, user_id):
+        events = queue.Queue(maxsize=self.backlog)
+
+        with self._lock:
+            if self._count >= self.max_streams:
+                raise StreamLimitReached('Too many open event streams.')
+
+            self._streams.setdefault(user_id, set()).add(events)
+            self._count += 1
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._listen, name='events', daemon=True)
+                self._thread.start()
+
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            streams = self._streams.get(user_id, set())
+
+            if events in streams:
+                streams.discard(events)
+                self._count -= 1
+
+            if not streams:
+                self._streams.pop(user_id, None)
+
+    def deliver(self, payload):
+        """Hand an event to the streams of its user in this process."""
+        user_id, _, payload = payload.partition(':')
+
+        with self._lock:
+            streams = list(self._streams.get(int(user_id), ()))
+
+        if not streams:
+            return
+
+        payload = json.loads(payload)
+
+        for events in streams:
+            try:
+                events.put_nowait(payload)
+            except queue.Full:
+                # a client that stopped reading misses events, it catches
+                # up with the regular endpoints
+                pass
+
+    def _listen(self):
+        with self.app.app_context():
+            engine = db.engine
+
+        if engine.dialect.name != 'postgresql':
+            return
+
+        while True:
+            connection = None
+
+            try:
+                # kept out of the pool for the life of the process
+                connection = engine.raw_connection()
+                connection.detach()
+                connection.connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CHANNEL}')
+                self._poll(connection.connection)
+            except Exception:
+                self.app.logger.exception('event listener failed')
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _poll(self, connection):
+        while True:
+            select.select([connection], [], [], self.keepalive)
+            connection.poll()
+
+            while connection.notifies:
+                self.deliver(connection.notifies.pop(0).payload)
+
+    @staticmethod
+    def collect_events(session, flush_context):
+        '''Publish the events of the rows inserted by a flush.'''
+        items = []
+
+        for obj in session.new:
+            get_events = getattr(obj, 'get_events', None)
+
+            if get_events is not None:
+                items.extend(get_events())
+
+        events.publish_many(items, session)
+
+    @staticmethod
+    def after_commit(session):
+        for payload in session.info.pop('events', ()):
+            events.deliver(payload)
+
+    @staticmethod
+    def discard_events(session):
+        session.info.pop('events', None)
+
+
+events = EventBus()
+
+db.event.listen(db.session, 'after_flush', EventBus.collect_events)
+db.event.listen(db.session, 'after_commit', EventBus.after_commit)
+db.event.listen(db.session, 'after_rollback', EventBus.discard_events)
@@ -0,0 +1,133 @@
+import time
+import threading
+
+from src import db
+from src.lib.worker import BackgroundWorker
+
+
+def id_chunks(query, column, size, after=None):
+    """
+    Read the ids of a single column query in chunks, each one an index
+    range scan starting after the last id of the previous chunk.
+
+    :param column: the int column selected, which the query is ordered by
+    :param after: only read the ids greater than this one
+    :return: generator of lists of at most size ids
+    """
+
+    while True:
+        chunk = query.order_by(column)
+
+        if after is not None:
+            chunk = chunk.filter(column > after)
+
+        ids = [id for id, in chunk.limit(size)]
+
+        if not ids:
+            return
+
+        yield ids
+        after = ids[-1]
+
+
+class FanOut(object):
+    """
+    Deliver new rows to their audience on a background worker, so the
+    request creating them neither waits on nor holds a transaction open
+    for every recipient.
+
+    `deliver` takes the id of a row and yields the number of recipients
+    of each chunk it writes, every chunk is committed on its own along
+    with whatever progress `deliver` saves, so a row that fails or is
+    lost with the process can be resumed. A failed row is retried up to
+    `retries` times, `retry_delay` seconds apart. Progress and lag, the
+    seconds the oldest unfinished row has been waiting, are reported by
+    stats.
+    """
+
+    def __init__(self, name, deliver, retries=3, retry_delay=30.0,
+                 app=None):
+        self.worker = BackgroundWorker(name)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.done = 0
+        self.failed = 0
+        self.recipients = 0
+        self.last_duration = 0.0
+        self._deliver = deliver
+        # id -> (time queued, recipients so far) of unfinished rows
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.worker.init_app(app)
+
+    def submit(self, id, attempt=0):
+        """Fan a committed row out in the background."""
+        with self._lock:
+            self._pending.setdefault(id, (time.time(), 0))
+
+        self.worker.submit(self._run, id, attempt)
+
+    def _run(self, id, attempt):
+        try:
+            self.run(id)
+        except Exception:
+            if attempt < self.retries:
+                retry = threading.Timer(
+                    self.retry_delay, self.submit, args=[id, attempt + 1])
+                retry.daemon = True
+                retry.start()
+            raise
+
+    def run(self, id):
+        """
+        Fan a row out on the current thread, e.g. from a command.
+
+        :raises Exception: whatever made it fail, progress up to the last
+            committed chunk is kept
+        """
+        with self._lock:
+            self._pending.setdefault(id, (time.time(), 0))
+
+        try:
+            for count in self._deliver(id):
+                db.session.commit()
+
+                with self._lock:
+                    queued_at, progress = self._pending[id]
+                    self._pending[id] = (queued_at, progress + count)
+                    self.recipients += count
+
+            # what deliver wrote after its last chunk
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+            with self._lock:
+                self._pending.pop(id)
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                queued_at, _ = self._pending.pop(id)
+                self.done += 1
+                self.last_duration = time.time() - queued_at
+
+    def stats(self):
+        with self._lock:
+            # rows run in the order they were queued, the oldest is running
+            current = next(iter(self._pending.items()), None)
+            return {
+                'queued': len(self._pending),
+                'done': self.done,
+                'failed': self.failed,
+                'recipients': self.recipients,
+                'current': {'id': current[0], 'recipients': current[1][1]}
+                if current else None,
+                'lag': time.time() - current[1][0] if current else 0.0,
+                'lastDuration': self.last_duration,
+            }
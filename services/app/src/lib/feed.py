@@ -0,0 +1,131 @@
+import heapq
+from operator import itemgetter
+
+from src.lib.cache import TTLCache
+
+
+class FeedEngine(object):
+    """
+    Build home feeds by merging, in memory, short per-author and per-tag
+    lists of recent posts.
+
+    Every source (e.g. ('user', 7) or ('tag', 3)) keeps its newest
+    FEED_SOURCE_SIZE (created_on, post_id) pairs, newest first. A feed
+    page is a k-way heap merge of the lists of everything the viewer
+    follows, so a post by a popular author costs one list update instead
+    of a write per follower. Lists are loaded in bulk by the loaders
+    registered for each kind of source and expire after FEED_SOURCE_TTL
+    seconds, which bounds how stale another worker's view can be.
+    """
+
+    def __init__(self, app=None):
+        self.loaders = {}
+        self.size = 100
+        self._sources = TTLCache()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config['FEED_SOURCE_SIZE']
+        self._sources = TTLCache(
+            maxsize=app.config['FEED_SOURCES'],
+            ttl=app.config['FEED_SOURCE_TTL'])
+
+    def loader(self, kind):
+        """
+        Register the bulk loader of a kind of source. It is called with
+        a list of ids and the list size, and returns a dict of id to the
+        newest (created_on, post_id) pairs, newest first.
+        """
+        def decorator(func):
+            self.loaders[kind] = func
+            return func
+        return decorator
+
+    def load(self, sources):
+        """
+        Get the lists of many sources, loading the missing ones with one
+        call per kind.
+
+        :param sources: list of (kind, id) tuples
+        :return: list of lists, in the same order as sources
+        """
+        lists = {}
+        missing = {}
+
+        for source in sources:
+            entries = self._sources.get(source)
+
+            if entries is None:
+                missing.setdefault(source[0], []).append(source[1])
+            else:
+                lists[source] = entries
+
+        for kind, ids in missing.items():
+            loaded = self.loaders[kind](ids, self.size)
+
+            for id in ids:
+                entries = loaded.get(id, [])
+                self._sources.set((kind, id), entries)
+                lists[(kind, id)] = entries
+
+        return [lists[source] for source in sources]
+
+    def push(self, source, created_on, post_id):
+        """
+        Add a new post to a source's list if it is cached, the loader
+        picks it up otherwise.
+        """
+        self._sources.replace(source, lambda entries: [
+            (created_on, post_id)] + entries[:self.size - 1])
+
+    def forget(self, source):
+        self._sources.pop(source)
+
+    def clear(self):
+        self._sources.clear()
+
+    def merge(self, sources, before=None, limit=20):
+        """
+        Merge the lists of sources into one page of a feed.
+
+        :param sources: list of (kind, id) tuples the viewer follows
+        :param before: only return posts older than this datetime
+        :param limit: page size
+        :return: up to limit + 1 (created_on, post_id) pairs, newest
+            first, or None when the cached lists cannot tell what the
+            page holds and the caller must fall back to the database
+        """
+        lists = self.load(sources)
+        merged = heapq.merge(*lists, key=itemgetter(0), reverse=True)
+        page = []
+        seen = set()
+
+        for created_on, post_id in merged:
+            if before is not None and created_on >= before:
+                continue
+            if post_id in seen:
+                continue
+
+            seen.add(post_id)
+            page.append((created_on, post_id))
+
+            if len(page) > limit:
+                break
+
+        # a full list only covers its source down to its oldest entry
+        boundary = page[-1][0] if len(page) > limit else None
+
+        for entries in lists:
+            if len(entries) >= self.size and (
+                    boundary is None or entries[-1][0] > boundary):
+                return None
+
+        return page
+
+    def stats(self):
+        return self._sources.stats()
+
+
+feed = FeedEngine()
@@ -0,0 +1,307 @@
+import re
+import time
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def tokenize(text):
+    return re.findall(r'\w+', text.casefold())
+
+
+def trigrams(term):
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+class TextIndex(object):
+    """
+    An in-memory search-as-you-type index.
+
+    Prefixes are looked up in a sorted array of terms, with the id of
+    each term's document in a parallel int array. It serves the same
+    purpose as a trie in a fraction of the memory: every term starting
+    with a prefix sits in one contiguous range found by binary search,
+    with exact matches first. Entries of the same term are sorted by id,
+    so one is found by binary search too. Words that only match in the
+    middle are found through trigram postings, also kept as int arrays
+    and cleaned up lazily.
+
+    Searches and changes take the same lock, the arrays are changed in
+    more than one step.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.terms = []
+        self.ids = array('i')
+        self.trigrams = {}
+        self.postings = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def load(self, docs):
+        """
+        Build the index in one pass.
+
+        :param docs: iterable of (id, dict of text fields)
+        """
+        with self._lock:
+            entries = []
+
+            for id, doc in docs:
+                self.docs[id] = self._terms(doc)
+                entries.extend((term, id) for term in self.docs[id])
+
+            entries.sort()
+            self.terms = [term for term, _ in entries]
+            self.ids = array('i', (id for _, id in entries))
+            self._build_trigrams()
+
+    def add(self, id, doc):
+        """Index a document, replacing the previous version of it."""
+        with self._lock:
+            self._remove(id)
+            self.docs[id] = self._terms(doc)
+
+            for term in self.docs[id]:
+                i = self._position(term, id)
+                self.terms.insert(i, term)
+                self.ids.insert(i, id)
+
+                for gram in trigrams(term):
+                    self.trigrams.setdefault(gram, array('i')).append(id)
+                    self.postings += 1
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def search(self, query, limit=10, scan=1000):
+        """
+        Find the documents with a term starting with every word of a
+        query.
+
+        :param query: Search-as-you-type text
+        :param limit: Maximum number of ids to return
+        :param scan: Maximum number of prefix matches to look at
+        :return: list of ids, exact and prefix matches first
+        """
+        words = tokenize(query)
+
+        if not words:
+            return []
+
+        with self._lock:
+            return self._search(words, limit, scan)
+
+    def _search(self, words, limit, scan):
+        # the longest word has the fewest terms starting with it
+        last = max(words, key=len)
+        others = [word for word in words if word is not last]
+        results = []
+        seen = set()
+        terms = self.terms
+        i = bisect_left(terms, last)
+        end = min(len(terms), i + scan)
+
+        while i < end and len(results) < limit:
+            if not terms[i].startswith(last):
+                break
+
+            id = self.ids[i]
+            i += 1
+
+            if id in seen:
+                continue
+
+            seen.add(id)
+            if self._matches(id, others):
+                results.append(id)
+
+        if len(results) < limit and len(last) >= 3:
+            for id in self._infix(last):
+                if len(results) >= limit:
+                    break
+                if id not in seen and self._matches(id, others):
+                    seen.add(id)
+                    results.append(id)
+
+        return results
+
+    def _terms(self, doc):
+        # numbers and dates are ranking signals, not text
+        return tuple(sorted({
+            term for value in doc.values() if isinstance(value, str)
+            for term in tokenize(value)}))
+
+    def _matches(self, id, words):
+        terms = self.docs.get(id, ())
+        return all(any(term.startswith(word) for term in terms)
+                   for word in words)
+
+    def _infix(self, word):
+        grams = sorted(
+            (self.trigrams.get(gram, ()) for gram in trigrams(word)),
+            key=len)
+
+        if not grams or not grams[0]:
+            return []
+
+        ids = set(grams[0]).intersection(*grams[1:])
+        return sorted(
+            id for id in ids
+            if any(word in term for term in self.docs.get(id, ())))
+
+    def _position(self, term, id):
+        '''Where the entry of a term and id is, or would be inserted.'''
+        return bisect_left(
+            self.ids, id, bisect_left(self.terms, term),
+            bisect_right(self.terms, term))
+
+    def _remove(self, id):
+        for term in self.docs.pop(id, ()):
+            i = self._position(term, id)
+
+            del self.terms[i]
+            del self.ids[i]
+            self.stale += len(trigrams(term))
+
+        # rebuild the postings once they hold more removed ids than live
+        if self.stale > self.postings - self.stale:
+            self._build_trigrams()
+
+    def _build_trigrams(self):
+        self.trigrams = {}
+        self.postings = 0
+        self.stale = 0
+
+        for id, terms in self.docs.items():
+            for term in terms:
+                for gram in trigrams(term):
+                    self.trigrams.setdefault(gram, array('i')).append(id)
+                    self.postings += 1
+
+
+class MemoryBackend(object):
+    """
+    Search backend keeping a TextIndex per search index in the process.
+
+    An index is loaded from the database on its first search and kept
+    current by the changes committed in this process. It is rebuilt in
+    the background every `ttl` seconds to pick up the changes made by
+    other processes, which this process serves up to `ttl` seconds late.
+    Changes committed while an index loads are replayed onto it before
+    it replaces the old one, so none is lost to a reload.
+
+    :param load: function returning the (id, doc) pairs of an index
+    :param submit: function running a callable in the background
+    """
+
+    def __init__(self, load, submit, ttl=600, scan=1000):
+        self.ttl = ttl
+        self.scan = scan
+        self.indexes = {}
+        self._load = load
+        self._submit = submit
+        self._loaded_at = {}
+        self._reloading = set()
+        # index -> changes committed since its load started
+        self._replay = {}
+        self._lock = threading.Lock()
+        self._updates_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config['SEARCH_MEMORY_TTL']
+
+    @property
+    def enabled(self):
+        '''Changes only need collecting once an index is loading.'''
+        return bool(self.indexes or self._replay)
+
+    def get(self, index):
+        """Get the TextIndex of an index, loading it when needed."""
+        text_index = self.indexes.get(index)
+
+        if text_index is None:
+            with self._lock:
+                if index not in self.indexes:
+                    self.load(index)
+                return self.indexes[index]
+
+        if time.monotonic() - self._loaded_at[index] > self.ttl and \
+                index not in self._reloading:
+            self._reloading.add(index)
+            self._submit(self.load, index)
+
+        return text_index
+
+    def load(self, index):
+        with self._updates_lock:
+            self._replay[index] = []
+
+        text_index = TextIndex()
+
+        try:
+            text_index.load(self._load(index))
+        except Exception:
+            with self._updates_lock:
+                self._replay.pop(index, None)
+            self._reloading.discard(index)
+            raise
+
+        with self._updates_lock:
+            for docs, removed in self._replay.pop(index):
+                self._apply(text_index, docs, removed)
+
+            self.indexes[index] = text_index
+            self._loaded_at[index] = time.monotonic()
+
+        self._reloading.discard(index)
+
+    def search(self, index, term, limit, after=None):
+        """
+        Pages are slices of the text matches, the cursor is the number
+        of hits already returned. Hits are ranked by text match only.
+        """
+        start = after[0] if after else 0
+        ids = self.get(index).search(term, start + limit + 1, self.scan)
+        after = (start + limit,) if len(ids) > start + limit else None
+
+        # only terms are kept, the documents are loaded by the caller
+        return [(id, None) for id in ids[start:start + limit]], \
+            len(ids), after
+
+    def search_many(self, indexes, term, limit, after=None):
+        return [self.search(index, term, limit, cursor) for index, cursor in
+                zip(indexes, after or [None] * len(indexes))]
+
+    def update(self, changes):
+        """
+        Apply committed changes to the loaded indexes, and keep them for
+        the indexes being loaded.
+
+        :param changes: dict of index to (dict of id to doc, removed ids)
+        """
+        with self._updates_lock:
+            for index, (docs, removed) in changes.items():
+                if index in self._replay:
+                    self._replay[index].append((docs, removed))
+
+                text_index = self.indexes.get(index)
+
+                if text_index is not None:
+                    self._apply(text_index, docs, removed)
+
+    @staticmethod
+    def _apply(text_index, docs, removed):
+        for id, doc in docs.items():
+            text_index.add(id, doc)
+        for id in removed:
+            text_index.remove(id)
+
+    def clear(self):
+        self.indexes.clear()
+        self._loaded_at.clear()
@@ -1,2 +1,6 @@
 from .resource import ResourceMixin
-from .search import SearchableMixin
+from .search import SearchableMixin, prefix_pattern, search_documents
+
+__all__ = [
+    'ResourceMixin', 'SearchableMixin', 'prefix_pattern', 'search_documents',
+]
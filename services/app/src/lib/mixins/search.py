@@ -1,59 +1,255 @@
+from flask import current_app
+
 from src import db
-from src.lib.search import add_to_index, remove_from_index, \
-    query_index, TagsIndex, UsersIndex
+from src.lib.cache import TTLCache
+from src.lib.search import indexer, query_index, query_indexes, \
+    get_backend, SearchUnavailable
+
+# documents recently queued by SearchableMixin.reindex
+reindexed = TTLCache(maxsize=10000)
+
+
+def search_documents(models, expression, after=None):
+    '''
+    Search the documents of several searchable models with a single
+    request, see SearchableMixin.search_documents.
+
+    :param after: list of the cursor of each model, or None
+    :return: list with the (hits, after) page found for each model, None
+        for a model whose index failed to answer
+    '''
+    try:
+        results = query_indexes(
+            [model.__search_index__ for model in models], expression, after)
+    except SearchUnavailable as e:
+        current_app.logger.warning(f'search fallback: {e}')
+        return [(model.fallback_documents(expression), None)
+                for model in models]
+
+    return [None if result is None else (
+        model.fill_documents(result[0]), result[2])
+        for model, result in zip(models, results)]
+
+
+def prefix_pattern(term):
+    '''A LIKE pattern matching strings that start with term.'''
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+    return f'{escaped}%'
 
 
 class SearchableMixin(object):
+    # the search Document class holding the model's rows
+    __search_index__ = None
+    # the text columns indexed and searched by default
+    __searchable__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        if cls.__dict__.get('__search_index__') is None:
+            return
+
+        # without columns both hooks have to be written by the model
+        if not cls.__searchable__ and (
+                cls.to_search_document is
+                SearchableMixin.to_search_document or
+                cls.search_fallback.__func__ is
+                SearchableMixin.search_fallback.__func__):
+            raise TypeError(
+                f'{cls.__name__} needs __searchable__ columns or its own '
+                'to_search_document and search_fallback')
+
+        indexer.register(cls.__search_index__, cls)
+
     @classmethod
     def search(cls, indexDoc, expression):
-        ids, total = query_index(indexDoc, expression)
+        '''
+        Search the rows of a model.
+
+        :return: list of model instances, best match first
+        '''
+        try:
+            hits, total, _ = query_index(indexDoc, expression)
+        except SearchUnavailable as e:
+            current_app.logger.warning(f'search fallback: {e}')
+            return cls.search_fallback(expression).limit(
+                current_app.config['SEARCH_RESULTS']).all()
 
         if total == 0:
             return []
 
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
+        when = [(id, i) for i, (id, _) in enumerate(hits)]
 
-        return cls.query.filter(cls.id.in_(ids)).order_by(
+        return cls.query.filter(cls.id.in_([id for id, _ in hits])).order_by(
             db.case(when, value=cls.id)).all()
 
     @classmethod
-    def reindex(cls, doc):
-        add_to_index(doc, cls)
+    def search_documents(cls, indexDoc, expression, after=None):
+        '''
+        Search the documents of a model, as stored in the index, so
+        results can be shown without loading the rows.
+
+        :param after: Cursor returned with the previous page
+        :return: (list of (id, document) pairs, best match first, cursor
+            of the next page or None)
+        '''
+        try:
+            hits, _, after = query_index(indexDoc, expression, after)
+        except SearchUnavailable as e:
+            current_app.logger.warning(f'search fallback: {e}')
+            return cls.fallback_documents(expression), None
+
+        return cls.fill_documents(hits), after
+
+    @classmethod
+    def fill_documents(cls, hits):
+        '''
+        Load, in one query, the documents of the hits of a backend that
+        does not store them.
+        '''
+        missing = [id for id, doc in hits if doc is None]
+
+        if missing:
+            docs = cls.get_search_documents(missing)
+            hits = [(id, doc if doc is not None else docs.get(id))
+                    for id, doc in hits]
+
+        return [(id, doc) for id, doc in hits if doc is not None]
+
+    @classmethod
+    def fallback_documents(cls, expression):
+        rows = cls.search_fallback(expression).limit(
+            current_app.config['SEARCH_RESULTS'])
+        return [(obj.id, obj.to_search_document()) for obj in rows]
+
+    @classmethod
+    def search_fallback(cls, expression):
+        '''
+        Query the database when the search cluster cannot answer. Only
+        prefixes are matched, escape them with prefix_pattern.
+
+        :return: query of matching rows, best first
+        '''
+        pattern = prefix_pattern(expression)
+        columns = [getattr(cls, name) for name in cls.__searchable__]
+
+        return cls.query.filter(db.or_(*[
+            column.ilike(pattern, escape='\\') for column in columns
+        ])).order_by(*columns)
+
+    @classmethod
+    def get_search_documents(cls, ids):
+        '''
+        Load the search documents of many rows in one query.
+
+        :param ids: Row ids
+        :return: dict of id to document fields, deleted rows are missing
+        '''
+        return cls._to_search_documents(
+            cls.query.filter(cls.id.in_(ids)).all())
+
+    @classmethod
+    def iter_search_documents(cls, after=0, batch_size=1000, since=None):
+        '''
+        Stream the (id, document) pairs of the rows with an id greater
+        than after, in id order, batch_size rows per query.
+
+        :param since: only stream the rows changed since this datetime
+        '''
+        query = cls.query.order_by(cls.id)
+
+        if since is not None:
+            query = query.filter(cls.search_changed_since(since))
+
+        while True:
+            rows = query.filter(cls.id > after).limit(batch_size).all()
+
+            if not rows:
+                return
+
+            after = rows[-1].id
+            yield from sorted(cls._to_search_documents(rows).items())
+
+    @classmethod
+    def _to_search_documents(cls, rows):
+        signals = cls.get_search_signals([obj.id for obj in rows])
+        docs = {}
+
+        for obj in rows:
+            doc = obj.to_search_document()
+
+            if doc is not None:
+                doc.update(signals.get(obj.id, {}))
+                docs[obj.id] = doc
+
+        return docs
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def get_search_signals(cls, ids):
+        '''
+        Load the ranking fields of many rows, counted from other tables,
+        with one query per field.
+
+        :return: dict of id to dict of fields
+        '''
+        return {}
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                if str(type(obj)) == 'User':
-                    add_to_index(UsersIndex, obj)
-                if str(type(obj)) == 'Tag':
-                    add_to_index(TagsIndex, obj)
+    def search_changed_since(cls, since):
+        '''Filter for the rows whose document may have changed since.'''
+        return cls.updated_on >= since
+
+    def to_search_document(self):
+        '''The indexed fields of a row, or None to leave it out.'''
+        return {name: getattr(self, name) for name in self.__searchable__}
+
+    def get_search_keys(self):
+        '''The (index, id) of the search documents showing this row.'''
+        return [(self.__search_index__, self.id)]
+
+    def reindex(self):
+        '''
+        Index the documents of self on commit, for changes that do not
+        touch its row such as the ones to its ranking fields.
+
+        A document is reindexed this way at most once per
+        SEARCH_SIGNALS_INTERVAL seconds in a process, every reindex drops
+        the cached searches of its whole index, so ranking fields lag by
+        up to that long rather than each post or follow emptying the cache.
+        '''
+        interval = current_app.config['SEARCH_SIGNALS_INTERVAL']
+        keys = [key for key in self.get_search_keys()
+                if key not in reindexed]
+
+        for key in keys:
+            reindexed.set(key, True, ttl=interval)
+
+        db.session.info.setdefault('search', set()).update(keys)
+
+    @staticmethod
+    def collect_changes(session, flush_context):
+        '''Remember the search documents touched by a flush.'''
+        changes = session.info.setdefault('search', set())
+
+        for obj in session.new | session.dirty | session.deleted:
+            get_search_keys = getattr(obj, 'get_search_keys', None)
+
+            if get_search_keys is not None:
+                changes.update(get_search_keys())
+
+    @staticmethod
+    def after_commit(session):
+        changes = session.info.pop('search', None)
 
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                if str(type(obj)) == 'User':
-                    add_to_index(UsersIndex, obj)
-                if str(type(obj)) == 'Tag':
-                    add_to_index(TagsIndex, obj)
+        if changes and get_backend().enabled:
+            indexer.enqueue(changes)
 
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                if str(type(obj)) == 'User':
-                    remove_from_index(UsersIndex, obj)
-                if str(type(obj)) == 'Tag':
-                    remove_from_index(TagsIndex, obj)
-        session._changes = None
+    @staticmethod
+    def discard_changes(session):
+        session.info.pop('search', None)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.collect_changes)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.discard_changes)
@@ -1,10 +1,38 @@
+import os
+import threading
+from datetime import datetime
+from itertools import islice
+
 from flask import current_app
-from elasticsearch_dsl.query import MultiMatch
-from elasticsearch_dsl import SearchAsYouType, Document, connections
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ElasticsearchException
+from elasticsearch.helpers import bulk, parallel_bulk, scan
+from elasticsearch_dsl.query import FunctionScore, MultiMatch
+from elasticsearch_dsl import SearchAsYouType, Document, Keyword, \
+    MultiSearch, Integer, Date, Q, SF
+
+from src.lib.breaker import CircuitBreaker, CircuitOpenError
+from src.lib.cache import TTLCache
+from src.lib.memsearch import MemoryBackend, tokenize
+from src.lib.worker import BackgroundWorker
+
+
+class SearchUnavailable(Exception):
+    pass
 
 
 class TagsIndex(Document):
     name = SearchAsYouType(max_shingle_size=3)
+    # ranking signals
+    posts = Integer()
+    # tiebreaker of the sort, set by the backend
+    id = Integer()
+
+    search_fields = ['name', 'name._2gram', 'name._3gram']
+    # boosts of the text score, busier tags first
+    search_functions = [
+        SF('field_value_factor', field='posts', modifier='ln2p', missing=0),
+    ]
 
     class Index:
         name = "tags"
@@ -14,45 +42,658 @@ class TagsIndex(Document):
 class UsersIndex(Document):
     name = SearchAsYouType(max_shingle_size=3)
     username = SearchAsYouType(max_shingle_size=3)
+    # only displayed
+    avatar = Keyword(index=False)
+    # ranking signals
+    followers = Integer()
+    active_on = Date()
+    # tiebreaker of the sort, set by the backend
+    id = Integer()
+
+    search_fields = [
+        'name', 'name._2gram', 'name._3gram',
+        'username', 'username._2gram', 'username._3gram']
+    # boosts of the text score, popular and recently active users first,
+    # users who never posted get no recency boost rather than the full one
+    # decay functions give a missing field
+    search_functions = [
+        SF('field_value_factor', field='followers', modifier='ln2p',
+           missing=0),
+        SF('gauss', filter=Q('exists', field='active_on'),
+           active_on={'origin': 'now', 'scale': '30d', 'decay': 0.5}),
+    ]
 
     class Index:
         name = "users"
         settings = {"number_of_shards": 1, "number_of_replicas": 0}
 
 
-def add_to_index(doc, model):
-    connections.create_connection(hosts=current_app.search_host, timeout=60)
-    doc.init()
+class SearchClient(object):
+    """
+    The Elasticsearch client of the process.
 
-    if model.__tablename__ == 'users':
-        for i in model.query:
-            doc(_id=i.id, name=i.profile.name,
-                username=i.profile.username).save()
-    else:
-        for i in model.query:
-            doc(_id=i.id, name=i.name).save()
+    It holds a pool of SEARCH_POOL_SIZE connections shared by all
+    threads, created on first use so every forked worker gets its own.
+    Calls time out after SEARCH_TIMEOUT seconds and go through a circuit
+    breaker: once SEARCH_BREAKER_FAILURES calls in a row have failed,
+    searches fail fast with SearchUnavailable for SEARCH_BREAKER_RESET
+    seconds instead of waiting on an unhealthy cluster.
+    """
+
+    def __init__(self, app=None):
+        self.hosts = None
+        self.timeout = 0.5
+        self.pool_size = 10
+        self.breaker = CircuitBreaker()
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['ELASTICSEARCH_URL']:
+            self.hosts = [app.config['ELASTICSEARCH_URL']]
+        elif app.config['ES_HOST']:
+            self.hosts = [{
+                'host': app.config['ES_HOST'],
+                'port': int(app.config['ES_PORT'] or 9200)}]
+
+        self.timeout = app.config['SEARCH_TIMEOUT']
+        self.pool_size = app.config['SEARCH_POOL_SIZE']
+        self.breaker = CircuitBreaker(
+            failures=app.config['SEARCH_BREAKER_FAILURES'],
+            reset_timeout=app.config['SEARCH_BREAKER_RESET'])
+
+    @property
+    def enabled(self):
+        return bool(self.hosts) or self._client is not None
+
+    def use(self, client):
+        """Replace the client, e.g. with a stub in tests."""
+        with self._lock:
+            self._client = client
+            self._pid = os.getpid()
+        self.breaker.reset()
+
+    def get_client(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = Elasticsearch(
+                    self.hosts, timeout=self.timeout,
+                    maxsize=self.pool_size, max_retries=0,
+                    retry_on_timeout=False)
+                self._pid = os.getpid()
+
+            return self._client
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(client, *args, **kwargs) through the circuit breaker.
+
+        :raises SearchUnavailable: when search is not configured, the
+            circuit is open or the call fails
+        """
+        if not self.enabled:
+            raise SearchUnavailable('Search is not configured.')
 
-    doc._index.refresh()
+        try:
+            return self.breaker.call(
+                func, self.get_client(), *args, **kwargs)
+        except CircuitOpenError:
+            raise SearchUnavailable('Search is unavailable.')
+        except ElasticsearchException as e:
+            raise SearchUnavailable(str(e)) from e
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+search_client = SearchClient()
+
+
+def get_write_alias(index):
+    """The alias live changes to an index are written to."""
+    return f'{index._index._name}-write'
+
+
+def ensure_index(es, index):
+    """
+    Give an index its write alias before anything is written to it,
+    otherwise Elasticsearch would create a concrete index under that name
+    which searches never read. The alias goes to the index searched now,
+    or to a first version when there is none; its name is fixed so that
+    processes racing to create it end up sharing it.
+
+    :param es: Elasticsearch client
+    :param index: Document class of the index
+    """
+    alias = index._index._name
+    write_alias = get_write_alias(index)
+
+    if es.indices.exists_alias(name=write_alias):
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
 
+    if es.indices.exists(index=alias):
+        # the read alias, or an index created before aliases were used
+        target = sorted(es.indices.get(index=alias))[-1]
+        actions = [{'add': {'index': target, 'alias': write_alias}}]
+    else:
+        target = f'{alias}-{0:020}'
+        index._index.clone(target).create(using=es, ignore=400)
+        actions = [
+            {'add': {'index': target, 'alias': alias}},
+            {'add': {'index': target, 'alias': write_alias}},
+        ]
+
+    # created by a write that came first, it only held unsearched copies
+    if es.indices.exists(index=write_alias):
+        actions.append({'remove_index': {'index': write_alias}})
+
+    es.indices.update_aliases(body={'actions': actions})
+
+
+def create_index_version(index):
+    """
+    Create a new physical index for a Document class to be rebuilt
+    into. Its name is the read alias followed by a timestamp, and it has
+    no replicas and no refreshes until it is published, so bulk loading
+    runs at full speed without touching the serving index.
+
+    :param index: Document class of the index
+    :return: the name of the new index
+    """
+    es = search_client.get_client()
+    name = f'{index._index._name}-{datetime.utcnow():%Y%m%d%H%M%S%f}'
+    index._index.clone(name).settings(
+        number_of_replicas=0, refresh_interval='-1').create(using=es)
+
+    return name
+
+
+def publish_index_version(index, name):
+    """
+    Switch the read and write aliases of a Document class to a rebuilt
+    index in one atomic request, then drop all but the newest
+    SEARCH_INDEX_VERSIONS_KEPT versions.
+
+    :param index: Document class of the index
+    :param name: Physical index made by create_index_version
+    """
+    es = search_client.get_client()
+    alias = index._index._name
+    write_alias = get_write_alias(index)
+    timeout = current_app.config['SEARCH_INDEX_TIMEOUT']
+    settings = index._index._settings
+
+    es.indices.put_settings(index=name, request_timeout=timeout, body={
+        'index': {
+            'number_of_replicas': settings.get('number_of_replicas', 1),
+            'refresh_interval': None,
+        }})
+    es.indices.refresh(index=name, request_timeout=timeout)
+
+    actions = [
+        {'add': {'index': name, 'alias': alias}},
+        {'add': {'index': name, 'alias': write_alias}},
+    ]
+
+    current = es.indices.get_alias(
+        name=f'{alias},{write_alias}', ignore=404)
+    # a missing alias adds error and status keys to the response
+    for old in set(current) - {name, 'error', 'status'}:
+        actions.append({'remove': {'index': old, 'alias': '*'}})
+
+    # an index created before aliases were used holds the alias's name,
+    # and one auto-created by a write can hold the write alias's name
+    for concrete in (alias, write_alias):
+        if es.indices.exists(index=concrete) and not es.indices.exists_alias(
+                name=concrete):
+            actions.append({'remove_index': {'index': concrete}})
+
+    es.indices.update_aliases(
+        body={'actions': actions}, request_timeout=timeout)
+
+    versions = sorted((
+        version for version in es.indices.get(index=f'{alias}-*')
+        if version[len(alias) + 1:].isdigit()), reverse=True)
+    for old in versions[current_app.config['SEARCH_INDEX_VERSIONS_KEPT']:]:
+        es.indices.delete(index=old, request_timeout=timeout)
+
+
+def to_source(id, doc):
+    """The _source of a document, with the id the results are sorted by."""
+    return dict(doc, id=id)
+
+
+def bulk_index(name, docs, workers=4, chunk_size=500):
+    """
+    Send documents to an index with parallel bulk requests.
+
+    :param name: Name of the index
+    :param docs: iterable of (id, document) pairs, e.g. from
+        SearchableMixin.iter_search_documents
+    :param workers: Number of bulk requests in flight
+    :param chunk_size: Documents per bulk request
+    :return: generator of the indexed ids, in the order of docs
+    """
+    es = search_client.get_client()
+    actions = (
+        {'_index': name, '_id': id, '_source': to_source(id, doc)}
+        for id, doc in docs)
+
+    for _, item in parallel_bulk(
+            es, actions, thread_count=workers, chunk_size=chunk_size,
+            request_timeout=current_app.config['SEARCH_INDEX_TIMEOUT']):
+        yield int(item['index']['_id'])
+
+
+def prune_index(name, model, batch_size=1000):
+    """
+    Delete the documents of an index whose rows no longer exist, such as
+    rows deleted while the index was rebuilt, which the live indexer
+    deleted from the version being replaced.
+
+    :param name: Name or alias of the index
+    :param model: SearchableMixin model of the index
+    :param batch_size: Ids checked against the database per query
+    :return: number of documents deleted
+    """
+    es = search_client.get_client()
+    timeout = current_app.config['SEARCH_INDEX_TIMEOUT']
+    hits = scan(es, index=name, query={'_source': False}, size=batch_size,
+                request_timeout=timeout)
+    deleted = 0
+
+    while True:
+        ids = [int(hit['_id']) for hit in islice(hits, batch_size)]
+
+        if not ids:
+            return deleted
+
+        existing = {id for id, in model.query.with_entities(
+            model.id).filter(model.id.in_(ids))}
+        removed = [id for id in ids if id not in existing]
+
+        if removed:
+            bulk(es, ({'_op_type': 'delete', '_index': name, '_id': id}
+                      for id in removed),
+                 raise_on_error=False, request_timeout=timeout)
+            deleted += len(removed)
+
+
+class Indexer(object):
+    """
+    Push changed rows to their search index in the background.
+
+    Changes are (index, id) pairs collected from committed transactions.
+    They are deduplicated while waiting, and each batch reloads the rows
+    with one query per model before handing them to the search backend:
+    rows that still exist are indexed, the others are deleted. A batch
+    that fails is queued again and retried after `retry_delay` seconds,
+    or sooner with the next change.
+    """
+
+    def __init__(self, app=None):
+        self.models = {}
+        self.retry_delay = 30
+        self.worker = BackgroundWorker('search-indexer')
+        self._pending = {}
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.worker.init_app(app)
+        self.retry_delay = app.config['SEARCH_BREAKER_RESET']
+
+    def register(self, index, model):
+        """Set the model whose rows are the documents of an index."""
+        self.models[index] = model
+
+    def enqueue(self, changes):
+        """
+        Schedule changes for indexing.
+
+        :param changes: iterable of (index, id) pairs
+        """
+        with self._lock:
+            for index, id in changes:
+                self._pending.setdefault(index, set()).add(id)
+
+            if self._scheduled or not self._pending:
+                return
+
+            self._scheduled = True
+
+        self.worker.submit(self.flush)
+
+    def flush(self):
+        """Index everything pending, called on the worker thread."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._scheduled = False
+
+        if not pending:
+            return
+
+        changes = {}
+
+        try:
+            for index, ids in pending.items():
+                docs = self.models[index].get_search_documents(ids)
+                changes[index] = (docs, ids.difference(docs))
+
+            get_backend().update(changes)
+        except Exception:
+            self._requeue(pending)
+            raise
+
+        for index in changes:
+            query_cache.invalidate(index)
+
+    def _requeue(self, pending):
+        with self._lock:
+            for index, ids in pending.items():
+                self._pending.setdefault(index, set()).update(ids)
+
+        retry = threading.Timer(self.retry_delay, self.enqueue, args=[()])
+        retry.daemon = True
+        retry.start()
+
+
+indexer = Indexer()
+
+
+class ElasticsearchBackend(object):
+    """Search backend sending queries and changes to Elasticsearch."""
+
+    def __init__(self):
+        # indexes whose write alias is known to exist
+        self._ready = set()
+
+    @property
+    def enabled(self):
+        return search_client.enabled
+
+    def _search(self, index, term, limit, after=None):
+        # one extra hit tells whether there is a next page
+        s = index.search()[:limit + 1].sort('_score', {'id': 'asc'})
+        s.query = FunctionScore(
+            query=MultiMatch(
+                query=term, type="bool_prefix", fields=index.search_fields),
+            functions=index.search_functions,
+            score_mode='sum', boost_mode='multiply')
+
+        if after is not None:
+            s = s.extra(search_after=list(after))
+
+        # past the deadline shards return what they found so far
+        return s.extra(timeout=f'{int(search_client.timeout * 1000)}ms')
+
+    def _hits(self, response, limit):
+        hits = list(response)[:limit + 1]
+        after = tuple(hits[limit - 1].meta.sort) \
+            if len(hits) > limit else None
+        docs = [(int(hit.meta.id), hit.to_dict()) for hit in hits[:limit]]
+
+        for _, doc in docs:
+            doc.pop('id', None)
+
+        return docs, response.hits.total.value, after
+
+    def search(self, index, term, limit, after=None):
+        s = self._search(index, term, limit, after)
+        return self._hits(search_client.call(
+            lambda es: s.using(es).execute()), limit)
+
+    def search_many(self, indexes, term, limit, after=None):
+        """
+        Search several indexes with a single msearch request, so the
+        latency is the one of the slowest search rather than the sum.
+
+        :param after: list of the cursor of each index, or None
+        :return: list of (hits, total, after) per index, None for an
+            index whose search failed
+        """
+        ms = MultiSearch()
+
+        for index, cursor in zip(indexes, after or [None] * len(indexes)):
+            ms = ms.add(self._search(index, term, limit, cursor))
+
+        responses = search_client.call(
+            lambda es: ms.using(es).execute(raise_on_error=False))
+
+        return [None if response is None else self._hits(response, limit)
+                for response in responses]
+
+    def update(self, changes):
+        """
+        Index and delete documents with a single bulk request.
+
+        :param changes: dict of index to (dict of id to doc, removed ids)
+        """
+        actions = []
+
+        for index, (docs, removed) in changes.items():
+            if index not in self._ready:
+                search_client.call(ensure_index, index)
+                self._ready.add(index)
+
+            name = get_write_alias(index)
+            actions.extend({
+                '_op_type': 'index', '_index': name, '_id': id,
+                '_source': to_source(id, doc)} for id, doc in docs.items())
+            actions.extend({
+                '_op_type': 'delete', '_index': name, '_id': id}
+                for id in removed)
+
+        # deleting a row that was never indexed is not an error
+        _, errors = search_client.call(
+            bulk, actions, raise_on_error=False, raise_on_exception=False,
+            request_timeout=current_app.config['SEARCH_INDEX_TIMEOUT'])
+
+        for error in errors:
+            if error.get('delete', {}).get('status') != 404:
+                current_app.logger.error(f'search indexing failed: {error}')
+
+
+elasticsearch_backend = ElasticsearchBackend()
+memory_backend = MemoryBackend(
+    load=lambda index: indexer.models[index].iter_search_documents(),
+    submit=indexer.worker.submit)
+
+
+def get_backend():
+    """Get the search backend named by SEARCH_BACKEND."""
+    if current_app.config['SEARCH_BACKEND'] == 'memory':
+        return memory_backend
+    return elasticsearch_backend
+
+
+class QueryCache(object):
+    """
+    Remember the results of recent searches for SEARCH_CACHE_TTL seconds.
+
+    Queries are normalized, so "Ada " and "ada" share an entry. A query
+    extending the last word of a cached one, e.g. "adam" after "ada",
+    is answered by filtering the cached hits when they hold every match,
+    i.e. fewer than a page. Later pages are cached by their cursor.
+    Changing an index bumps its generation, which makes all of its
+    entries unreachable at once. A search is cached under the generation
+    read before it ran, so a result that may predate a change is dropped.
+    """
+
+    def __init__(self, app=None):
+        self.limit = 10
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._entries = TTLCache()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limit = app.config['SEARCH_RESULTS']
+        self._entries = TTLCache(
+            maxsize=app.config['SEARCH_CACHE_SIZE'],
+            ttl=app.config['SEARCH_CACHE_TTL'])
+
+    @staticmethod
+    def normalize(term):
+        return ' '.join(term.casefold().split())
+
+    def _key(self, index, generation, term, after=None):
+        return index, generation, term, after
+
+    def get(self, index, term, after=None):
+        """
+        :param term: Normalized query
+        :param after: Cursor of the page
+        :return: (cached (hits, total, after) or None, generation of the
+            index to pass to set with the result of a miss)
+        """
+        with self._lock:
+            generation = self._generations.get(index, 0)
+
+        result = self._entries.get(
+            self._key(index, generation, term, after), count=False)
+
+        if result is not None:
+            self._count('hits')
+            return result, generation
+
+        if after is None and ' ' not in term:
+            for end in range(len(term) - 1, 0, -1):
+                result = self._entries.get(
+                    self._key(index, generation, term[:end]), count=False)
+
+                if result is not None:
+                    result = self._narrow(result, term)
+
+                    if result is not None:
+                        self._count('prefix_hits')
+                        self.set(index, term, result, generation=generation)
+                        return result, generation
+                    break
+
+        self._count('misses')
+        return None, generation
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _narrow(self, result, term):
+        hits, total, after = result
+
+        if total >= self.limit or after is not None or any(
+                doc is None for _, doc in hits):
+            return None
+
+        hits = [(id, doc) for id, doc in hits if any(
+            word.startswith(term) for value in doc.values()
+            if isinstance(value, str) for word in tokenize(value))]
+        return hits, len(hits), None
+
+    def set(self, index, term, result, after=None, generation=None):
+        """
+        :param generation: Generation returned by get before the search,
+            a result found before an invalidation is not cached
+        """
+        with self._lock:
+            current = self._generations.get(index, 0)
+
+        if generation is None or generation == current:
+            self._entries.set(self._key(index, current, term, after), result)
+
+    def invalidate(self, index):
+        with self._lock:
+            self._generations[index] = self._generations.get(index, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, prefix_hits, misses = \
+                self.hits, self.prefix_hits, self.misses
+
+        lookups = hits + prefix_hits + misses
+        return {
+            'size': len(self._entries),
+            'hits': hits,
+            'prefixHits': prefix_hits,
+            'misses': misses,
+            'hitRate': (hits + prefix_hits) / lookups if lookups else 0.0,
+        }
+
+
+query_cache = QueryCache()
+
+
+def query_index(index, term, after=None):
+    """
+    Search an index, one page of SEARCH_RESULTS hits at a time.
+
+    :param index: Document class of the index
+    :param term: Search-as-you-type text
+    :param after: Cursor returned with the previous page
+    :return: (list of (id, document) ordered by relevance, number of
+        results, cursor of the next page or None on the last one), the
+        documents are None when the backend does not store them
+    :raises SearchUnavailable: when the cluster cannot answer in time
+    """
+    term = QueryCache.normalize(term)
+    after = tuple(after) if after is not None else None
+    result, generation = query_cache.get(index, term, after)
+
+    if result is None:
+        result = get_backend().search(
+            index, term, current_app.config['SEARCH_RESULTS'], after)
+        query_cache.set(index, term, result, after, generation)
+
+    return result
+
+
+def query_indexes(indexes, term, after=None):
+    """
+    Search several indexes at once.
+
+    :param indexes: list of Document classes
+    :param term: Search-as-you-type text
+    :param after: list of the cursor of each index, or None
+    :return: list of (hits, total, after) like query_index per index,
+        None for an index whose search failed
+    :raises SearchUnavailable: when the cluster cannot answer in time
+    """
+    term = QueryCache.normalize(term)
+    after = {index: tuple(cursor) if cursor is not None else None
+             for index, cursor in zip(indexes, after or [None] * len(
+                 indexes))}
+    cached = [query_cache.get(index, term, after[index])
+              for index in indexes]
+    results = [result for result, _ in cached]
+    generations = {index: generation
+                   for index, (_, generation) in zip(indexes, cached)}
+    missing = [index for index, result in zip(indexes, results)
+               if result is None]
+
+    if missing:
+        found = dict(zip(missing, get_backend().search_many(
+            missing, term, current_app.config['SEARCH_RESULTS'],
+            [after[index] for index in missing])))
 
-def query_index(index, term):
-    connections.create_connection(hosts=current_app.search_host, timeout=20)
-    results = []
+        for index, result in found.items():
+            # failed searches are not cached
+            if result is not None:
+                query_cache.set(
+                    index, term, result, after[index], generations[index])
 
-    try:
-        s = index.search()
-        s.query = MultiMatch(query=term, type="bool_prefix", fields=["*"])
-        response = s.execute()
-    except Exception as e:
-        print(e)
-        return None
+        results = [found[index] if result is None else result
+                   for index, result in zip(indexes, results)]
 
-    for res in response:
-        results.append(res.meta.id)
-    return results, len(response)
+    return results
@@ -0,0 +1,50 @@
+import queue
+import threading
+
+
+class BackgroundWorker(object):
+    """
+    Run functions on a daemon thread, inside an application context, so
+    slow work such as talking to Elasticsearch stays off the request
+    thread.
+    """
+
+    def __init__(self, name, app=None):
+        self.name = name
+        self.app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), starting the thread if needed."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+        self._queue.put((func, args, kwargs))
+
+    def join(self):
+        """Block until every queued function has run."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+
+            # the session is removed when the app context is torn down
+            try:
+                with self.app.app_context():
+                    func(*args, **kwargs)
+            except Exception:
+                self.app.logger.exception(f'{self.name} task failed')
+            finally:
+                self._queue.task_done()
@@ -2,7 +2,8 @@ import pytest
 
 from src import create_app, db as _db
 from src.config import TestingConfig
-from src.tests.utils import add_user, add_post
+from src.lib.search import query_cache, search_client
+from src.tests.utils import add_user, add_post, StubElasticsearch
 from src.blueprints.users.models import User
 from src.blueprints.posts.models import Post
 
@@ -141,7 +142,27 @@ def posts(db, session, users):
         'Ut enim ad minim veniam, quis nostrud exercitation ', u2, p1.id)
     add_post(
         'ullamco laboris nisi ut aliquip ex ea commodo consequat.', u3, p3.id)
-    p1.likes.append(u1)
-    p2.likes.append(u1)
+    p1.add_like(u1)
+    p2.add_like(u1)
 
     return db
+
+
+@pytest.fixture(scope='function')
+def search_stub(app):
+    """
+    Serve searches from an in-memory stub instead of Elasticsearch.
+
+    :param app: Pytest fixture
+    :return: StubElasticsearch
+    """
+    stub = StubElasticsearch()
+    search_client.use(stub)
+    query_cache.clear()
+    app.config['SEARCH_BACKEND'] = 'elasticsearch'
+
+    yield stub
+
+    app.config['SEARCH_BACKEND'] = 'memory'
+    query_cache.clear()
+    search_client.use(None)
@@ -1,5 +1,9 @@
 import json
 
+from src import db
+from src.lib.auth import load_principal
+from src.blueprints.users.models import User
+
 
 def test_check_email_does_not_exist(client, users):
     response = client.post(
@@ -130,3 +134,28 @@ def test_get_user(client, token):
     assert response.status_code == 200
     assert isinstance(data, dict) is True
     assert data.get('profile')['name'] == 'admin'
+
+
+def test_principal_cache(users):
+    user = User.find_by_email('regularuser@test.com')
+    principal = load_principal(user.id)
+    assert principal.username == 'regularuser'
+    assert principal.email == 'regularuser@test.com'
+
+    user.profile.name = 'irregular'
+    db.session.commit()
+    assert load_principal(user.id).name == 'irregular'
+
+
+def test_principal_writes_user(client, users):
+    user = User.find_by_email('regularuser@test.com')
+    read_time = user.last_notif_read_time
+    response = client.get(
+        '/notifications?cursor=0',
+        headers={'Authorization': f'Bearer {user.encode_auth_token()}'}
+    )
+    assert response.status_code == 200
+
+    db.session.expire_all()
+    assert User.find_by_email(
+        'regularuser@test.com').last_notif_read_time != read_time
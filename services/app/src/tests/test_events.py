@@ -0,0 +1,99 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from src import db
+from src.lib.events import EventBus, StreamLimitReached, events
+
+
+# without NOTIFY, events are kept in the session until it commits
+not_postgres = SimpleNamespace(dialect=SimpleNamespace(name='sqlite'))
+
+
+def test_events_delivered_after_commit(app, monkeypatch):
+    monkeypatch.setattr(db.session, 'get_bind', lambda: not_postgres)
+    queue = events.subscribe(1)
+
+    try:
+        events.publish(1, 'read', {'chatId': 2})
+        db.session.rollback()
+        assert queue.empty()
+
+        events.publish_many([(1, 'read', {'chatId': 3}),
+                             (2, 'read', {'chatId': 3})])
+        assert queue.empty()
+        db.session.commit()
+        assert queue.get(timeout=1) == {
+            'event': 'read', 'data': {'chatId': 3}}
+        assert queue.empty()
+    finally:
+        events.unsubscribe(1, queue)
+
+
+def test_collect_events(app):
+    row = SimpleNamespace(get_events=lambda: [(1, 'message', {'id': 4})])
+    session = SimpleNamespace(
+        new=[row, object()], info={}, get_bind=lambda: not_postgres)
+
+    EventBus.collect_events(session, None)
+    assert session.info['events'] == [
+        '1:{"event": "message", "data": {"id": 4}}']
+
+
+def test_stream(app):
+    bus = EventBus(app)
+    bus.keepalive = 0.01
+    stream = bus.stream(1)
+
+    assert next(stream) == ': keepalive\n\n'
+    bus.deliver('1:{"event": "read", "data": {"chatId": 2}}')
+    assert next(stream) == 'event: read\ndata: {"chatId": 2}\n\n'
+
+    stream.close()
+    assert bus._streams == {} and bus._count == 0
+
+
+def test_stream_backlog(app):
+    bus = EventBus(app)
+    bus.backlog = 1
+    queue = bus.subscribe(1)
+
+    bus.deliver('1:{"event": "read", "data": {}}')
+    bus.deliver('1:{"event": "message", "data": {}}')
+    assert queue.qsize() == 1 and queue.get()['event'] == 'read'
+    # events of users without a stream are not even decoded
+    bus.deliver('2:not json')
+
+
+def test_stream_limit(app, client, token, monkeypatch):
+    bus = EventBus(app)
+    bus.max_streams = 1
+    bus.subscribe(1)
+
+    with pytest.raises(StreamLimitReached):
+        bus.stream(1)
+
+    monkeypatch.setattr(events, 'max_streams', 0)
+    response = client.get(
+        '/events', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 503
+
+
+def test_events_token(client, token, users, monkeypatch):
+    # the test client reads the first chunk of the stream
+    monkeypatch.setattr(events, 'keepalive', 0.01)
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post('/events/token', headers=headers)
+    assert response.status_code == 200
+    stream_token = json.loads(response.data.decode())['token']
+
+    # regular tokens stay out of URLs, stream tokens out of other routes
+    assert client.get(f'/events?token={token}').status_code == 401
+    assert client.get('/notifications/count', headers={
+        'Authorization': f'Bearer {stream_token}'}).status_code == 401
+
+    response = client.get(f'/events?token={stream_token}')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    response.close()
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+from src.lib.feed import FeedEngine
+
+
+now = datetime(2021, 1, 1)
+
+
+def make_engine(posts, size=3):
+    """
+    Build a feed engine over posts, a dict of (kind, id) to a list of
+    post ids whose age in minutes equals the post id.
+    """
+    engine = FeedEngine()
+    engine.size = size
+    engine.calls = 0
+
+    def load(kind):
+        def loader(ids, limit):
+            engine.calls += 1
+            return {id: [(now - timedelta(minutes=p), p)
+                         for p in sorted(posts.get((kind, id), []))[:limit]]
+                    for id in ids}
+        return loader
+
+    engine.loader('user')(load('user'))
+    engine.loader('tag')(load('tag'))
+    return engine
+
+
+def test_merge_orders_and_dedupes():
+    engine = make_engine({('user', 1): [1, 4], ('tag', 1): [2, 4, 5]}, 5)
+    page = engine.merge([('user', 1), ('tag', 1)], limit=10)
+    assert [p for _, p in page] == [1, 2, 4, 5]
+    assert engine.calls == 2
+
+
+def test_merge_pages_with_cursor():
+    engine = make_engine({('user', 1): [1, 3, 5], ('user', 2): [2, 4]}, 5)
+    sources = [('user', 1), ('user', 2)]
+    page = engine.merge(sources, limit=2)
+    assert [p for _, p in page] == [1, 2, 3]
+    page = engine.merge(sources, before=page[1][0], limit=2)
+    assert [p for _, p in page] == [3, 4, 5]
+    assert engine.calls == 1
+
+
+def test_merge_falls_back_past_truncated_lists():
+    engine = make_engine({('user', 1): [1, 2, 3, 4], ('user', 2): [9]})
+    assert engine.merge([('user', 1), ('user', 2)], limit=1) is not None
+    assert engine.merge([('user', 1), ('user', 2)], limit=3) is None
+
+
+def test_push_updates_cached_lists():
+    engine = make_engine({('user', 1): [1, 2]}, 4)
+    engine.merge([('user', 1)])
+    engine.push(('user', 1), now, 0)
+    engine.push(('user', 2), now, 7)
+    page = engine.merge([('user', 1), ('user', 2)])
+    assert [p for _, p in page] == [0, 1, 2]
@@ -1,7 +1,18 @@
 # from flask import current_app
+import pytest
+
 from src import db
-from src.blueprints.users.models import User
+from src.blueprints.users.models import User, Timeline, Recommendation, \
+    FanOutProgress
 from src.blueprints.profiles.models import Profile
+from src.blueprints.posts.models import Post, PostRanking, RankingEpoch, \
+    featured_pool
+from src.blueprints.messages.models import Chat, Message, Notification
+from src.blueprints.tags.models import Tag
+from src.lib.buffer import WriteBuffer
+from src.lib.fanout import FanOut
+from src.lib.feed import feed
+from src.tests.utils import add_post
 
 
 # auth
@@ -69,3 +80,298 @@ def test_follow(users):
     assert u1.is_following(u2) is False
     assert u1.followed.count() == 0
     assert u2.followers.count() == 0
+
+
+# posts
+#############
+def test_bulk_to_dict(posts):
+    user = User.find_by_email('adminuser@test.com')
+    query = Post.query.filter(
+        Post.comment_id.is_(None)).order_by(Post.id).all()
+    data = Post.bulk_to_dict(query, user)
+    assert [p['id'] for p in data] == [p.id for p in query]
+    assert data[0]['likes'] == 1
+    assert data[0]['comments'] == 2
+    assert data[0]['isLiked'] is True
+    assert data[0]['author']['isFollowing'] is None
+    assert data[-1]['isLiked'] is False
+
+
+def test_like_counters(posts):
+    user = User.find_by_email('regularuser@test.com')
+    post = Post.query.filter(Post.comment_id.is_(None)).order_by(
+        Post.id).first()
+    likes = post.likes.count()
+
+    for _ in range(2):
+        post.add_like(user)
+        post.save()
+        assert post.like_count == likes + 1 == post.likes.count()
+
+        post.remove_like(user)
+        post.save()
+        assert post.like_count == likes == post.likes.count()
+
+    assert post.comment_count == post.comments.count()
+
+
+def test_reconcile_counters(posts):
+    post = Post.query.filter(Post.comment_id.is_(None)).order_by(
+        Post.id).first()
+    Post.query.filter(Post.id == post.id).update(
+        {Post.like_count: 7, Post.comment_count: 0},
+        synchronize_session=False)
+
+    assert Post.reconcile_counters(post.id, post.id + 1) == 1
+    db.session.refresh(post)
+    assert post.like_count == post.likes.count()
+    assert post.comment_count == post.comments.count()
+    assert Post.reconcile_counters(post.id, post.id + 1) == 0
+
+
+def test_post_rankings(app, posts):
+    epoch = PostRanking.rebuild()
+    ranked = PostRanking.get_posts(epoch).all()
+    reactions = [p.like_count + p.comment_count for p, _ in ranked]
+    assert len(ranked) == Post.query.filter(Post.comment_id.is_(None)).count()
+    assert reactions == sorted(reactions, reverse=True)
+    assert PostRanking.get_epoch() == epoch
+    assert PostRanking.decode_cursor(
+        PostRanking.encode_cursor(epoch, 2)) == (epoch, 2)
+
+    admin = User.find_by_email('adminuser@test.com')
+    post = ranked[0][0]
+    Timeline.push([admin.id], post)
+    assert Timeline.get_top_posts(admin.id, epoch).all() == [ranked[0]]
+
+    # stale snapshots are dropped with their partition
+    for _ in range(app.config['RANKING_EPOCHS_KEPT']):
+        PostRanking.rebuild()
+    assert PostRanking.get_epoch(epoch) != epoch
+    assert PostRanking.get_posts(epoch).count() == 0
+
+    # without a snapshot the top feeds are empty until rank_posts runs
+    RankingEpoch.query.delete()
+    assert PostRanking.get_epoch() is None
+    assert PostRanking.get_posts(None).count() == 0
+
+
+def test_timeline_fan_out(posts):
+    admin = User.find_by_email('adminuser@test.com')
+    common = User.find_by_email('commonuser@test.com')
+    regular = User.find_by_email('regularuser@test.com')
+    post = Post.query.filter_by(user_id=admin.id).first()
+    notifications = Notification.query.filter_by(subject='post').count()
+    Timeline.push([admin.id], post)
+    assert sum(Timeline.fan_out(post, chunk_size=1)) == 1
+    assert [p.id for p, _ in Timeline.get_posts(admin.id)] == [post.id]
+    assert [p.id for p, _ in Timeline.get_posts(common.id)] == [post.id]
+    assert Notification.query.filter_by(
+        subject='post').count() == notifications + 1
+    assert Timeline.get_posts(regular.id).count() == 0
+
+    Timeline.remove_posts(common.id, Post.query.with_parent(admin))
+    assert Timeline.get_posts(common.id).count() == 1
+
+
+def test_timeline_keeps_posts_of_followed_tags(posts):
+    admin = User.find_by_email('adminuser@test.com')
+    common = User.find_by_email('commonuser@test.com')
+    tag = Tag(name='keepers')
+    post = Post.query.filter_by(user_id=admin.id).first()
+    post.tags.append(tag)
+    common.follow_tag(tag)
+    Timeline.push([common.id], post)
+
+    common.unfollow(admin)
+    db.session.flush()
+    Timeline.remove_posts(common.id, Post.query.with_parent(admin))
+    assert [p.id for p, _ in Timeline.get_posts(common.id)] == [post.id]
+
+    common.unfollow_tag(tag)
+    db.session.flush()
+    Timeline.remove_posts(common.id, Post.query.with_parent(tag))
+    assert Timeline.get_posts(common.id).count() == 0
+
+
+def test_merged_feed_skips_deleted_posts(posts):
+    admin = User.find_by_email('adminuser@test.com')
+    post = add_post('deleted after it was merged', admin)
+    feed.clear()
+
+    rows, after = Post.get_merged_feed(admin, limit=1)
+    assert [p.id for p, _ in rows] == [post.id]
+
+    Post.query.filter(Post.id == post.id).delete()
+    rows, after = Post.get_merged_feed(admin, limit=1)
+    assert rows == [] and after == post.created_on
+
+    rows, after = Post.get_merged_feed(admin, after, 1)
+    assert len(rows) == 1 and after is not None
+    feed.clear()
+
+
+def test_recommendations(posts):
+    admin = User.find_by_email('adminuser@test.com')
+    common = User.find_by_email('commonuser@test.com')
+    regular = User.find_by_email('regularuser@test.com')
+    Post.query.filter_by(user_id=admin.id).first().add_like(regular)
+    Recommendation.rebuild(1, max(admin.id, common.id, regular.id) + 1)
+    assert regular.get_users_to_follow() == [admin]
+    assert admin.get_users_to_follow() == [regular]
+    # nothing computed for common, who already follows admin
+    assert common.get_users_to_follow() == [regular]
+
+
+def test_chat_last_messages(users):
+    admin = User.find_by_email('adminuser@test.com')
+    common = User.find_by_email('commonuser@test.com')
+    regular = User.find_by_email('regularuser@test.com')
+
+    for other in (common, regular):
+        user1_id, user2_id = Chat.participants(admin.id, other.id)
+        chat = Chat(user1_id=user1_id, user2_id=user2_id)
+        db.session.add(chat)
+        db.session.flush()
+        message = Message(body='hi', author_id=other.id, chat_id=chat.id)
+        db.session.add(message)
+        db.session.flush()
+        chat.set_last_message(message)
+        admin.add_unread_message(chat.id)
+
+    first = admin.get_chat_last_messages(limit=1)
+    assert [(user, unread) for _, user, _, _, unread in first] == [
+        (regular, 1)]
+    db.session.refresh(admin)
+    assert admin.unread_chats == 2
+
+    chat = first[0][2]
+    rest = admin.get_chat_last_messages(
+        (chat.last_message_at, chat.id), limit=1)
+    assert [user for _, user, _, _, _ in rest] == [common]
+
+    admin.read_chat(chat.id)
+    db.session.refresh(admin)
+    assert admin.unread_chats == 1
+
+
+def test_cleared_chat_leaves_inbox(users):
+    admin = User.find_by_email('adminuser@test.com')
+    regular = User.find_by_email('regularuser@test.com')
+    user1_id, user2_id = Chat.participants(admin.id, regular.id)
+    chat = Chat(user1_id=user1_id, user2_id=user2_id)
+    db.session.add(chat)
+    db.session.flush()
+    message = Message(body='hi', author_id=regular.id, chat_id=chat.id)
+    db.session.add(message)
+    db.session.flush()
+    chat.set_last_message(message)
+
+    admin.clear_chat(chat.id)
+    assert admin.get_chat_messages(chat).all() == []
+    assert admin.get_chat_last_messages() == []
+    assert [user for _, user, _, _, _ in regular.get_chat_last_messages()] \
+        == [admin]
+
+
+def test_chat_messages_deleted_for_me(users):
+    admin = User.find_by_email('adminuser@test.com')
+    regular = User.find_by_email('regularuser@test.com')
+    user1_id, user2_id = Chat.participants(admin.id, regular.id)
+    chat = Chat(user1_id=user1_id, user2_id=user2_id)
+    db.session.add(chat)
+    db.session.flush()
+    first, second = Message(body='1', chat_id=chat.id), Message(
+        body='2', chat_id=chat.id)
+    db.session.add_all([first, second])
+    db.session.flush()
+
+    admin.deleted_messages.append(second)
+    assert admin.get_chat_messages(chat).all() == [first]
+    assert regular.get_chat_messages(chat).count() == 2
+
+
+def test_write_buffer():
+    written = []
+    buffer = WriteBuffer('test', written.append)
+    buffer.worker.submit = lambda func: None
+    buffer.add((1, 2), 5)
+    buffer.add((1, 2), 3)
+    buffer.add((2, 2), 1)
+    buffer.flush()
+    buffer.flush()
+
+    assert written == [{(1, 2): 5, (2, 2): 1}]
+
+
+def test_write_buffer_retries_failures():
+    written = []
+    scheduled = []
+    failures = [ValueError()]
+
+    def write(pending):
+        if failures:
+            raise failures.pop()
+        written.append(pending)
+
+    buffer = WriteBuffer('test', write)
+    buffer.worker.submit = lambda *args: scheduled.append(args)
+    buffer.add((1, 2), 5)
+    with pytest.raises(ValueError):
+        buffer.flush()
+
+    assert scheduled[1][1] == buffer.retry_delay
+    buffer.add((1, 2), 7)
+    buffer.flush()
+    assert written == [{(1, 2): 7}]
+
+
+def test_fan_out_stats(app):
+    def deliver(id):
+        yield 2
+        if id == 2:
+            raise ValueError()
+        yield 3
+
+    fan_out = FanOut('test', deliver, retries=1, retry_delay=60)
+    fan_out.worker.submit = lambda *args: None
+    fan_out.submit(1)
+    fan_out.submit(2)
+    assert fan_out.stats()['queued'] == 2
+    assert fan_out.stats()['current'] == {'id': 1, 'recipients': 0}
+
+    fan_out.run(1)
+    with pytest.raises(ValueError):
+        fan_out.run(2)
+
+    stats = fan_out.stats()
+    assert (stats['queued'], stats['done'], stats['failed']) == (0, 1, 1)
+    assert stats['recipients'] == 7 and stats['lag'] == 0.0
+
+
+def test_fan_out_resumes(posts):
+    admin = User.find_by_email('adminuser@test.com')
+    common = User.find_by_email('commonuser@test.com')
+    post = Post.query.filter_by(user_id=admin.id).first()
+    progress = FanOutProgress(post_id=post.id, part=0, after_id=common.id)
+    db.session.add(progress)
+
+    # common already got it before the fan-out stopped
+    assert list(Timeline.fan_out(post, progress=progress)) == []
+    assert Timeline.get_posts(common.id).count() == 0
+
+    progress.after_id = None
+    assert sum(Timeline.deliver(post.id)) == 1
+    assert FanOutProgress.query.get(post.id) is None
+
+
+def test_featured_pool_skips_empty(posts, monkeypatch):
+    featured_pool.clear()
+    monkeypatch.setattr(Post, 'sample_ids', classmethod(lambda cls, n: []))
+    assert Post.get_featured() == []
+    assert featured_pool.get('ids') is None
+
+    monkeypatch.undo()
+    assert len(Post.get_featured(1)) == 1
+    assert featured_pool.get('ids')
+    featured_pool.clear()
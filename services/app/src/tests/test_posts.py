@@ -3,6 +3,7 @@ import json
 from src import create_app
 from src.config import TestingConfig
 from src.blueprints.posts.models import Post
+from src.blueprints.users.models import User
 
 
 app = create_app(config=TestingConfig)
@@ -55,6 +56,25 @@ def test_create_post(client, token):
     assert isinstance(data, dict) is True
 
 
+def test_search_posts(client, token, posts):
+    response = client.get(
+        '/posts/search?q=laboris',
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    data = json.loads(response.data.decode())
+    assert response.status_code == 200
+    assert len(data['data']) == app.config['ITEMS_PER_PAGE']
+    assert data['nextCursor'] is not None
+
+    response = client.get(
+        f'/posts/search?q=laboris&cursor={data["nextCursor"]}',
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    data = json.loads(response.data.decode())
+    assert len(data['data']) == 1
+    assert data['nextCursor'] is None
+
+
 def test_delete_post(client, token, posts):
     post = Post.query.all()[0]
     response = client.delete(
@@ -181,3 +201,20 @@ def test_like_comment(client, token, posts):
     data = json.loads(response.data.decode())
     assert response.status_code == 200
     assert isinstance(data, dict) is True
+
+
+def test_get_stats(client, token, users):
+    response = client.get(
+        '/posts/stats',
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    data = json.loads(response.data.decode())
+    assert response.status_code == 200
+    assert {'queued', 'done', 'failed', 'lag'} <= set(data['fanOut'])
+
+    common = User.find_by_email('commonuser@test.com')
+    response = client.get(
+        '/posts/stats',
+        headers={'Authorization': f'Bearer {common.encode_auth_token()}'}
+    )
+    assert response.status_code == 403
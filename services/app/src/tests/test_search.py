@@ -0,0 +1,273 @@
+import pytest
+
+import src.lib.search as search
+from src import db
+from src.lib.breaker import CircuitBreaker, CircuitOpenError
+from src.lib.memsearch import MemoryBackend, TextIndex
+from src.lib.mixins import SearchableMixin, search_documents
+from src.lib.mixins.search import reindexed
+from src.lib.search import Indexer, TagsIndex, UsersIndex, SearchUnavailable, \
+    query_index, search_client, memory_backend, query_cache
+from src.blueprints.tags.models import Tag
+from src.blueprints.users.models import User
+
+
+class Tags(object):
+    rows = {1: 'python', 2: 'flask'}
+
+    @classmethod
+    def get_search_documents(cls, ids):
+        return {id: {'name': cls.rows[id]} for id in ids if id in cls.rows}
+
+
+def test_indexer_flush(search_stub, monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        search, 'bulk', lambda client, actions, **kwargs: (
+            sent.extend(actions), (len(sent), []))[1])
+
+    indexer = Indexer()
+    indexer.register(TagsIndex, Tags)
+    indexer.worker.submit = lambda func: None
+    indexer.enqueue([(TagsIndex, 1), (TagsIndex, 3)])
+    indexer.enqueue([(TagsIndex, 1)])
+    indexer.flush()
+
+    assert sorted(sent, key=lambda action: action['_id']) == [
+        {'_op_type': 'index', '_index': 'tags-write', '_id': 1,
+         '_source': {'name': 'python', 'id': 1}},
+        {'_op_type': 'delete', '_index': 'tags-write', '_id': 3},
+    ]
+    indexer.flush()
+    assert len(sent) == 2
+
+
+def test_indexer_requeues_failures(search_stub, monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        search, 'bulk', lambda client, actions, **kwargs: (
+            sent.extend(actions), (len(sent), []))[1])
+
+    class Failing(object):
+        @classmethod
+        def get_search_documents(cls, ids):
+            raise ValueError()
+
+    indexer = Indexer()
+    indexer.register(TagsIndex, Failing)
+    indexer.worker.submit = lambda func: None
+    indexer.retry_delay = 60
+    indexer.enqueue([(TagsIndex, 1)])
+    with pytest.raises(ValueError):
+        indexer.flush()
+
+    indexer.register(TagsIndex, Tags)
+    indexer.flush()
+    assert [action['_id'] for action in sent] == [1]
+
+
+def test_ensure_index(search_stub):
+    indices = search_stub.indices
+    indices.aliases['tags-write'] = set()
+
+    search.ensure_index(search_stub, TagsIndex)
+    assert indices.aliases == {
+        'tags-00000000000000000000': {'tags', 'tags-write'}}
+
+    indices.aliases = {'users': set()}
+    search.ensure_index(search_stub, UsersIndex)
+    assert indices.aliases == {'users': {'users-write'}}
+
+
+def test_reindex_throttled(users):
+    user = User.find_by_email('adminuser@test.com')
+    reindexed.clear()
+    db.session.info.pop('search', None)
+
+    user.reindex()
+    user.reindex()
+    assert db.session.info.pop('search') == {(UsersIndex, user.id)}
+    user.reindex()
+    assert db.session.info.pop('search') == set()
+    reindexed.clear()
+
+
+def test_searchable_defaults():
+    assert Tag(name='python').to_search_document() == {'name': 'python'}
+
+    with pytest.raises(TypeError):
+        class Untyped(SearchableMixin):
+            __search_index__ = TagsIndex
+
+
+def test_circuit_breaker(monkeypatch):
+    breaker = CircuitBreaker(failures=2, reset_timeout=30)
+
+    def fail():
+        raise ValueError()
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(fail)
+
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: 'ok')
+
+    monkeypatch.setattr(breaker, 'reset_timeout', 0)
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert not breaker.is_open
+
+
+def test_query_index(search_stub):
+    search_stub.docs['users'] = {
+        1: {'name': 'Ada Lovelace', 'username': 'ada'},
+        2: {'name': 'Alan Turing', 'username': 'alan'},
+    }
+    assert query_index(UsersIndex, 'lov') == (
+        [(1, search_stub.docs['users'][1])], 1, None)
+
+    search_stub.down = True
+    query_cache.clear()
+    for _ in range(search_client.breaker.failures):
+        with pytest.raises(SearchUnavailable):
+            query_index(UsersIndex, 'lov')
+
+    calls = search_stub.calls
+    with pytest.raises(SearchUnavailable):
+        query_index(UsersIndex, 'lov')
+    assert search_stub.calls == calls
+
+
+def test_search_documents(search_stub):
+    ada = {'name': 'Ada Lovelace', 'username': 'ada', 'avatar': ''}
+    search_stub.docs['users'] = {1: ada}
+
+    assert User.search_documents(UsersIndex, 'lov') == ([(1, ada)], None)
+
+
+def test_search_pages(app, search_stub, monkeypatch):
+    monkeypatch.setitem(app.config, 'SEARCH_RESULTS', 2)
+    search_stub.docs['users'] = {
+        id: {'name': f'Ada {id}', 'username': f'ada{id}', 'followers': 7}
+        for id in range(1, 6)}
+
+    hits, total, after = query_index(UsersIndex, 'ada')
+    assert [id for id, _ in hits] == [1, 2]
+    assert total == 5 and after == (1.0, 2)
+
+    hits, _, after = query_index(UsersIndex, 'ada', after)
+    assert [id for id, _ in hits] == [3, 4]
+    hits, _, after = query_index(UsersIndex, 'ada', after)
+    assert [id for id, _ in hits] == [5] and after is None
+    # followers are a ranking signal, not text
+    assert query_index(UsersIndex, '7')[1] == 0
+
+
+def test_recency_boost_skips_inactive_users():
+    functions = search.elasticsearch_backend._search(
+        UsersIndex, 'ada', 10).to_dict()['query']['function_score'][
+            'functions']
+    gauss, = [function for function in functions if 'gauss' in function]
+    assert gauss['filter'] == {'exists': {'field': 'active_on'}}
+
+
+def test_query_cache(search_stub):
+    search_stub.docs['users'] = {
+        1: {'name': 'Ada Lovelace', 'username': 'ada'},
+        2: {'name': 'Adam Smith', 'username': 'adam'},
+    }
+    hits, total, _ = query_index(UsersIndex, 'Ada ')
+    assert total == 2
+    assert query_index(UsersIndex, 'ada') == (hits, total, None)
+    assert query_index(UsersIndex, 'adam') == ([hits[1]], 1, None)
+    assert search_stub.calls == 1
+
+    query_cache.invalidate(UsersIndex)
+    query_index(UsersIndex, 'ada')
+    assert search_stub.calls == 2
+    assert query_cache.stats()['prefixHits'] == 1
+
+    # a change while searching keeps the result out of the cache
+    result, generation = query_cache.get(UsersIndex, 'lovelace')
+    assert result is None
+    query_cache.invalidate(UsersIndex)
+    query_cache.set(UsersIndex, 'lovelace', (hits, 1, None),
+                    generation=generation)
+    assert query_cache.get(UsersIndex, 'lovelace')[0] is None
+
+
+def test_search_many(search_stub):
+    ada = {'name': 'Ada Lovelace', 'username': 'ada', 'avatar': ''}
+    search_stub.docs['users'] = {1: ada}
+    search_stub.docs['tags'] = {2: {'name': 'adaptive'}}
+
+    assert search_documents([Tag, User], 'ada') == [
+        ([(2, {'name': 'adaptive'})], None), ([(1, ada)], None)]
+
+    search_stub.failing.add('tags')
+    query_cache.clear()
+    assert search_documents([Tag, User], 'ada') == [None, ([(1, ada)], None)]
+
+
+def test_search_fallback(search_stub, session):
+    tag = Tag(name='python_tips')
+    session.add_all([tag, Tag(name='pythonic'), Tag(name='py')])
+    session.flush()
+    search_stub.down = True
+
+    assert Tag.search(TagsIndex, 'python_') == [tag]
+
+
+def test_text_index():
+    index = TextIndex()
+    index.load([
+        (1, {'name': 'Ada Lovelace', 'username': 'ada'}),
+        (2, {'name': 'Adam Smith', 'username': 'adam'}),
+        (3, {'name': 'Alan Turing', 'username': 'turing'}),
+    ])
+    assert index.search('ada') == [1, 2]
+    assert index.search('ad sm') == [2]
+    assert index.search('ring') == [3]
+    assert index.search('x') == []
+
+    index.add(1, {'name': 'Grace Hopper', 'username': 'grace'})
+    index.remove(2)
+    assert index.search('ada') == []
+    assert index.search('opper') == [1]
+    assert index.search('a', limit=1) == [3]
+
+
+def test_text_index_shared_terms():
+    index = TextIndex()
+    index.load((id, {'name': 'Ada'}) for id in range(0, 10, 2))
+    index.add(5, {'name': 'Ada'})
+    index.remove(4)
+    index.add(2, {'name': 'Grace'})
+
+    assert index.search('ada') == [0, 5, 6, 8]
+    assert list(index.ids) == [0, 5, 6, 8, 2]
+
+
+def test_memory_reload_replays_changes():
+    def load(index):
+        # committed while the rows were being read
+        backend.update({index: ({3: {'name': 'python3'}}, [1])})
+        yield 1, {'name': 'python'}
+        yield 2, {'name': 'pypy'}
+
+    backend = MemoryBackend(load, submit=lambda func, *args: None)
+    backend.load(TagsIndex)
+
+    assert backend.get(TagsIndex).search('py') == [2, 3]
+    assert backend._replay == {}
+
+
+def test_memory_search(session):
+    tag = Tag(name='python')
+    session.add_all([tag, Tag(name='flask')])
+    session.flush()
+    memory_backend.clear()
+
+    assert Tag.search(TagsIndex, 'pyt') == [tag]
+    memory_backend.clear()
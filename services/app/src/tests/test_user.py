@@ -90,3 +90,12 @@ def test_get_user_likes(client, token, posts):
     assert data.get('hasNext') is False
     assert len(data.get('likes')) == 2
     assert len(data.get('likes')) <= app.config['ITEMS_PER_PAGE']
+
+
+def test_get_chats_bad_cursor(client, token):
+    for cursor in ('nope', 'MjAyMS0wMS0wMV94', ''):
+        response = client.get(
+            f'/chats?cursor={cursor}',
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        assert response.status_code == 400
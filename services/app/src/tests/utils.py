@@ -1,3 +1,5 @@
+from elasticsearch.exceptions import ConnectionError
+
 from src import db
 from src.blueprints.profiles.models import Profile
 from src.blueprints.users.models import User
@@ -31,6 +33,7 @@ def add_post(body, user, post_id=None):
 
     if post_id:
         post.comment_id = post_id
+        Post.find_by_id(post_id).update_comment_count(1)
 
     post_notifs = []
     for u in user.followers.all():
@@ -40,3 +43,103 @@ def add_post(body, user, post_id=None):
     db.session.add_all(post_notifs)
     post.save()
     return post
+
+
+class StubIndices(object):
+    """
+    Index and alias calls of the Elasticsearch stub, kept as a dict of
+    index name to the set of its aliases.
+    """
+
+    def __init__(self):
+        self.aliases = {}
+
+    def _resolve(self, name):
+        return {index for index, aliases in self.aliases.items()
+                if index == name or name in aliases}
+
+    def exists(self, index, **kwargs):
+        return bool(self._resolve(index))
+
+    def exists_alias(self, name, **kwargs):
+        return any(name in aliases for aliases in self.aliases.values())
+
+    def get(self, index, **kwargs):
+        return {name: {} for name in self._resolve(index)}
+
+    def create(self, index, body=None, **kwargs):
+        self.aliases.setdefault(index, set())
+
+    def update_aliases(self, body, **kwargs):
+        for action in body['actions']:
+            (kind, args), = action.items()
+
+            if kind == 'add':
+                self.aliases[args['index']].add(args['alias'])
+            elif kind == 'remove_index':
+                del self.aliases[args['index']]
+
+
+class StubElasticsearch(object):
+    """
+    Stand-in for the Elasticsearch client. Searches match the start of
+    any word of the text fields of documents kept in memory, sorted by
+    id, every call fails while down is set and searches of the indexes
+    in failing return an error.
+
+    :param docs: dict of index name to a dict of id to document
+    """
+
+    def __init__(self, docs=None):
+        self.docs = docs or {}
+        self.down = False
+        self.failing = set()
+        self.calls = 0
+        self.indices = StubIndices()
+
+    def msearch(self, body=None, index=None, **kwargs):
+        if self.down:
+            self.calls += 1
+            raise ConnectionError('N/A', 'Search stub is down.', None)
+
+        responses = []
+
+        for header, query in zip(body[::2], body[1::2]):
+            if header['index'][0] in self.failing:
+                responses.append({'error': {'type': 'timeout'}})
+            else:
+                responses.append(self.search(query, header['index']))
+
+        return {'responses': responses}
+
+    def search(self, body=None, index=None, **kwargs):
+        self.calls += 1
+
+        if self.down:
+            raise ConnectionError('N/A', 'Search stub is down.', None)
+
+        if isinstance(index, (list, tuple)):
+            index = index[0]
+
+        query = body['query']['function_score']['query']
+        term = query['multi_match']['query'].lower()
+        hits = [
+            {'_index': index, '_id': str(id), '_score': 1.0,
+             '_source': dict(doc, id=id), 'sort': [1.0, id]}
+            for id, doc in sorted(self.docs.get(index, {}).items())
+            if any(word.startswith(term) for value in doc.values()
+                   if isinstance(value, str)
+                   for word in value.lower().split())]
+        after = body.get('search_after')
+        page = [hit for hit in hits
+                if after is None or hit['sort'] > after]
+
+        return {
+            'took': 1,
+            'timed_out': False,
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'max_score': 1.0,
+                'hits': page[:body.get('size', 10)],
+            },
+        }